@@ -0,0 +1,257 @@
+"""
+Token alphabets for rest_framework_encrypted_lookup
+
+Each alphabet converts the encrypted bytes of a token to text and back. The
+'alphabet' setting selects one of ALPHABETS by name.
+"""
+import base64
+import binascii
+import math
+import re
+from string import ascii_lowercase, ascii_uppercase, digits
+
+
+class RFC4648Alphabet(object):
+    """
+    Base class for the RFC 4648 token alphabets, which encode each group of
+    group_bytes bytes into group_chars characters. Tokens carry no padding.
+    """
+
+    name = None
+    group_bytes = None
+    group_chars = None
+    bits_per_char = None
+
+    # A regex of valid tokens, for codecs which would skip foreign characters.
+    pattern = None
+
+    # A regex character class of the characters which decoding accepts.
+    character_class = None
+
+    # The character which encodes zero bits.
+    zero_char = 'A'
+
+    def _encode(self, data):
+        raise NotImplementedError
+
+    def _decode(self, text):
+        raise NotImplementedError
+
+    def encoded_length(self, length):
+        """
+        :param length: a byte length
+        :return: the length of the token which encodes that many bytes
+        """
+        return (length * 8 + self.bits_per_char - 1) // self.bits_per_char
+
+    def decoded_length(self, encoded_length):
+        """
+        :param encoded_length: a token length
+        :return: the number of bytes encoded by a token of that length, or
+            None if no token can have that length
+        """
+        length = encoded_length * self.bits_per_char // 8
+        if self.encoded_length(length) != encoded_length:
+            return None
+
+        return length
+
+    def encode(self, data):
+        return self._encode(data).rstrip('=')
+
+    def _is_malformed(self, text):
+        return self.decoded_length(len(text)) is None or (
+            self.pattern is not None and not self.pattern.match(text)
+        )
+
+    def decode(self, text):
+        if self._is_malformed(text):
+            raise binascii.Error("Malformed %s text: '%s'" % (self.name, text))
+
+        return self._decode(text + '=' * (-len(text) % self.group_chars))
+
+    def encode_many(self, chunks):
+        """
+        Encode a sequence of byte strings in one call.
+
+        Zero-filling every chunk up to a group boundary lets the whole batch
+        be encoded at once and the tokens sliced back out: zero bits encode to
+        the same characters that the single encode produces before padding.
+        """
+        buffer = []
+        spans = []
+        position = 0
+        for chunk in chunks:
+            fill = -len(chunk) % self.group_bytes
+            buffer.append(chunk)
+            buffer.append(b'\0' * fill)
+            spans.append((position, position + self.encoded_length(len(chunk))))
+            position += (len(chunk) + fill) // self.group_bytes * self.group_chars
+
+        if not spans:
+            return []
+
+        text = self._encode(b''.join(buffer))
+
+        return [text[begin:end] for begin, end in spans]
+
+    def decode_many(self, texts):
+        """
+        Decode a sequence of tokens in one call; the inverse of encode_many.
+        """
+        buffer = []
+        spans = []
+        position = 0
+        for text in texts:
+            # Guard the split below: a token of the wrong length or with
+            # foreign characters would otherwise shift every following token.
+            if self._is_malformed(text):
+                raise binascii.Error("Malformed %s text: '%s'" % (self.name, text))
+
+            length = self.decoded_length(len(text))
+
+            fill = -len(text) % self.group_chars
+            buffer.append(text)
+            buffer.append(self.zero_char * fill)
+            spans.append((position, position + length))
+            position += (len(text) + fill) // self.group_chars * self.group_bytes
+
+        if not spans:
+            return []
+
+        data = self._decode(''.join(buffer))
+
+        return [data[begin:end] for begin, end in spans]
+
+
+class Base32Alphabet(RFC4648Alphabet):
+    """
+    Lower-case base32, the original token alphabet. Decoding ignores case.
+    """
+
+    name = 'base32'
+    group_bytes = 5
+    group_chars = 8
+    bits_per_char = 5
+    character_class = 'A-Za-z2-7'
+
+    def _encode(self, data):
+        return base64.b32encode(data).decode('utf-8').lower()
+
+    def _decode(self, text):
+        return base64.b32decode(text.upper())
+
+
+class Base64Alphabet(RFC4648Alphabet):
+    """
+    URL-safe base64: 22 characters per block rather than base32's 26.
+    """
+
+    name = 'base64'
+    group_bytes = 3
+    group_chars = 4
+    bits_per_char = 6
+    pattern = re.compile(r'^[A-Za-z0-9_-]*$')
+    character_class = 'A-Za-z0-9_-'
+
+    def _encode(self, data):
+        return base64.urlsafe_b64encode(data).decode('utf-8')
+
+    def _decode(self, text):
+        return base64.urlsafe_b64decode(text.encode('utf-8'))
+
+
+class Base62Alphabet(object):
+    """
+    Alphanumeric base62: as short as base64, without punctuation.
+
+    Each byte string is encoded as one big-endian number, in the fewest
+    characters which can hold every byte string of its length.
+    """
+
+    name = 'base62'
+    characters = digits + ascii_uppercase + ascii_lowercase
+    pattern = re.compile(r'^[0-9A-Za-z]*$')
+    character_class = '0-9A-Za-z'
+
+    # The characters per byte, log(256) / log(62), a little under 4/3.
+    chars_per_byte = math.log(256) / math.log(62)
+
+    # Lengths are looked up in tables up to this many bytes, and computed beyond it.
+    max_tabulated_length = 256
+
+    def __init__(self):
+        self.indexes = dict((char, index) for index, char in enumerate(self.characters))
+
+        self.encoded_lengths = [
+            self._encoded_length(length) for length in range(self.max_tabulated_length + 1)
+        ]
+        self.decoded_lengths = dict(
+            (encoded_length, length) for length, encoded_length in enumerate(self.encoded_lengths)
+        )
+
+    def _encoded_length(self, length):
+        # Estimated in closed form, then corrected exactly, as the estimate
+        # may round the wrong way.
+        encoded_length = int(math.ceil(length * self.chars_per_byte))
+        while 62 ** encoded_length < 256 ** length:
+            encoded_length += 1
+        while encoded_length and 62 ** (encoded_length - 1) >= 256 ** length:
+            encoded_length -= 1
+
+        return encoded_length
+
+    def encoded_length(self, length):
+        if length <= self.max_tabulated_length:
+            return self.encoded_lengths[length]
+
+        return self._encoded_length(length)
+
+    def decoded_length(self, encoded_length):
+        if encoded_length <= self.encoded_lengths[-1]:
+            return self.decoded_lengths.get(encoded_length)
+
+        # Each byte takes more than one character, so there is at most one candidate.
+        length = int(encoded_length / self.chars_per_byte)
+        for candidate in (length - 1, length, length + 1):
+            if self._encoded_length(candidate) == encoded_length:
+                return candidate
+
+        return None
+
+    def encode(self, data):
+        value = int(binascii.hexlify(data), 16) if data else 0
+        chars = []
+        for _ in range(self.encoded_length(len(data))):
+            value, index = divmod(value, 62)
+            chars.append(self.characters[index])
+
+        return ''.join(reversed(chars))
+
+    def decode(self, text):
+        length = self.decoded_length(len(text))
+        if length is None or not self.pattern.match(text):
+            raise binascii.Error("Malformed %s text: '%s'" % (self.name, text))
+
+        value = 0
+        for char in text:
+            value = value * 62 + self.indexes[char]
+
+        if value >> (8 * length):
+            raise binascii.Error("Malformed %s text: '%s'" % (self.name, text))
+
+        return binascii.unhexlify('%0*x' % (2 * length, value)) if length else b''
+
+    def encode_many(self, chunks):
+        return [self.encode(chunk) for chunk in chunks]
+
+    def decode_many(self, texts):
+        return [self.decode(text) for text in texts]
+
+
+ALPHABETS = dict(
+    (alphabet.name, alphabet) for alphabet in (Base32Alphabet(), Base64Alphabet(), Base62Alphabet())
+)
+
+# Tokens issued before an alphabet was configured use base32.
+LEGACY_ALPHABET = ALPHABETS['base32']
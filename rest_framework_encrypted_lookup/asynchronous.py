@@ -0,0 +1,320 @@
+"""
+Asynchronous views and fields for rest_framework_encrypted_lookup
+
+Requires Django 3.1 or later, the first which runs coroutine views. Under an
+ASGI server, AsyncEncryptedLookupGenericViewSet handles its requests as
+coroutines:
+
+* Lookups are decoded inline; decoding a token takes microseconds.
+* Objects, and the related objects of submitted lookups, are resolved with
+  Django's asynchronous ORM (aget, and async iteration over a
+  filter(pk__in=...) queryset for many=True), where it exists.
+* Everything which may block, such as rest_framework's authentication,
+  validation and saving, and the representation of a page with its batch
+  encryption, runs in an executor, by asgiref's sync_to_async.
+
+Concurrent requests then wait on one another only in that executor, rather
+than in the event loop.
+"""
+import asyncio
+import functools
+
+import django
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404
+
+from rest_framework import mixins, status
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import empty
+from rest_framework.response import Response
+
+from .fields import EncryptedLookupRelatedField, EncryptedLookupManyRelatedField
+from .serializers import EncryptedLookupModelSerializer
+from .views import EncryptedLookupGenericViewSet
+
+if django.VERSION < (3, 1):
+    raise ImportError('rest_framework_encrypted_lookup.asynchronous requires Django 3.1 or later')
+
+# asgiref is installed with Django 3.0 and later.
+from asgiref.sync import sync_to_async  # pylint: disable=wrong-import-position,wrong-import-order
+
+
+async def run_sync(function, *args, **kwargs):
+    """
+    Call a blocking function in an executor, and await its result.
+    """
+    return await sync_to_async(function)(*args, **kwargs)
+
+
+async def aget(queryset, **kwargs):
+    """
+    :return: queryset.get(**kwargs), with the asynchronous ORM where it exists
+    """
+    if hasattr(queryset, 'aget'):  # Django >= 4.1
+        return await queryset.aget(**kwargs)
+
+    return await run_sync(queryset.get, **kwargs)
+
+
+async def alist(iterable):
+    """
+    :return: the items of a queryset, or other iterable, as a list
+    """
+    if isinstance(iterable, list):
+        return iterable
+
+    if hasattr(iterable, '__aiter__'):  # Django >= 4.1
+        items = []
+        async for item in iterable:
+            items.append(item)
+        return items
+
+    return await run_sync(list, iterable)
+
+
+async def ais_valid(serializer, raise_exception=False):
+    """
+    Validate a serializer, resolving the lookups of its asynchronous related fields first.
+
+    The related objects are looked up with the asynchronous ORM, and then
+    found by the serializer's validation, which runs in an executor.
+    """
+    if serializer.initial_data is not empty:
+        # A list serializer has no fields of its own.
+        for field in getattr(serializer, 'fields', {}).values():
+            if field.read_only or not hasattr(field, 'aresolve'):
+                continue
+
+            data = field.get_value(serializer.initial_data)
+            if data is not empty:
+                await field.aresolve(data)
+
+    return await run_sync(serializer.is_valid, raise_exception=raise_exception)
+
+
+async def aget_data(serializer):
+    """
+    :return: the representation of a serializer, built in an executor
+
+    A list serializer's lookups are encrypted in one batch as the page is
+    represented, so large pages do not hold up the event loop.
+    """
+    return await run_sync(getattr, serializer, 'data')
+
+
+# pylint: disable=too-few-public-methods
+class AsyncLookupResolutionMixin(object):
+    """
+    Related-field mixin whose lookups may be resolved ahead of validation, by aresolve.
+    """
+
+    # The last data resolved by aresolve, and its internal value.
+    resolved = None
+
+    async def aresolve(self, data):
+        """
+        Resolve data ahead of validation. Data which cannot be resolved is
+        left to fail, with its usual message, during validation.
+        """
+        try:
+            self.resolved = (data, await self.ato_internal_value(data))
+        except ValidationError:
+            self.resolved = None
+
+    def to_internal_value(self, data):
+        if self.resolved is not None and self.resolved[0] == data:
+            return self.resolved[1]
+
+        return super(AsyncLookupResolutionMixin, self).to_internal_value(data)
+
+
+class AsyncEncryptedLookupRelatedField(AsyncLookupResolutionMixin, EncryptedLookupRelatedField):
+    """
+    EncryptedLookupRelatedField with an asynchronous ato_internal_value.
+    """
+
+    async def ato_internal_value(self, data):
+        lookup = self.get_lookup(data)
+
+        token_field = self.get_related_token_field()
+        if token_field is not None and isinstance(lookup, str):
+            try:
+                return await aget(self.get_queryset(), **{token_field.attname: lookup})
+            except ObjectDoesNotExist:
+                # The token may not have been stored yet; decode it instead.
+                pass
+
+        pk = self.decode_lookup(data, lookup)
+        try:
+            return await aget(self.get_queryset(), pk=pk)
+        except ObjectDoesNotExist:
+            self.fail('does_not_exist', pk_value=pk)
+
+
+class AsyncEncryptedLookupManyRelatedField(AsyncLookupResolutionMixin,
+                                           EncryptedLookupManyRelatedField):
+    """
+    EncryptedLookupManyRelatedField with an asynchronous ato_internal_value.
+
+    The lookups are decoded in one batch, and the related objects fetched with
+    a single pk__in query, iterated asynchronously.
+    """
+
+    async def ato_internal_value(self, data):
+        data, pks, errors = self.decode_items(data)
+        return self.collect_objects(data, pks, errors, await self.aget_objects(set(pks.values())))
+
+    async def aget_objects(self, pks):
+        """
+        :return: dictionary of the related objects by pk, in one query
+        """
+        lookup_field = self.get_lookup_field()
+        objects = await alist(self.get_objects_queryset(pks))
+        return dict((getattr(obj, lookup_field), obj) for obj in objects)
+
+AsyncEncryptedLookupRelatedField.many_related_field_class = AsyncEncryptedLookupManyRelatedField
+
+
+class AsyncEncryptedLookupModelSerializer(EncryptedLookupModelSerializer):
+    """
+    EncryptedLookupModelSerializer whose related fields resolve their lookups
+    asynchronously, under ais_valid.
+    """
+
+    serializer_related_field = AsyncEncryptedLookupRelatedField  # Django Rest Framework 3.0.0
+    _related_class = AsyncEncryptedLookupRelatedField  # Django Rest Framework 3.0.1
+
+
+class AsyncEncryptedLookupGenericViewSet(EncryptedLookupGenericViewSet):
+    """
+    EncryptedLookupGenericViewSet whose views are coroutine functions.
+
+    Actions may be coroutine functions, such as those of the Async*ModelMixin
+    classes below, which are awaited; other actions are run in an executor.
+    """
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super(AsyncEncryptedLookupGenericViewSet, cls).as_view(actions, **initkwargs)
+
+        # Copies the attributes of view, including csrf_exempt, whose decorator would hide
+        # the coroutine.
+        @functools.wraps(view)
+        async def async_view(request, *args, **kwargs):
+            # The synchronous view returns the coroutine of dispatch.
+            return await view(request, *args, **kwargs)
+
+        return async_view
+
+    async def dispatch(self, request, *args, **kwargs):  # pylint: disable=invalid-overridden-method
+        self.decode_lookup_kwargs(request, kwargs)
+
+        # As APIView.dispatch, with the handler awaited or run in an executor.
+        # pylint: disable=attribute-defined-outside-init
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await run_sync(self.initial, request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            if asyncio.iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await run_sync(handler, request, *args, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def aget_object(self):
+        """
+        As get_object, with the object fetched by the asynchronous ORM.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = self.kwargs[lookup_url_kwarg]
+        token_field = self.get_token_field()
+
+        try:
+            if token_field is not None and isinstance(lookup, str):
+                try:
+                    obj = await aget(queryset, **{token_field.attname: lookup})
+                except ObjectDoesNotExist:
+                    # The token may not have been stored yet; decode it instead.
+                    obj = await aget(queryset, **{self.lookup_field: self.decode_lookup(lookup)})
+                self.kwargs[lookup_url_kwarg] = obj.pk
+            else:
+                obj = await aget(queryset, **{self.lookup_field: lookup})
+        except (ObjectDoesNotExist, TypeError, ValueError):
+            raise Http404
+
+        await run_sync(self.check_object_permissions, self.request, obj)
+
+        return obj
+
+
+class AsyncRetrieveModelMixin(object):
+
+    async def retrieve(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        instance = await self.aget_object()
+        return Response(await aget_data(self.get_serializer(instance)))
+
+
+class AsyncListModelMixin(object):
+
+    async def list(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = await run_sync(self.paginate_queryset, queryset)
+        if page is not None:
+            data = await aget_data(self.get_serializer(page, many=True))
+            return self.get_paginated_response(data)
+
+        items = await alist(queryset)
+        return Response(await aget_data(self.get_serializer(items, many=True)))
+
+
+class AsyncCreateModelMixin(mixins.CreateModelMixin):
+
+    async def create(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        serializer = self.get_serializer(data=request.data)
+        await ais_valid(serializer, raise_exception=True)
+        await run_sync(self.perform_create, serializer)
+
+        data = await aget_data(serializer)
+        headers = self.get_success_headers(data)
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class AsyncUpdateModelMixin(mixins.UpdateModelMixin):
+
+    async def update(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        partial = kwargs.pop('partial', False)
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        await ais_valid(serializer, raise_exception=True)
+        await run_sync(self.perform_update, serializer)
+
+        return Response(await aget_data(serializer))
+
+    async def partial_update(self, request, *args, **kwargs):
+        kwargs['partial'] = True
+        return await self.update(request, *args, **kwargs)
+
+
+class AsyncDestroyModelMixin(mixins.DestroyModelMixin):
+
+    async def destroy(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        instance = await self.aget_object()
+        await run_sync(self.perform_destroy, instance)
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
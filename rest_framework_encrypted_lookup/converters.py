@@ -0,0 +1,50 @@
+"""
+URL path converter for rest_framework_encrypted_lookup
+
+Django 2.0 and later route path() patterns through converters. Importing this
+module registers EncryptedLookupConverter as "encrypted_lookup" there, so that
+
+    path('users/<encrypted_lookup:pk>/', ...)
+
+matches only well-formed tokens and hands the view a decoded id. Earlier
+versions of Django have no converters; use the regex of
+EncryptedLookupConverter, or a router and EncryptedLookupGenericViewSet.
+"""
+import six
+
+try:
+    from django.urls import register_converter
+except ImportError:  # Django < 2.0
+    register_converter = None
+
+from .registry import id_cipher
+
+
+class EncryptedLookupConverter(object):
+    """
+    Path converter between encrypted lookups and ids.
+
+    Subclass and override get_cipher to convert the lookups of another cipher,
+    such as a model's cipher from id_cipher_registry.
+    """
+
+    @staticmethod
+    def get_cipher():
+        return id_cipher
+
+    @property
+    def regex(self):
+        return '(?:%s)' % self.get_cipher().get_token_pattern()
+
+    def to_python(self, value):
+        # A ValueError makes the resolver try the next pattern.
+        return self.get_cipher().decode(value)
+
+    def to_url(self, value):
+        if isinstance(value, six.string_types):
+            return value
+        return self.get_cipher().encode(value)
+
+
+if register_converter is not None:
+    register_converter(EncryptedLookupConverter, 'encrypted_lookup')
@@ -0,0 +1,9 @@
+"""
+Exceptions for rest_framework_encrypted_lookup
+"""
+
+
+class InvalidTokenError(ValueError):
+    """
+    Raised by the ciphers' decode methods for any text which is not a valid token.
+    """
@@ -1,56 +1,471 @@
 import json
-from argparse import Namespace
+import re
+import uuid
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.utils.translation import ugettext_lazy as _
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ObjectDoesNotExist
+from django.utils.translation import gettext_lazy as _
+
+try:
+    from django.urls import NoReverseMatch, Resolver404, get_script_prefix, resolve, reverse
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import (
+        NoReverseMatch, Resolver404, get_script_prefix, resolve, reverse,
+    )
+import six
+from six.moves.urllib import parse as urlparse
 
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import ManyRelatedField, MANY_RELATION_KWARGS
+
+from .instrumentation import instrumented
+from .models import StoredToken, get_loaded_related_object, get_stored_token, get_token_field
+from .registry import get_key_type, id_cipher_registry
+from .settings import encrypted_lookup_settings
 
 
 # pylint: disable=too-few-public-methods
 class EncryptedLookupFieldMixin(object):
 
     def get_cipher(self):
+        # A list serializer may have encrypted this row's lookups in advance,
+        # by the field name of the many-related field of a child relation.
+        field = self.parent if isinstance(self.parent, ManyRelatedField) else self
+        batch_ciphers = getattr(field.parent, 'batch_ciphers', None)
+        if batch_ciphers and field.field_name in batch_ciphers:
+            return batch_ciphers[field.field_name]
+
+        return self.get_lookup_cipher()
+
+    def get_lookup_cipher(self):
+        """
+        :return: the cipher of the lookups this field presents, before any batching
+        """
         return self.parent.get_cipher()
 
+    def get_stored_token(self, obj):
+        """
+        :return: the token stored on obj, if it is the lookup this field's cipher would
+            encrypt, or else None
+        """
+        token = get_stored_token(obj)
+        if token is not None and \
+                self.get_lookup_cipher() is not id_cipher_registry.get_for_model(obj.__class__):
+            # A serializer's own cipher may not be the one the token was stored with.
+            return None
+
+        return token
+
+
+class EncryptedLookupRelationMixin(EncryptedLookupFieldMixin):
+    """
+    Encrypted lookup mixin for fields presenting the lookups of a related model.
+
+    With the 'model_namespaces' setting enabled, these lookups are encrypted
+    with the related model's cipher rather than with the serializer's. So are
+    they when the related model's pk is not an integer, such as a UUID, whose
+    key type the serializer's cipher may not share.
+    """
+
+    # The ManyRelatedField class which a related field builds with many=True.
+    many_related_field_class = None
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs.keys():
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        # Set on each concrete class, after its many-related field class is defined.
+        return cls.many_related_field_class(**list_kwargs)  # pylint: disable=not-callable
+
+    def get_lookup_cipher(self):
+        if not encrypted_lookup_settings['model_namespaces']:
+            model = self.get_lookup_model()
+            if model is None or get_key_type(model) == 'int':
+                return self.parent.get_cipher()
+
+            return id_cipher_registry.get_for_model(model)
+
+        model = self.get_lookup_model()
+        if model is None:
+            raise ImproperlyConfigured(
+                "Cannot determine the related model of encrypted lookup field '%s'; "
+                "give it a queryset." % self.field_name
+            )
+
+        return id_cipher_registry.get_for_model(model)
+
+    def get_lookup_model(self):
+        """
+        :return: the related model, from the field's queryset or else from the serializer's model
+        """
+        queryset = getattr(self, 'queryset', None)
+        if queryset is None:
+            queryset = getattr(getattr(self, 'child_relation', None), 'queryset', None)
+        if queryset is not None:
+            # Stand-ins for querysets, such as lists of objects, may have no model.
+            return getattr(queryset, 'model', None)
+
+        model = getattr(getattr(self.parent, 'Meta', None), 'model', None)
+        if model is None:
+            # A child relation, bound to a ManyRelatedField.
+            get_lookup_model = getattr(self.parent, 'get_lookup_model', None)
+            return get_lookup_model() if get_lookup_model is not None else None
+
+        try:
+            field = model._meta.get_field(self.source)  # pylint: disable=protected-access
+        except FieldDoesNotExist:
+            return None
+
+        return getattr(field, 'related_model', None) or field.rel.to
+
 
 # TODO: Refactor abstract-method error from class
 # pylint: disable=abstract-method
 class EncryptedLookupField(EncryptedLookupFieldMixin, serializers.ReadOnlyField):
     """
     Read-only rest_framework field used to present an encrypted-lookup field.
+
+    The pk of a model with an EncryptedLookupTokenField is presented by its stored token.
     """
+    def get_attribute(self, instance):
+        token = self.get_stored_token(instance)
+        if token is not None and len(self.source_attrs) == 1:
+            pk_attname = instance._meta.pk.attname  # pylint: disable=protected-access
+            if self.source_attrs[0] in ('pk', pk_attname):
+                return token
+
+        return super(EncryptedLookupField, self).get_attribute(instance)
+
     def to_representation(self, value):
+        if isinstance(value, StoredToken):
+            return six.text_type(value)
+
         return self.get_cipher().encode(value)
 
 
-class EncryptedLookupRelatedField(EncryptedLookupFieldMixin,
+class StoredTokenRelationMixin(object):
+    """
+    Related-field mixin which reads a related object loaded with select_related,
+    rather than only its pk, so that its stored token can be presented.
+    """
+
+    def get_attribute(self, instance):
+        if len(self.source_attrs) == 1:
+            related = get_loaded_related_object(instance, self.source_attrs[0])
+            if related is not None and get_stored_token(related) is not None:
+                return related
+
+        return super(StoredTokenRelationMixin, self).get_attribute(instance)
+
+
+class EncryptedLookupRelatedField(StoredTokenRelationMixin, EncryptedLookupRelationMixin,
                                   serializers.PrimaryKeyRelatedField):
     """
     Encrypted lookup field to be used in place of PrimaryKeyRelatedField
+
+    Related models with an EncryptedLookupTokenField are looked up by their
+    token column, and presented by their stored token when loaded with
+    select_related.
     """
 
+    @staticmethod
+    def load_lookup(data):
+        """
+        Unwrap a json encoded encrypted lookup.
+        """
+        if isinstance(data, str):
+            data = json.loads(data)
+        return data
+
     def to_internal_value(self, data):
+        lookup = self.get_lookup(data)
+
+        token_field = self.get_related_token_field()
+        if token_field is not None and isinstance(lookup, six.string_types):
+            try:
+                return self.get_related_object_by_token(token_field, lookup)
+            except ObjectDoesNotExist:
+                # The token may not have been stored yet; decode it instead.
+                pass
+
+        pk = self.decode_lookup(data, lookup)
         try:
-            if isinstance(data, str):
-                data = json.loads(data)
-            data = self.get_cipher().decode(data)
-            return self.get_queryset().get(pk=data)
+            return self.get_related_object(pk)
         except ObjectDoesNotExist:
-            self.fail('does_not_exist', pk_value=data)
+            self.fail('does_not_exist', pk_value=pk)
+
+    def get_lookup(self, data):
+        """
+        Return the encrypted lookup of data, failing if it is not json encoded.
+        """
+        try:
+            return self.load_lookup(data)
         except (TypeError, ValueError):
             self.fail('incorrect_type_encrypted_lookup', data_type=type(data).__name__)
 
+    def decode_lookup(self, data, lookup):
+        """
+        Return the pk of an encrypted lookup, failing if it is not a token.
+        """
+        try:
+            return self.get_cipher().decode(lookup)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type_encrypted_lookup', data_type=type(data).__name__)
+
+    def get_related_token_field(self):
+        """
+        :return: the token field of the related model, if its tokens are this field's
+            lookups, or else None
+        """
+        model = getattr(self.get_queryset(), 'model', None)
+        token_field = get_token_field(model)
+        if token_field is None or \
+                self.get_lookup_cipher() is not id_cipher_registry.get_for_model(model):
+            return None
+
+        return token_field
+
+    @instrumented('related_query')
+    def get_related_object(self, pk):
+        return self.get_queryset().get(pk=pk)
+
+    @instrumented('related_query')
+    def get_related_object_by_token(self, token_field, token):
+        return self.get_queryset().get(**{token_field.attname: token})
+
     def to_representation(self, value):
+        token = self.get_stored_token(value)
+        if token is not None:
+            return six.text_type(token)
+
         return self.get_cipher().encode(value.pk)
 
 EncryptedLookupRelatedField.default_error_messages['incorrect_type_encrypted_lookup'] = \
     _('Incorrect type. Expected json encoded string value, received {data_type}.')
 
 
-class EncryptedLookupHyperlinkedRelatedField(EncryptedLookupFieldMixin,
+class EncryptedLookupManyRelatedField(EncryptedLookupRelationMixin, ManyRelatedField):
+    """
+    ManyRelatedField used by EncryptedLookupRelatedField(many=True).
+
+    All lookups are decoded in one batch and resolved with a single pk__in
+    query, rather than with one decode and one query per lookup. Every
+    malformed or missing lookup is reported in the same validation error.
+    """
+
+    def to_internal_value(self, data):
+        data, pks, errors = self.decode_items(data)
+        return self.collect_objects(data, pks, errors, self.get_objects(set(pks.values())))
+
+    def decode_items(self, data):
+        """
+        Check that data is a list, and decode the lookups of its items in one batch.
+
+        :return: the list of items, a dictionary of decoded pks by item index,
+            and a dictionary of error messages by item index
+        """
+        if isinstance(data, type('')) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not getattr(self, 'allow_empty', True) and len(data) == 0:
+            self.fail('empty')
+
+        data = list(data)
+        lookups, errors = self.get_lookups(data)
+        pks = self.decode_lookups(data, lookups, errors)
+
+        return data, pks, errors
+
+    def collect_objects(self, data, pks, errors, objects):
+        """
+        :param objects: dictionary of the related objects by pk
+        :return: the related object of each item, in order
+        :raise ValidationError: listing the error of every item which has no related object
+        """
+        ret = []
+        messages = []
+        for index in range(len(data)):
+            if index in errors:
+                messages.append(errors[index])
+            elif pks[index] not in objects:
+                messages.append(self.get_missing_error(pks[index]))
+            else:
+                ret.append(objects[pks[index]])
+
+        if messages:
+            raise ValidationError(messages)
+
+        return ret
+
+    def get_lookups(self, data):
+        """
+        Extract the encrypted lookup of each item.
+
+        :return: the list of lookups, and a dictionary of error messages by
+            the index of each item which holds no lookup
+        """
+        lookups = []
+        errors = {}
+        for index, item in enumerate(data):
+            try:
+                lookups.append(self.child_relation.load_lookup(item))
+            except (TypeError, ValueError):
+                lookups.append(None)
+                errors[index] = self.get_decode_error(item)
+
+        return lookups, errors
+
+    def decode_lookups(self, data, lookups, errors):
+        """
+        Decode the lookups of the items without errors, adding an error for
+        each lookup which cannot be decoded.
+
+        :return: dictionary of decoded pks by item index
+        """
+        cipher = self.get_cipher()
+        indexes = [index for index in range(len(data)) if index not in errors]
+
+        try:
+            return dict(zip(indexes, cipher.decode_many([lookups[index] for index in indexes])))
+        except (TypeError, ValueError):
+            # At least one lookup is malformed. Decode them one at a time, so
+            # that each malformed lookup can be reported.
+            pass
+
+        pks = {}
+        for index in indexes:
+            try:
+                pks[index] = cipher.decode(lookups[index])
+            except (TypeError, ValueError):
+                errors[index] = self.get_decode_error(data[index])
+
+        return pks
+
+    def get_lookup_field(self):
+        return 'pk'
+
+    def get_objects_queryset(self, pks):
+        """
+        :return: queryset of the related objects with the given pks
+        """
+        return self.child_relation.get_queryset().filter(**{self.get_lookup_field() + '__in': pks})
+
+    @instrumented('related_query')
+    def get_objects(self, pks):
+        """
+        :return: dictionary of the related objects by pk, in one query
+        """
+        lookup_field = self.get_lookup_field()
+        return dict((getattr(obj, lookup_field), obj) for obj in self.get_objects_queryset(pks))
+
+    def get_decode_error(self, item):
+        return self.child_relation.error_messages['incorrect_type_encrypted_lookup'].format(
+            data_type=type(item).__name__
+        )
+
+    def get_missing_error(self, pk):
+        return self.child_relation.error_messages['does_not_exist'].format(pk_value=pk)
+
+EncryptedLookupRelatedField.many_related_field_class = EncryptedLookupManyRelatedField
+
+
+class EncryptedLookupHyperlinkedRelatedField(StoredTokenRelationMixin, EncryptedLookupRelationMixin,
                                              serializers.HyperlinkedRelatedField):
 
+    def __init__(self, view_name=None, **kwargs):
+        super(EncryptedLookupHyperlinkedRelatedField, self).__init__(view_name, **kwargs)
+
+        # Reversed URLs, split around their lookup, by view name, format,
+        # request and lookup length.
+        self.url_templates = {}
+
+        # URL paths, split around their lookup, with a regex of lookups, by view name.
+        self.route_templates = {}
+
+    def get_route_template(self, view_name):
+        """
+        Reverse the view's URL pattern once, around a sample lookup.
+
+        :return: the path before and after the lookup, and a regex of lookups,
+            or None if the pattern cannot be reversed with a lookup alone
+        """
+        try:
+            return self.route_templates[view_name]
+        except KeyError:
+            pass
+
+        cipher = self.get_cipher()
+        sample_id = uuid.UUID(int=0) if getattr(cipher, 'key_type', 'int') == 'uuid' else 0
+        try:
+            sample = cipher.encode(sample_id)
+        except (TypeError, ValueError):
+            # Hyperlinks of a cipher which cannot encode the sample are resolved instead.
+            return self.route_templates.setdefault(view_name, None)
+
+        get_token_pattern = getattr(cipher, 'get_token_pattern', None)
+        pattern = get_token_pattern() if get_token_pattern is not None else '[^/]+'
+
+        try:
+            parts = reverse(view_name, kwargs={self.lookup_url_kwarg: sample}).split(sample)
+        except NoReverseMatch:
+            parts = []
+
+        template = None
+        if len(parts) == 2:
+            template = (parts[0], parts[1], re.compile('^(?:%s)$' % pattern))
+
+        return self.route_templates.setdefault(view_name, template)
+
+    def parse_lookup(self, data):
+        """
+        Return the encrypted lookup of a hyperlink, failing as to_internal_value would.
+
+        Hyperlinks are matched against the view's route template; only those
+        which do not fit it are resolved.
+        """
+        request = self.context.get('request', None)
+        try:
+            http_prefix = data.startswith(('http:', 'https:'))
+        except AttributeError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        path = urlparse.urlparse(data).path if http_prefix else data
+
+        try:
+            expected_viewname = request.versioning_scheme.get_versioned_viewname(
+                self.view_name, request
+            )
+        except AttributeError:
+            expected_viewname = self.view_name
+
+        template = self.get_route_template(expected_viewname)
+        if template is not None:
+            prefix, suffix, lookup_regex = template
+            if path.startswith(prefix) and path.endswith(suffix):
+                lookup = path[len(prefix):len(path) - len(suffix)]
+                if lookup_regex.match(lookup):
+                    return lookup
+
+        if http_prefix:
+            script_prefix = get_script_prefix()
+            if path.startswith(script_prefix):
+                path = '/' + path[len(script_prefix):]
+
+        try:
+            match = resolve(path)
+        except Resolver404:
+            self.fail('no_match')
+
+        if match.view_name != expected_viewname:
+            self.fail('incorrect_match')
+
+        try:
+            return match.kwargs[self.lookup_url_kwarg]
+        except KeyError:
+            self.fail('does_not_exist')
+
+    @instrumented('related_query')
     def get_object(self, view_name, view_args, view_kwargs):
         encrypted_url_kwarg = view_kwargs[self.lookup_url_kwarg]
         decrypted_url_kwarg = self.get_cipher().decode(encrypted_url_kwarg)
@@ -61,10 +476,64 @@ class EncryptedLookupHyperlinkedRelatedField(EncryptedLookupFieldMixin,
 
         return parent.get_object(view_name, view_args, view_kwargs)
 
+    @instrumented('hyperlink')
     def get_url(self, obj, view_name, request, url_format):
-        new_obj = Namespace()
-        new_obj.pk = self.get_cipher().encode(obj.pk)
+        """
+        Return the URL of obj, with its encrypted lookup.
 
-        parent = super(EncryptedLookupHyperlinkedRelatedField, self)
+        Each URL pattern is reversed once, and its URLs are then made by
+        inserting the lookup. Lookups of one cipher and length share their
+        characters and shape, so the result is the URL reverse() would give.
+        """
+        lookup = self.get_stored_token(obj) or self.get_cipher().encode(obj.pk)
+
+        # The request, which may not be hashable, is kept in the value so that its id stays unique.
+        key = (view_name, url_format, id(request), len(lookup))
+        try:
+            _, prefix, suffix = self.url_templates[key]
+        except KeyError:
+            url = self.reverse(view_name, kwargs={self.lookup_url_kwarg: lookup},
+                               request=request, format=url_format)
+
+            parts = url.split(lookup)
+            if len(parts) != 2:
+                # The lookup is not the only match, so a template could not be trusted.
+                return url
+
+            _, prefix, suffix = self.url_templates.setdefault(key, (request, parts[0], parts[1]))
+
+        return prefix + lookup + suffix
+
+
+class EncryptedLookupHyperlinkedManyRelatedField(EncryptedLookupManyRelatedField):
+    """
+    ManyRelatedField used by EncryptedLookupHyperlinkedRelatedField(many=True).
+
+    Hyperlinks are parsed against a route template rather than resolved one
+    by one, and their lookups are decoded in one batch and resolved with a
+    single query.
+    """
+
+    def get_lookups(self, data):
+        lookups = []
+        errors = {}
+        for index, item in enumerate(data):
+            try:
+                lookups.append(self.child_relation.parse_lookup(item))
+            except ValidationError as error:
+                lookups.append(None)
+                errors[index] = error.detail[0] if isinstance(error.detail, list) else error.detail
+
+        return lookups, errors
+
+    def get_lookup_field(self):
+        return self.child_relation.lookup_field
+
+    def get_decode_error(self, item):
+        return self.child_relation.error_messages['does_not_exist']
+
+    def get_missing_error(self, pk):
+        return self.child_relation.error_messages['does_not_exist']
 
-        return parent.get_url(new_obj, view_name, request, url_format)
+EncryptedLookupHyperlinkedRelatedField.many_related_field_class = \
+    EncryptedLookupHyperlinkedManyRelatedField
@@ -0,0 +1,192 @@
+"""
+Django-Rest-Framework filter backend for rest_framework_encrypted_lookup
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.test.signals import setting_changed
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+try:
+    import django_filters
+except ImportError:  # django-filter is only needed by EncryptedLookupFilter
+    django_filters = None
+
+from .fields import EncryptedLookupField, EncryptedLookupRelatedField, \
+    EncryptedLookupManyRelatedField, EncryptedLookupHyperlinkedRelatedField
+from .registry import id_cipher_registry
+from .views import DEFAULT_GET_CIPHER, get_function
+
+
+INVALID_LOOKUP_MESSAGE = _('"{value}" is not a valid encrypted lookup.')
+
+
+# The filterable fields by serializer class and field names, for serializers whose cipher
+# does not depend on their context. rest_framework builds a new filter backend for every
+# request, so they are kept here.
+filter_fields = {}  # pylint: disable=invalid-name
+
+
+def clear_filter_fields(**kwargs):
+    if kwargs['setting'] == 'ENCRYPTED_LOOKUP':
+        filter_fields.clear()
+
+
+setting_changed.connect(clear_filter_fields)
+
+
+def split_lookups(values):
+    """
+    :param values: query parameter values, each holding one or more comma-separated lookups
+    :return: list of lookups
+    """
+    return [lookup for value in values for lookup in value.split(',') if lookup]
+
+
+def decode_lookups(cipher, lookups):
+    """
+    Decode lookups in one batch.
+
+    :raise ValidationError: listing every lookup which cannot be decoded
+    """
+    try:
+        return cipher.decode_many(lookups)
+    except (TypeError, ValueError):
+        # Decode the lookups one at a time, so that each malformed lookup can be reported.
+        pass
+
+    pks = []
+    errors = []
+    for lookup in lookups:
+        try:
+            pks.append(cipher.decode(lookup))
+        except (TypeError, ValueError):
+            errors.append(INVALID_LOOKUP_MESSAGE.format(value=lookup))
+
+    if errors:
+        raise ValidationError(errors)
+
+    return pks
+
+
+def get_lookup_model(model, path):
+    """
+    :return: the model whose pks the field at path, relative to model, holds
+    """
+    for name in path.split('__'):
+        try:
+            field = model._meta.get_field(name)  # pylint: disable=protected-access
+        except FieldDoesNotExist:
+            return model
+
+        related_model = getattr(field, 'related_model', None) or \
+            getattr(getattr(field, 'rel', None), 'to', None)
+        if related_model is None:
+            return model
+        model = related_model
+
+    return model
+
+
+class EncryptedLookupFilterBackend(BaseFilterBackend):
+    """
+    Filter backend for encrypted lookups in query parameters.
+
+    Each encrypted-lookup field of the view's serializer may be filtered on by
+    its name, with one or more comma-separated lookups (not hyperlinks), as in
+    ?related=<lookup>,<lookup> or ?id__in=<lookup>,<lookup>. The lookups of
+    each field are decoded in one batch and applied as a single __in filter.
+    A malformed lookup is rejected with a validation error before any query.
+
+    A view may restrict the filterable fields with encrypted_lookup_filter_fields.
+    """
+
+    field_classes = (
+        EncryptedLookupField,
+        EncryptedLookupRelatedField,
+        EncryptedLookupHyperlinkedRelatedField,
+        EncryptedLookupManyRelatedField,
+    )
+
+    def filter_queryset(self, request, queryset, view):
+        query_params = getattr(request, 'query_params', request.GET)
+        if not query_params:
+            return queryset
+
+        for name, (path, field) in self.get_filter_fields(view).items():
+            values = query_params.getlist(name) + query_params.getlist(name + '__in')
+            lookups = split_lookups(values)
+            if not lookups:
+                continue
+
+            try:
+                pks = decode_lookups(field.get_cipher(), lookups)
+            except ValidationError as error:
+                raise ValidationError({name: error.detail})
+
+            queryset = queryset.filter(**{path + '__in': set(pks)})
+            if isinstance(field, EncryptedLookupManyRelatedField):
+                queryset = queryset.distinct()
+
+        return queryset
+
+    def get_filter_fields(self, view):
+        """
+        :return: dictionary of the view serializer's filterable fields, as (filter path,
+            field), by field name
+        """
+        serializer_class = view.get_serializer_class()
+        names = getattr(view, 'encrypted_lookup_filter_fields', None)
+        key = (serializer_class, None if names is None else tuple(names))
+        get_cipher = get_function(getattr(serializer_class, 'get_cipher', None))
+        cacheable = get_cipher is DEFAULT_GET_CIPHER
+
+        if cacheable and key in filter_fields:
+            return filter_fields[key]
+
+        # A cached serializer is built without context, so that it keeps no request.
+        serializer = serializer_class() if cacheable else view.get_serializer()
+
+        fields = dict(
+            (name, (field.source.replace('.', '__'), field))
+            for name, field in serializer.fields.items()
+            if isinstance(field, self.field_classes) and field.source != '*' and
+            (names is None or name in names)
+        )
+
+        if cacheable:
+            filter_fields[key] = fields
+
+        return fields
+
+
+if django_filters is not None:
+
+    class EncryptedLookupFilter(django_filters.CharFilter):
+        """
+        django-filter filter of comma-separated encrypted lookups.
+
+        The lookups are decoded in one batch and applied as a single __in
+        filter. They are decoded with the given cipher, or else with the
+        cipher of the model whose pks the filtered field holds.
+        """
+
+        def __init__(self, *args, **kwargs):
+            self.cipher = kwargs.pop('cipher', None)
+            super(EncryptedLookupFilter, self).__init__(*args, **kwargs)
+
+        def filter(self, qs, value):
+            if value in ([], (), {}, None, ''):
+                return qs
+
+            # django-filter 2 renamed name to field_name.
+            path = getattr(self, 'field_name', None) or self.name
+            cipher = self.cipher or \
+                id_cipher_registry.get_for_model(get_lookup_model(qs.model, path))
+
+            pks = decode_lookups(cipher, split_lookups([value]))
+            qs = self.get_method(qs)(**{path + '__in': set(pks)})
+            if self.distinct:
+                qs = qs.distinct()
+            return qs
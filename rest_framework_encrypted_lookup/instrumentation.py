@@ -0,0 +1,246 @@
+"""
+Instrumentation for rest_framework_encrypted_lookup
+
+Counters and timings of the package's hot paths are reported to the sinks listed
+by the 'instrumentation_sinks' setting, which may be instances or dotted paths of
+sink classes. Counters:
+
+    encode, decode          ids encoded or decoded, singly or in batches
+    decode_failure          decode calls which rejected a token
+    cache_hit, cache_miss   lookups in the ciphers' LRU caches
+    related_query           queries for related objects by decoded lookup
+    hyperlink               hyperlinks generated
+
+Timings, in seconds: encode, encode_many, decode, decode_many, related_query
+and hyperlink.
+
+With no sinks configured, which is the default, ciphers are not wrapped at all,
+and instrumented field methods make a single check before doing their work.
+"""
+import bisect
+import functools
+import threading
+from timeit import default_timer
+
+from django.dispatch import Signal
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_string
+import six
+
+from .settings import encrypted_lookup_settings
+
+
+# Sent by SignalSink with the keyword arguments kind ('increment' or 'timing'), name and value.
+metric_recorded = Signal()  # pylint: disable=invalid-name
+
+
+class Sink(object):
+    """
+    Receiver of metrics. Subclasses override either method.
+    """
+
+    def increment(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+
+class CallbackSink(Sink):
+    """
+    Sink which passes each metric to a callback, as callback(kind, name, value).
+
+    This adapts metrics clients such as statsd or prometheus_client.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def increment(self, name, value=1):
+        self.callback('increment', name, value)
+
+    def timing(self, name, seconds):
+        self.callback('timing', name, seconds)
+
+
+class SignalSink(Sink):
+    """
+    Sink which sends each metric as the metric_recorded signal.
+    """
+
+    def increment(self, name, value=1):
+        metric_recorded.send(sender=self.__class__, kind='increment', name=name, value=value)
+
+    def timing(self, name, seconds):
+        metric_recorded.send(sender=self.__class__, kind='timing', name=name, value=seconds)
+
+
+class MemorySink(Sink):
+    """
+    Thread-safe sink which keeps counters, and histograms of timings, in memory.
+    """
+
+    # Upper bounds of the histogram buckets, in seconds; the last bucket is unbounded.
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = {
+                    'count': 0, 'sum': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1),
+                }
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def get_stats(self):
+        """
+        :return: dictionary of counters, and of timing histograms with their count, sum and
+            bucket counts
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': dict(
+                    (name, {
+                        'count': histogram['count'],
+                        'sum': histogram['sum'],
+                        'buckets': list(zip(self.BUCKETS + (float('inf'),), histogram['buckets'])),
+                    })
+                    for name, histogram in self.timings.items()
+                ),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+
+class Instrumentation(object):
+    """
+    The configured sinks, built on first use, and again after the ENCRYPTED_LOOKUP setting changes.
+    """
+
+    def __init__(self):
+        self._sinks = None
+
+    @property
+    def sinks(self):
+        if self._sinks is None:
+            self._sinks = tuple(
+                import_string(sink)() if isinstance(sink, six.string_types) else sink
+                for sink in encrypted_lookup_settings['instrumentation_sinks']
+            )
+        return self._sinks
+
+    def reload(self):
+        self._sinks = None
+
+    def increment(self, name, value=1):
+        for sink in self.sinks:
+            sink.increment(name, value)
+
+    def timing(self, name, seconds):
+        for sink in self.sinks:
+            sink.timing(name, seconds)
+
+
+instrumentation = Instrumentation()  # pylint: disable=invalid-name
+
+
+def reload_instrumentation(**kwargs):
+    if kwargs['setting'] == 'ENCRYPTED_LOOKUP':
+        instrumentation.reload()
+
+
+setting_changed.connect(reload_instrumentation)
+
+
+def instrumented(name):
+    """
+    Decorate a method to count and time its calls as name, while any sink is configured.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.sinks:
+                return method(*args, **kwargs)
+
+            started = default_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                instrumentation.increment(name)
+                instrumentation.timing(name, default_timer() - started)
+        return wrapper
+    return decorator
+
+
+class InstrumentedIDCipher(object):
+    """
+    Proxy which reports the work of a cipher to the instrumentation sinks.
+
+    build_id_cipher wraps its ciphers in this proxy only while any sink is configured.
+    """
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+
+    def encode(self, this_id):
+        return self.record('encode', 'encode', 'encode_cache', 1, self.cipher.encode, this_id)
+
+    # The batch methods take any iterable, so their ids are counted from their results.
+
+    def encode_many(self, ids):
+        return self.record('encode_many', 'encode', 'encode_cache', None,
+                           self.cipher.encode_many, ids)
+
+    def decode(self, encoded):
+        return self.record('decode', 'decode', 'decode_cache', 1, self.cipher.decode, encoded)
+
+    def decode_many(self, encoded_ids):
+        return self.record('decode_many', 'decode', 'decode_cache', None,
+                           self.cipher.decode_many, encoded_ids)
+
+    def record(self, operation, counter, cache_name, count, method, argument):
+        """
+        Call method with argument, timing it and counting its ids and cache lookups.
+
+        :param count: the number of ids, or None to count the items of the result
+        """
+        # The cache counters are shared by threads, so under concurrent use their changes are
+        # approximate.
+        cache = getattr(self.cipher, cache_name, None)
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+
+        started = default_timer()
+        try:
+            result = method(argument)
+        except ValueError:
+            if counter == 'decode':
+                instrumentation.increment('decode_failure')
+            raise
+        finally:
+            instrumentation.timing(operation, default_timer() - started)
+
+        instrumentation.increment(counter, len(result) if count is None else count)
+        if cache is not None and cache.hits != hits:
+            instrumentation.increment('cache_hit', cache.hits - hits)
+        if cache is not None and cache.misses != misses:
+            instrumentation.increment('cache_miss', cache.misses - misses)
+
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.cipher, name)
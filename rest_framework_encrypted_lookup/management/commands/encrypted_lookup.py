@@ -0,0 +1,321 @@
+"""
+Management command to encode or decode files of ids in bulk
+
+    manage.py encrypted_lookup encode ids.txt -o tokens.txt
+    manage.py encrypted_lookup decode export.csv --format csv --field id --workers 8
+
+The input is read a chunk at a time and the chunks are spread across a pool of
+worker processes, each with its own cipher, so that memory use does not grow
+with the size of the file. Output is written in input order.
+"""
+import collections
+import csv
+import json
+import multiprocessing
+import sys
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...registry import build_id_cipher, get_key_type, model_namespace, id_cipher, \
+    id_cipher_registry
+from ...settings import encrypted_lookup_settings
+
+
+# The cipher of a worker process, built by init_worker.
+worker_cipher = None  # pylint: disable=invalid-name
+
+
+def init_worker(user_settings, namespace, key_type):
+    """
+    Build the cipher of a worker process.
+
+    Workers which were not forked from the command do not inherit its settings.
+    """
+    global worker_cipher  # pylint: disable=global-statement,invalid-name
+
+    if not settings.configured:
+        settings.configure(ENCRYPTED_LOOKUP=user_settings)
+
+    worker_cipher = build_id_cipher(namespace, key_type)
+
+
+def convert(cipher, operation, values):
+    """
+    Encode or decode a chunk of values in one batch.
+
+    Empty values are passed through. Values which cannot be converted are
+    returned as None. UUIDs are read and written as text.
+
+    :param operation: 'encode' or 'decode'
+    :return: list of converted values
+    """
+    indexes = [index for index, value in enumerate(values) if value]
+    results = list(values)
+
+    try:
+        if operation == 'encode':
+            converted = cipher.encode_many([parse_id(cipher, values[index]) for index in indexes])
+        else:
+            converted = cipher.decode_many([values[index] for index in indexes])
+    except (TypeError, ValueError):
+        # Convert the values one at a time, so that only the bad ones are lost.
+        converted = [convert_one(cipher, operation, values[index]) for index in indexes]
+
+    for index, value in zip(indexes, converted):
+        results[index] = str(value) if isinstance(value, uuid.UUID) else value
+
+    return results
+
+
+def convert_one(cipher, operation, value):
+    try:
+        if operation == 'encode':
+            return cipher.encode(parse_id(cipher, value))
+        return cipher.decode(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_id(cipher, value):
+    # Ciphers of other key types parse text themselves.
+    return int(value) if getattr(cipher, 'key_type', 'int') == 'int' else value
+
+
+def convert_in_worker(operation, values):
+    return convert(worker_cipher, operation, values)
+
+
+class LinesFormat(object):
+    """
+    One value per line.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    @staticmethod
+    def read(lines):
+        for line in lines:
+            yield line.rstrip('\r\n')
+
+    @staticmethod
+    def get_value(row):
+        return row
+
+    @staticmethod
+    def set_value(row, value):  # pylint: disable=unused-argument
+        return value
+
+    def write(self, output, rows):
+        if rows:
+            output.write(''.join('%s\n' % row for row in rows))
+
+
+class CSVFormat(LinesFormat):
+    """
+    CSV with a header row; the named column is converted.
+    """
+
+    def __init__(self, field):
+        super(CSVFormat, self).__init__(field)
+        self.column = None
+        self.header = None
+
+    def read(self, lines):
+        reader = csv.reader(lines)
+        self.header = next(reader, None)
+        if self.header is None:
+            return
+
+        try:
+            self.column = self.header.index(self.field)
+        except ValueError:
+            raise CommandError("The CSV input has no '%s' column." % self.field)
+
+        for row in reader:
+            yield row
+
+    def get_value(self, row):
+        return row[self.column] if len(row) > self.column else ''
+
+    def set_value(self, row, value):
+        if len(row) > self.column:
+            row[self.column] = value
+        return row
+
+    def write(self, output, rows):
+        writer = csv.writer(output, lineterminator='\n')
+        if self.header is not None:
+            writer.writerow(self.header)
+            self.header = None
+        writer.writerows(rows)
+
+
+class JSONLinesFormat(LinesFormat):
+    """
+    JSON Lines of objects; the named key is converted.
+    """
+
+    @staticmethod
+    def read(lines):
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    def get_value(self, row):
+        value = row.get(self.field)
+        return '' if value is None else str(value)
+
+    def set_value(self, row, value):
+        if self.field in row and row[self.field] is not None:
+            row[self.field] = value
+        return row
+
+    def write(self, output, rows):
+        if rows:
+            output.write(''.join(json.dumps(row) + '\n' for row in rows))
+
+
+FORMATS = {
+    'lines': LinesFormat,
+    'csv': CSVFormat,
+    'jsonl': JSONLinesFormat,
+}
+
+
+def iter_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ("Encode a file of ids as encrypted lookups, or decode a file of encrypted lookups "
+            "as ids.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('operation', choices=('encode', 'decode'))
+        parser.add_argument('input', nargs='?', default='-',
+                            help="Input file, or - for standard input.")
+        parser.add_argument('-o', '--output', default='-',
+                            help="Output file, or - for standard output.")
+        parser.add_argument('--format', choices=sorted(FORMATS), default='lines',
+                            help="Input and output format; defaults to one value per line.")
+        parser.add_argument('--field', default='id',
+                            help="CSV column or JSON key to convert; defaults to id.")
+        parser.add_argument('--model', help="Model whose cipher to use, as app_label.ModelName, "
+                                            "when the model_namespaces setting is enabled.")
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                            help="Worker processes; 1 converts in this process. "
+                                 "Defaults to the CPU count.")
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Values per worker task.")
+
+    def handle(self, *args, **options):
+        operation = options['operation']
+        file_format = FORMATS[options['format']](options['field'])
+        workers = max(1, options['workers'])
+        chunk_size = max(1, options['chunk_size'])
+        model = self.get_model(options['model'])
+
+        input_file = sys.stdin if options['input'] == '-' else open(options['input'], 'r')
+        output = self.stdout if options['output'] == '-' else open(options['output'], 'w')
+
+        started = time.time()
+        try:
+            total, invalid = self.convert_file(operation, file_format, input_file, output, model,
+                                               workers, chunk_size)
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+            if output is not self.stdout:
+                output.close()
+        elapsed = time.time() - started
+
+        self.stderr.write("%sd %d values in %.2fs (%d values/s) with %d worker%s." % (
+            operation.capitalize(), total, elapsed, total / elapsed if elapsed else 0,
+            workers, '' if workers == 1 else 's'))
+        if invalid:
+            self.stderr.write("%d values could not be %sd, and were written empty." %
+                              (invalid, operation))
+
+    @staticmethod
+    def get_model(label):
+        """
+        :return: the model labelled app_label.ModelName, or None for id_cipher's lookups
+        """
+        if label is None:
+            return None
+
+        try:
+            return apps.get_model(label)
+        except (LookupError, ValueError):
+            raise CommandError("Unknown model: '%s'" % label)
+
+    def convert_file(self, operation, file_format, input_file, output, model, workers, chunk_size):
+        """
+        Convert the input chunk by chunk.
+
+        :return: the number of values read, and the number which could not be converted
+        """
+        counts = [0, 0]
+
+        def write(chunk, values):
+            counts[0] += len(values)
+            counts[1] += values.count(None)
+            file_format.write(output, [
+                file_format.set_value(row, '' if value is None else value)
+                for row, value in zip(chunk, values)
+            ])
+
+        chunks = iter_chunks(file_format.read(input_file), chunk_size)
+
+        if workers == 1:
+            cipher = id_cipher_registry.get_for_model(model) if model is not None else id_cipher
+            for chunk in chunks:
+                values = [file_format.get_value(row) for row in chunk]
+                write(chunk, convert(cipher, operation, values))
+        else:
+            namespace = None
+            if model is not None and encrypted_lookup_settings['model_namespaces']:
+                namespace = model_namespace(model)
+            self.convert_chunks_in_pool(operation, file_format, chunks, write, namespace,
+                                        get_key_type(model), workers)
+
+        # Write the header of an input without rows.
+        write([], [])
+
+        return counts
+
+    @staticmethod
+    def convert_chunks_in_pool(operation, file_format, chunks, write, namespace, key_type, workers):
+        """
+        Convert chunks in worker processes, keeping at most two chunks per worker in flight.
+        """
+        pool = multiprocessing.Pool(workers, init_worker,
+                                    (dict(encrypted_lookup_settings.items()), namespace, key_type))
+        try:
+            pending = collections.deque()
+            for chunk in chunks:
+                values = [file_format.get_value(row) for row in chunk]
+                pending.append((chunk, pool.apply_async(convert_in_worker, (operation, values))))
+                if len(pending) >= 2 * workers:
+                    chunk, result = pending.popleft()
+                    write(chunk, result.get())
+
+            while pending:
+                chunk, result = pending.popleft()
+                write(chunk, result.get())
+
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
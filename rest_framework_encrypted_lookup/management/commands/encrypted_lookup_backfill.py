@@ -0,0 +1,86 @@
+"""
+Management command to fill the EncryptedLookupTokenField of a model's rows
+
+    manage.py encrypted_lookup_backfill app_label.ModelName
+    manage.py encrypted_lookup_backfill app_label.ModelName --all
+
+Rows are read in batches of pks; each batch's tokens are encrypted in one
+encode_many call and written with a single UPDATE. By default only rows
+without a token are filled. --all recomputes every token, as is needed after
+the ENCRYPTED_LOOKUP settings, such as the secret key, change.
+"""
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import Case, CharField, Value, When
+
+from ...models import get_token_field
+from ...registry import id_cipher_registry
+
+
+class Command(BaseCommand):
+    help = "Store the encrypted lookups of a model's rows in its EncryptedLookupTokenField."
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="Model whose tokens to store, as app_label.ModelName.")
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help="Recompute every token, rather than only the missing ones.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows per update.")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError):
+            raise CommandError("Unknown model: '%s'" % options['model'])
+
+        token_field = get_token_field(model)
+        if token_field is None:
+            raise CommandError("%s has no EncryptedLookupTokenField." % options['model'])
+
+        started = time.time()
+        total = self.backfill(model, token_field, options['all'], max(1, options['batch_size']))
+        elapsed = time.time() - started
+
+        self.stdout.write("Stored %d tokens of %s in %.2fs." % (total, options['model'], elapsed))
+
+    @staticmethod
+    def backfill(model, token_field, recompute, batch_size):
+        """
+        Store the tokens of the model's rows, a batch at a time, in order of pk.
+
+        :param recompute: whether to store the tokens of rows which already have one
+        :return: the number of tokens stored
+        """
+        cipher = id_cipher_registry.get_for_model(model)
+        manager = model._base_manager  # pylint: disable=protected-access
+        connection = connections[router.db_for_write(model)]
+
+        queryset = manager.order_by('pk')
+        if not recompute:
+            queryset = queryset.filter(**{token_field.attname + '__isnull': True})
+
+        # Each row of a batch takes three query parameters, which some databases limit.
+        pk_field = model._meta.pk  # pylint: disable=protected-access
+        batch_size = max(1, min(batch_size, connection.ops.bulk_batch_size(
+            [pk_field, pk_field, token_field], range(batch_size))))
+
+        total = 0
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return total
+
+            tokens = Case(
+                *[When(pk=pk, then=Value(token))
+                  for pk, token in zip(pks, cipher.encode_many(pks))],
+                output_field=CharField()
+            )
+            with transaction.atomic(using=connection.alias):
+                manager.filter(pk__in=pks).update(**{token_field.attname: tokens})
+
+            total += len(pks)
+            last_pk = pks[-1]
@@ -0,0 +1,149 @@
+"""
+Stored encrypted lookups for rest_framework_encrypted_lookup
+
+A model with an EncryptedLookupTokenField keeps each row's encrypted lookup in
+an indexed column, so that the package's fields can present it, and its views
+find the row by it, without encrypting or decrypting anything per request.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.signals import post_save
+import six
+
+from .registry import id_cipher_registry
+
+
+class EncryptedLookupTokenField(models.CharField):
+    """
+    Unique, indexed column holding the encrypted lookup of its row's pk.
+
+    The token is set whenever a row with a pk is saved; a row whose pk is
+    assigned by the database gets its token with one extra update after it
+    is created. Rows saved before the field was added, or before the
+    ENCRYPTED_LOOKUP settings changed, are filled by the
+    encrypted_lookup_backfill management command.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('unique', True)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        super(EncryptedLookupTokenField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):  # pylint: disable=arguments-differ
+        super(EncryptedLookupTokenField, self).contribute_to_class(cls, name, *args, **kwargs)
+
+        if not cls._meta.abstract:  # pylint: disable=protected-access
+            post_save.connect(self.set_created_token, sender=cls, weak=False)
+
+    def get_token(self, model_instance):
+        return id_cipher_registry.get_for_model(model_instance.__class__).encode(model_instance.pk)
+
+    def pre_save(self, model_instance, add):
+        if model_instance.pk is not None:
+            setattr(model_instance, self.attname, self.get_token(model_instance))
+
+        return super(EncryptedLookupTokenField, self).pre_save(model_instance, add)
+
+    # pylint: disable=unused-argument
+    def set_created_token(self, sender, instance, created, raw=False, **kwargs):
+        if not created or raw or getattr(instance, self.attname) is not None:
+            return
+
+        token = self.get_token(instance)
+        manager = sender._base_manager  # pylint: disable=protected-access
+        manager.filter(pk=instance.pk).update(**{self.attname: token})
+        setattr(instance, self.attname, token)
+
+
+class StoredToken(six.text_type):
+    """
+    A token read from its column, which fields present as is.
+    """
+
+
+# The token field of each model, or None, by model.
+token_fields = {}  # pylint: disable=invalid-name
+
+
+def get_token_field(model):
+    """
+    :return: the EncryptedLookupTokenField of model, or None
+    """
+    try:
+        return token_fields[model]
+    except KeyError:
+        pass
+
+    token_field = None
+    meta = getattr(model, '_meta', None)
+    if meta is not None:
+        for field in meta.fields:
+            if isinstance(field, EncryptedLookupTokenField):
+                token_field = field
+                break
+
+    return token_fields.setdefault(model, token_field)
+
+
+def get_stored_token(obj):
+    """
+    :return: the token stored on a model instance, or None if it has none
+    """
+    token_field = get_token_field(obj.__class__)
+    if token_field is None:
+        return None
+
+    token = obj.__dict__.get(token_field.attname)
+    return None if token is None else StoredToken(token)
+
+
+# The foreign key of each model and field name, or None if it is not a foreign key to a
+# model with a token field.
+token_relations = {}  # pylint: disable=invalid-name
+
+
+def get_token_relation(model, name):
+    """
+    :return: the foreign key field name of model, if its related model has a token field,
+        or else None
+    """
+    try:
+        return token_relations[(model, name)]
+    except KeyError:
+        pass
+
+    field = None
+    meta = getattr(model, '_meta', None)
+    if meta is not None:
+        try:
+            field = meta.get_field(name)
+        except FieldDoesNotExist:
+            pass
+
+    if field is not None and not (field.concrete and (field.many_to_one or field.one_to_one) and
+                                  get_token_field(field.related_model) is not None):
+        field = None
+
+    return token_relations.setdefault((model, name), field)
+
+
+def get_loaded_related_object(instance, name):
+    """
+    :return: the object related to instance by its foreign key name, if that
+        object has a token field and was already loaded, as by select_related;
+        or else None
+    """
+    field = get_token_relation(instance.__class__, name)
+    if field is None:
+        return None
+
+    is_cached = getattr(field, 'is_cached', None)
+    if is_cached is not None:  # Django >= 2.0
+        loaded = is_cached(instance)
+    else:
+        loaded = hasattr(instance, field.get_cache_name())
+
+    return getattr(instance, name) if loaded else None
@@ -0,0 +1,301 @@
+"""
+Cipher registry for rest_framework_encrypted_lookup
+
+Builds the ciphers configured by ENCRYPTED_LOOKUP settings, including the
+multi-key ciphers of key rotation, and holds them by namespace and key type
+until the settings change.
+"""
+import hashlib
+import hmac
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.test.signals import setting_changed
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+import six
+
+from .exceptions import InvalidTokenError
+from .instrumentation import InstrumentedIDCipher
+from .settings import encrypted_lookup_settings
+
+
+class MultiKeyIDCipher(object):
+    """
+    Cipher over a set of keys, each identified by a short key id, for key rotation.
+
+    Tokens are encoded with the current key and tagged with its key id, as
+    "<key id>~<token>". Decoding selects the cipher for a token's key id from a
+    dictionary, so accepting old keys costs no trial decryption. Untagged tokens
+    belong to the key id '', which is how tokens issued before rotation stay valid.
+
+    Decodes with any key other than the current one are counted, so that the
+    usage of old keys can be watched until they may be retired.
+    """
+
+    KEY_ID_SEPARATOR = '~'
+
+    def __init__(self, ciphers, key_id):
+        """
+        :param ciphers: dictionary of ciphers by key id, including the current key id
+        :param key_id: the key id to encode with
+        """
+        for this_key_id in ciphers:
+            if self.KEY_ID_SEPARATOR in this_key_id:
+                raise ValueError("Key ids may not contain '%s': '%s'" %
+                                 (self.KEY_ID_SEPARATOR, this_key_id))
+
+        if key_id not in ciphers:
+            raise ValueError("No cipher for the current key id: '%s'" % key_id)
+
+        self.ciphers = dict(ciphers)
+        self.key_id = key_id
+        self.cipher = self.ciphers[key_id]
+        self.prefix = key_id + self.KEY_ID_SEPARATOR if key_id else ''
+
+        self.lock = threading.Lock()
+        self.legacy_usage = dict(
+            (this_key_id, {'decodes': 0, 'last_used': None})
+            for this_key_id in self.ciphers if this_key_id != key_id
+        )
+
+    def _split(self, encoded):
+        if not isinstance(encoded, six.string_types):
+            raise InvalidTokenError("Tokens must be strings, not %s." % type(encoded).__name__)
+
+        key_id, _, token = encoded.rpartition(self.KEY_ID_SEPARATOR)
+        try:
+            return key_id, self.ciphers[key_id], token
+        except KeyError:
+            raise InvalidTokenError("Unrecognized key id: '%s'" % key_id)
+
+    def _count(self, key_id, decodes):
+        if key_id == self.key_id:
+            return
+
+        with self.lock:
+            usage = self.legacy_usage[key_id]
+            usage['decodes'] += decodes
+            usage['last_used'] = time.time()
+
+    def get_key_usage(self):
+        """
+        :return: for each key id other than the current one, its decode count and last decode time
+        """
+        with self.lock:
+            return dict((key_id, dict(usage)) for key_id, usage in self.legacy_usage.items())
+
+    def get_token_pattern(self):
+        patterns = []
+        for key_id, cipher in sorted(self.ciphers.items()):
+            pattern = cipher.get_token_pattern()
+            if key_id:
+                pattern = '%s(?:%s)' % (re.escape(key_id + self.KEY_ID_SEPARATOR), pattern)
+            patterns.append(pattern)
+
+        return '|'.join(patterns)
+
+    def encode(self, this_id):
+        return self.prefix + self.cipher.encode(this_id)
+
+    def decode(self, encoded):
+        key_id, cipher, token = self._split(encoded)
+        this_id = cipher.decode(token)
+        self._count(key_id, 1)
+        return this_id
+
+    def encode_many(self, ids):
+        prefix = self.prefix
+        return [prefix + token for token in self.cipher.encode_many(ids)]
+
+    def decode_many(self, encoded):
+        encoded = list(encoded)
+
+        groups = OrderedDict()
+        for index, this_encoded in enumerate(encoded):
+            key_id, cipher, token = self._split(this_encoded)
+            groups.setdefault(key_id, (cipher, [], []))
+            groups[key_id][1].append(index)
+            groups[key_id][2].append(token)
+
+        ids = [None] * len(encoded)
+        for key_id, (cipher, indexes, tokens) in groups.items():
+            for index, this_id in zip(indexes, cipher.decode_many(tokens)):
+                ids[index] = this_id
+            self._count(key_id, len(tokens))
+
+        return ids
+
+    def __getattr__(self, name):
+        return getattr(self.cipher, name)
+
+
+def model_namespace(model):
+    """
+    :return: the cipher namespace of a model class, "<app label>.<model name>"
+    """
+    meta = model._meta  # pylint: disable=protected-access
+    return '%s.%s' % (meta.app_label, meta.object_name)
+
+
+def derive_secret(secret, namespace):
+    """
+    Derive the secret of a namespace from a master secret.
+    """
+    if namespace is None:
+        return secret
+
+    key, message = bytearray(secret, 'utf-8'), bytearray(namespace, 'utf-8')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+# The key type of each model, by model.
+key_types = {}  # pylint: disable=invalid-name
+
+
+def get_key_type(model):
+    """
+    :return: the key type of a model's pk: 'uuid' for a UUIDField, or else 'int'
+    """
+    try:
+        return key_types[model]
+    except KeyError:
+        pass
+
+    key_type = 'int'
+    if model is not None:
+        pk_field = model._meta.pk  # pylint: disable=protected-access
+        while pk_field.is_relation:
+            # A pk which is a relation, such as a multi-table parent link, has the type of its
+            # target.
+            pk_field = pk_field.related_model._meta.pk  # pylint: disable=protected-access
+
+        if pk_field.get_internal_type() == 'UUIDField':
+            key_type = 'uuid'
+
+    return key_types.setdefault(model, key_type)
+
+
+def build_id_cipher(namespace=None, key_type='int'):
+    """
+    Build the cipher configured by ENCRYPTED_LOOKUP settings.
+
+    With a key id or legacy secret keys configured, this is a MultiKeyIDCipher
+    over one instance of the cipher class per key.
+
+    With instrumentation sinks configured, the cipher is wrapped in an
+    InstrumentedIDCipher.
+
+    :param namespace: if given, every key is derived from the configured secret and this namespace
+    :param key_type: the key type of the ids to encode, 'int' or 'uuid'
+    """
+    cipher_class = import_string(encrypted_lookup_settings['cipher_class'])
+    secret = derive_secret(encrypted_lookup_settings['secret_key'], namespace)
+    key_id = encrypted_lookup_settings['key_id']
+    legacy_secret_keys = encrypted_lookup_settings['legacy_secret_keys']
+
+    # Cipher classes written before key types need not accept the argument for integer keys.
+    kwargs = {} if key_type == 'int' else {'key_type': key_type}
+
+    if not key_id and not legacy_secret_keys:
+        cipher = cipher_class(**kwargs) if namespace is None else \
+            cipher_class(secret=secret, **kwargs)
+    else:
+        ciphers = dict(
+            (legacy_key_id, cipher_class(secret=derive_secret(legacy_secret, namespace), **kwargs))
+            for legacy_key_id, legacy_secret in legacy_secret_keys.items()
+        )
+        ciphers[key_id] = cipher_class(secret=secret, **kwargs)
+        cipher = MultiKeyIDCipher(ciphers, key_id)
+
+    if encrypted_lookup_settings['instrumentation_sinks']:
+        return InstrumentedIDCipher(cipher)
+
+    return cipher
+
+
+class IDCipherRegistry(object):
+    """
+    Registry of ciphers by namespace and key type.
+
+    Each namespace's cipher is built once, on first use, and reused until the
+    ENCRYPTED_LOOKUP setting changes, so requests derive no keys. With the
+    'model_namespaces' setting enabled, every model has its own namespace, so
+    that a token for one model does not decode as a token for another.
+
+    A model's cipher is of the key type of its pk, so that UUID pks are encoded
+    as UUIDs, each in a single block.
+    """
+
+    def __init__(self):
+        self.ciphers = {}
+        self.model_ciphers = {}
+
+    def get(self, namespace, key_type='int'):
+        try:
+            return self.ciphers[(namespace, key_type)]
+        except KeyError:
+            # Threads racing to first use may each build a cipher, but all keep the first stored.
+            cipher = build_id_cipher(namespace, key_type)
+            return self.ciphers.setdefault((namespace, key_type), cipher)
+
+    def get_for_model(self, model):
+        """
+        :return: the cipher of the model's namespace and key type, which is
+            id_cipher for integer keys if model namespaces are disabled
+        """
+        try:
+            return self.model_ciphers[model]
+        except KeyError:
+            pass
+
+        key_type = get_key_type(model)
+        if model is not None and encrypted_lookup_settings['model_namespaces']:
+            cipher = self.get(model_namespace(model), key_type)
+        elif key_type == 'int':
+            cipher = id_cipher
+        else:
+            cipher = self.get(None, key_type)
+
+        return self.model_ciphers.setdefault(model, cipher)
+
+    def clear(self):
+        self.ciphers = {}
+        self.model_ciphers = {}
+
+
+class LazyIDCipher(LazyObject):
+    """
+    Proxy for the cipher configured by ENCRYPTED_LOOKUP settings.
+
+    The cipher is built on first use, so that importing this module derives no keys,
+    and is built again after the ENCRYPTED_LOOKUP setting changes.
+    """
+
+    # Threads racing to first use all get the same cipher, and so the same caches.
+    setup_lock = threading.Lock()
+
+    def _setup(self):
+        with self.setup_lock:
+            if self._wrapped is empty:
+                self._wrapped = build_id_cipher()
+
+    def reset(self):
+        self._wrapped = empty
+
+
+# TODO: Refactor name to ID_CIPHER on next major version upgrade
+id_cipher = LazyIDCipher()  # pylint: disable=invalid-name
+
+id_cipher_registry = IDCipherRegistry()  # pylint: disable=invalid-name
+
+
+def reset_id_cipher(**kwargs):
+    if kwargs['setting'] == 'ENCRYPTED_LOOKUP':
+        id_cipher.reset()
+        id_cipher_registry.clear()
+
+
+setting_changed.connect(reset_id_cipher)
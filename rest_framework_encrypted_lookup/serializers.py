@@ -1,18 +1,261 @@
 """
 Django-Rest-Framework replacement Serializers for rest_framework_encrypted_lookup
 """
+import copy
+import itertools
+from collections import OrderedDict
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
+from django.test.signals import setting_changed
+from django.utils.functional import Promise
+import six
+
 from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.serializers import LIST_SERIALIZER_KWARGS
 
 from .fields import EncryptedLookupRelatedField, EncryptedLookupField, \
-    EncryptedLookupHyperlinkedRelatedField
-from .settings import encrypted_lookup_settings
-from .utils import id_cipher
+    EncryptedLookupHyperlinkedRelatedField, EncryptedLookupManyRelatedField
+from .models import StoredToken
+from .registry import id_cipher_registry
+from .settings import SettingDescriptor
+from .utils import PrecomputedIDCipher
+
+
+# The fields built for each encrypted-lookup serializer class, with the Meta options they
+# were built from.
+field_layouts = {}  # pylint: disable=invalid-name
+
+
+def clear_field_layouts(**kwargs):
+    if kwargs['setting'] == 'ENCRYPTED_LOOKUP':
+        field_layouts.clear()
+
+
+setting_changed.connect(clear_field_layouts)
+
+
+def get_meta_options(meta):
+    """
+    :return: a snapshot of the options of a serializer's Meta, which compares equal until
+        they change
+    """
+    def snapshot(value):
+        # Copy containers, which may be changed in place; compare anything else by identity or
+        # equality.
+        if isinstance(value, dict):
+            return dict((key, snapshot(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return (type(value), [snapshot(item) for item in value])
+        return value
+
+    names = [name for name in dir(meta) if not name.startswith('_')]
+    return dict((name, snapshot(getattr(meta, name))) for name in names)
+
+
+# Field arguments which copies of a field may share: immutable values, and querysets and
+# managers, which rest_framework's related fields only ever read through .all().
+SHARED_FIELD_ARGUMENT_TYPES = six.string_types + six.integer_types + (
+    float, type(None), Promise, models.query.QuerySet, models.Manager,
+)
+
+
+def get_loaded_items(value):
+    """
+    :return: the related objects of a many-related field's value, if they
+        were already loaded, as by prefetch_related; or else an empty list
+    """
+    if isinstance(value, models.query.QuerySet):
+        # An unevaluated queryset would be queried again when it is represented.
+        return value._result_cache or []  # pylint: disable=protected-access
+
+    return value
+
+
+def copy_field(field):
+    """
+    Copy an unbound field, as rest_framework copies declared fields: by
+    instantiating it again with the arguments it was created with.
+
+    Unlike rest_framework, arguments which may be shared are not deep-copied,
+    while validators, which may hold the state of a validation, are copied.
+    """
+    kwargs = {}
+    for key, value in field._kwargs.items():  # pylint: disable=protected-access
+        if key == 'validators':
+            value = [copy.copy(validator) for validator in value]
+        elif not isinstance(value, SHARED_FIELD_ARGUMENT_TYPES):
+            value = copy.deepcopy(value)
+        kwargs[key] = value
+
+    args = copy.deepcopy(field._args)  # pylint: disable=protected-access
+    return field.__class__(*args, **kwargs)
+
+
+class EncryptedLookupListSerializer(serializers.ListSerializer):
+    """
+    ListSerializer used by encrypted-lookup serializers with many=True.
+
+    Before any item is represented, the lookups presented by the child's
+    encrypted-lookup fields are gathered across every item and encrypted in
+    one batch.
+    """
+
+    batch_field_classes = (
+        EncryptedLookupField,
+        EncryptedLookupRelatedField,
+        EncryptedLookupHyperlinkedRelatedField,
+        EncryptedLookupManyRelatedField,
+    )
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        items = list(iterable)
+
+        self.child.batch_ciphers = self.get_batch_ciphers(items)
+        try:
+            return super(EncryptedLookupListSerializer, self).to_representation(items)
+        finally:
+            self.child.batch_ciphers = None
+
+    def iter_representation(self, data, chunk_size):
+        """
+        Represent items one chunk at a time, without holding them all in memory.
+
+        Each chunk's lookups are encrypted in one batch. A queryset is read
+        with iterator(), so that it caches no rows; its prefetch_related
+        lookups are therefore not applied.
+
+        :param data: the object instances to be represented
+        :param chunk_size: the number of items to represent at a time
+        :return: iterator of item representations
+        """
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        if isinstance(iterable, models.query.QuerySet):
+            iterator = iterable.iterator()
+        else:
+            iterator = iter(iterable)
+
+        try:
+            while True:
+                items = list(itertools.islice(iterator, chunk_size))
+                if not items:
+                    return
+
+                self.child.batch_ciphers = self.get_batch_ciphers(items)
+                for item in items:
+                    yield self.child.to_representation(item)
+        finally:
+            self.child.batch_ciphers = None
+
+    def get_batch_ciphers(self, items):
+        """
+        Encrypt the lookups which the child's encrypted-lookup fields will present.
+
+        Fields which share a cipher share one batch.
+
+        :param items: the object instances to be represented
+        :return: dictionary of PrecomputedIDCipher by field name
+        """
+        groups = {}
+        for field in self.child.fields.values():
+            if isinstance(field, self.batch_field_classes) and not field.write_only:
+                cipher = field.get_lookup_cipher()
+                groups.setdefault(id(cipher), (cipher, []))[1].append(field)
+
+        batch_ciphers = {}
+        for cipher, fields in groups.values():
+            batch_cipher = PrecomputedIDCipher(cipher, self.get_lookup_ids(items, fields))
+            for field in fields:
+                batch_ciphers[field.field_name] = batch_cipher
+
+        return batch_ciphers
+
+    @staticmethod
+    def get_lookup_ids(items, fields):
+        """
+        Gather the ids which the given encrypted-lookup fields will encode.
+
+        Values which cannot be read are skipped here, and left to fail during
+        representation as they otherwise would. So are values which will be
+        presented by their stored tokens. The related objects of many-related
+        fields are gathered only if they were prefetched; otherwise each row
+        queries its own, and they are encrypted as they are represented.
+
+        :param items: the object instances to be represented
+        :param fields: the child's encrypted-lookup fields
+        :return: list of ids
+        """
+        ids = []
+        for item in items:
+            for field in fields:
+                try:
+                    value = field.get_attribute(item)
+                except (AttributeError, KeyError, ObjectDoesNotExist, SkipField):
+                    continue
+
+                if isinstance(field, EncryptedLookupManyRelatedField):
+                    field, values = field.child_relation, get_loaded_items(value)
+                else:
+                    values = [value]
+
+                for value in values:
+                    if isinstance(value, StoredToken):
+                        continue
+
+                    if not isinstance(field, EncryptedLookupField):
+                        if field.get_stored_token(value) is not None:
+                            continue
+                        value = getattr(value, 'pk', None)
+
+                    if value is not None:
+                        ids.append(value)
+
+        return ids
 
 
 class EncryptedLookupSerializerMixin(object):
-    lookup_field = encrypted_lookup_settings["lookup_field_name"]
+    lookup_field = SettingDescriptor("lookup_field_name")
+
+    # Set by EncryptedLookupListSerializer while it represents a batch of items.
+    batch_ciphers = None
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        child_serializer = cls(*args, **kwargs)
+        list_kwargs = {'child': child_serializer}
+        list_kwargs.update(dict([
+            (key, value) for key, value in kwargs.items()
+            if key in LIST_SERIALIZER_KWARGS
+        ]))
+        meta = getattr(cls, 'Meta', None)
+        list_serializer_class = getattr(meta, 'list_serializer_class',
+                                        EncryptedLookupListSerializer)
+        return list_serializer_class(*args, **list_kwargs)
+
+    # Whether the fields of each serializer class are built once, and copied for each instance.
+    # Enable this only for a serializer whose fields do not depend on its instance, such as on
+    # its context.
+    cache_fields = False
 
     def get_fields(self):
+        if not self.cache_fields:
+            return self.build_fields()
+
+        serializer_class = self.__class__
+        options = get_meta_options(getattr(serializer_class, 'Meta', None))
+
+        layout = field_layouts.get(serializer_class)
+        if layout is None or layout[0] != options:
+            layout = field_layouts[serializer_class] = (options, self.build_fields())
+
+        return OrderedDict((name, copy_field(field)) for name, field in layout[1].items())
+
+    def build_fields(self):
+        """
+        Build the fields of ModelSerializer, with an encrypted lookup field.
+        """
         ret = serializers.ModelSerializer.get_fields(self)
 
         if self.lookup_field in ret:
@@ -20,9 +263,17 @@ class EncryptedLookupSerializerMixin(object):
 
         return ret
 
-    @staticmethod
-    def get_cipher():
-        return id_cipher
+    @classmethod
+    def get_model_cipher(cls):
+        """
+        :return: the cipher of this serializer's model, which is id_cipher unless model
+            namespaces are enabled
+        """
+        model = getattr(getattr(cls, 'Meta', None), 'model', None)
+        return id_cipher_registry.get_for_model(model)
+
+    def get_cipher(self):
+        return self.get_model_cipher()
 
 
 class EncryptedLookupModelSerializer(EncryptedLookupSerializerMixin,
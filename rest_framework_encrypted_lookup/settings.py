@@ -1,33 +1,119 @@
 """
 Settings for rest_framework_encrypted_lookup
+
+The ENCRYPTED_LOOKUP dictionary is read and validated on first access rather than
+at import time, and is re-read whenever Django's setting_changed signal reports a
+change to it (for example under override_settings).
 """
 
 from django.conf import settings
+from django.test.signals import setting_changed
 
 EXTRA_REQUIRED_SETTINGS = ('secret_key',)
 
 # TODO: Refactor name to DEFAULT_ENCRYPTED_LOOKUP_SETTINGS on next major version upgrade
 default_encrypted_lookup_settings = {  # pylint: disable=invalid-name
     'lookup_field_name': 'pk',
+    'cache_size': 0,
+    'rejected_cache_size': 0,
+    'id_format': 'decimal',
+    'alphabet': 'base32',
+    'cipher_class': 'rest_framework_encrypted_lookup.utils.IDCipher',
+    'key_id': '',
+    'legacy_secret_keys': {},
+    'model_namespaces': False,
+    'instrumentation_sinks': (),
 }
 
-try:
-    encrypted_lookup_settings = getattr(settings, 'ENCRYPTED_LOOKUP')  # pylint: disable=invalid-name
-except AttributeError:
-    raise AttributeError(
-        "Django.conf.settings must include an ENCRYPTED_LOOKUP settings dictionary."
-    )
-else:
-    for required_key in EXTRA_REQUIRED_SETTINGS:
-        if required_key not in encrypted_lookup_settings:
+
+class EncryptedLookupSettings(object):
+    """
+    A read-only, dictionary-like view of the validated ENCRYPTED_LOOKUP settings.
+
+    Nothing is read from django.conf.settings until the first lookup, so importing this
+    package does not require Django to be configured yet.
+    """
+
+    def __init__(self):
+        self._settings = None
+
+    @staticmethod
+    def load():
+        try:
+            user_settings = getattr(settings, 'ENCRYPTED_LOOKUP')
+        except AttributeError:
             raise AttributeError(
-                "ENCRYPTED_LOOKUP settings dictionary must include a '%s' key." % required_key
+                "Django.conf.settings must include an ENCRYPTED_LOOKUP settings dictionary."
             )
 
-    for key in encrypted_lookup_settings:
-        if key not in default_encrypted_lookup_settings and key not in EXTRA_REQUIRED_SETTINGS:
-            raise AttributeError("Unrecognized ENCRYPTED_LOOKUP setting key: '%s'" % key)
+        for required_key in EXTRA_REQUIRED_SETTINGS:
+            if required_key not in user_settings:
+                raise AttributeError(
+                    "ENCRYPTED_LOOKUP settings dictionary must include a '%s' key." % required_key
+                )
+
+        for key in user_settings:
+            if key not in default_encrypted_lookup_settings and key not in EXTRA_REQUIRED_SETTINGS:
+                raise AttributeError("Unrecognized ENCRYPTED_LOOKUP setting key: '%s'" % key)
+
+        loaded = dict(default_encrypted_lookup_settings)
+        loaded.update(user_settings)
+        return loaded
+
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = self.load()
+        return self._settings
+
+    def reload(self):
+        """
+        Discard the loaded settings; they are read again on the next lookup.
+        """
+        self._settings = None
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __contains__(self, key):
+        return key in self.settings
+
+    def __iter__(self):
+        return iter(self.settings)
+
+    def __len__(self):
+        return len(self.settings)
+
+    def get(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def keys(self):
+        return self.settings.keys()
+
+    def items(self):
+        return self.settings.items()
+
+
+class SettingDescriptor(object):
+    """
+    A class attribute that reads an ENCRYPTED_LOOKUP setting each time it is accessed.
+
+    Subclasses may still override the attribute with a plain value.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, instance, owner):
+        return encrypted_lookup_settings[self.key]
+
+
+encrypted_lookup_settings = EncryptedLookupSettings()  # pylint: disable=invalid-name
+
+
+def reload_encrypted_lookup_settings(**kwargs):
+    if kwargs['setting'] == 'ENCRYPTED_LOOKUP':
+        encrypted_lookup_settings.reload()
+
 
-    for key, value in default_encrypted_lookup_settings.items():
-        if key not in encrypted_lookup_settings:
-            encrypted_lookup_settings[key] = value
+setting_changed.connect(reload_encrypted_lookup_settings)
@@ -0,0 +1,72 @@
+"""
+Streaming serialization for rest_framework_encrypted_lookup
+
+Large exports are represented a chunk of items at a time, with each chunk's
+lookups encrypted in one batch, and rendered to the response as they are
+produced, so that memory use does not grow with the size of the result.
+"""
+import json
+
+from django.http import StreamingHttpResponse
+
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def encode_json(data, encoder_class=JSONEncoder):
+    """
+    Encode data as rest_framework's JSONRenderer would, without indentation.
+    """
+    separators = (',', ':') if api_settings.COMPACT_JSON else (', ', ': ')
+    return json.dumps(data, cls=encoder_class, ensure_ascii=not api_settings.UNICODE_JSON,
+                      separators=separators)
+
+
+def iter_json(representations, encoder_class=JSONEncoder):
+    """
+    :return: iterator of the text of a JSON array of representations
+    """
+    yield '['
+    separator = ''
+    for representation in representations:
+        yield separator + encode_json(representation, encoder_class)
+        separator = ','
+    yield ']'
+
+
+def iter_jsonl(representations, encoder_class=JSONEncoder):
+    """
+    :return: iterator of the lines of JSON Lines text, one line per representation
+    """
+    for representation in representations:
+        yield encode_json(representation, encoder_class) + '\n'
+
+
+STREAM_FORMATS = {
+    'json': (iter_json, 'application/json'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson'),
+}
+
+
+def stream_representation(serializer, data, stream_format='json', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream the representation of data through a StreamingHttpResponse.
+
+    :param serializer: an EncryptedLookupListSerializer, as built with many=True
+    :param data: the object instances to represent, such as a queryset
+    :param stream_format: 'json' for a JSON array, or 'jsonl' for JSON Lines
+    :param chunk_size: the number of items to represent, and whose lookups to encrypt, at a time
+    :return: StreamingHttpResponse
+    """
+    try:
+        iter_text, content_type = STREAM_FORMATS[stream_format]
+    except KeyError:
+        raise ValueError("Unrecognized stream format: '%s'" % stream_format)
+
+    return StreamingHttpResponse(
+        iter_text(serializer.iter_representation(data, chunk_size)),
+        content_type=content_type,
+    )
@@ -0,0 +1,688 @@
+"""
+Benchmarks for rest_framework_encrypted_lookup.
+
+Run through runbenchmarks.py, which configures Django settings first.
+
+The bench_suite_* benchmarks run against a SQLite database, compare each
+encrypted-lookup path with its plain rest_framework equivalent, and record
+their results, which runbenchmarks.py can save as JSON and compare with an
+earlier run.
+"""
+import json
+import multiprocessing
+import platform
+import os
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+from argparse import Namespace
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import django
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
+from django.core.management import call_command
+from django.test.utils import override_settings
+import six
+import rest_framework
+from rest_framework import mixins, serializers, viewsets
+from rest_framework.reverse import reverse
+from rest_framework.test import APIRequestFactory
+
+from rest_framework_encrypted_lookup.fields import EncryptedLookupField, \
+    EncryptedLookupHyperlinkedRelatedField
+from rest_framework_encrypted_lookup.instrumentation import MemorySink
+from rest_framework_encrypted_lookup.serializers import EncryptedLookupModelSerializer, \
+    EncryptedLookupListSerializer, EncryptedLookupHyperlinkedModelSerializer
+from rest_framework_encrypted_lookup.streaming import encode_json, iter_json
+from rest_framework_encrypted_lookup.utils import id_cipher, IDCipher, FeistelIDCipher, \
+    CryptographyIDCipher, Cipher
+from rest_framework_encrypted_lookup.views import EncryptedLookupGenericViewSet
+
+
+def best_of(function, number, repeat=3):
+    """
+    Return the best per-call time, in seconds, of calling function number times.
+    """
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def bench_cipher_batch(sizes=(10, 1000, 100000), cipher=id_cipher):
+    """
+    Compare scalar encode/decode against encode_many/decode_many.
+    """
+    results = []
+
+    for size in sizes:
+        ids = list(range(size))
+        encoded = cipher.encode_many(ids)
+        number = max(1, 10000 // size)
+
+        scalar_encode = best_of(lambda: [cipher.encode(i) for i in ids], number)
+        batch_encode = best_of(lambda: cipher.encode_many(ids), number)
+        scalar_decode = best_of(lambda: [cipher.decode(e) for e in encoded], number)
+        batch_decode = best_of(lambda: cipher.decode_many(encoded), number)
+
+        results.append(('encode', size, scalar_encode, batch_encode))
+        results.append(('decode', size, scalar_decode, batch_decode))
+
+    print('%-8s %8s %12s %12s %8s' % ('op', 'ids', 'scalar (s)', 'batch (s)', 'speedup'))
+    for operation, size, scalar, batch in results:
+        print('%-8s %8d %12.6f %12.6f %7.2fx' % (operation, size, scalar, batch, scalar / batch))
+
+    return results
+
+
+def bench_cipher_cache(size=10000, distinct=100):
+    """
+    Compare uncached and cached encode/decode over a stream of repeated ids.
+    """
+    ids = [i % distinct for i in range(size)]
+    encoded = id_cipher.encode_many(ids)
+    cached_cipher = IDCipher(cache_size=distinct)
+
+    uncached_encode = best_of(lambda: [id_cipher.encode(i) for i in ids], 1)
+    cached_encode = best_of(lambda: [cached_cipher.encode(i) for i in ids], 1)
+    uncached_decode = best_of(lambda: [id_cipher.decode(e) for e in encoded], 1)
+    cached_decode = best_of(lambda: [cached_cipher.decode(e) for e in encoded], 1)
+
+    print('%-8s %8s %12s %12s %8s' % ('op', 'ids', 'uncached (s)', 'cached (s)', 'speedup'))
+    print('%-8s %8d %12.6f %12.6f %7.2fx' % ('encode', size, uncached_encode, cached_encode,
+                                            uncached_encode / cached_encode))
+    print('%-8s %8d %12.6f %12.6f %7.2fx' % ('decode', size, uncached_decode, cached_decode,
+                                            uncached_decode / cached_decode))
+    print(cached_cipher.get_cache_stats())
+
+
+def bench_cipher_formats(size=10000):
+    """
+    Compare token length and encode/decode cost across id formats and alphabets.
+    """
+    ids = list(range(size))
+
+    print('%-8s %-8s %6s %12s %12s' % ('format', 'alphabet', 'chars', 'encode (s)', 'decode (s)'))
+    for id_format in IDCipher.ID_FORMATS:
+        for alphabet in ('base32', 'base64', 'base62'):
+            cipher = IDCipher(id_format=id_format, alphabet=alphabet)
+            encoded = cipher.encode_many(ids)
+
+            encode = best_of(lambda: [cipher.encode(i) for i in ids], 1)
+            decode = best_of(lambda: [cipher.decode(e) for e in encoded], 1)
+
+            print('%-8s %-8s %6d %12.6f %12.6f' %
+                  (id_format, alphabet, len(encoded[0]), encode, decode))
+
+
+def bench_invalid_tokens(number=10000):
+    """
+    Compare the cost of rejecting junk and hostile tokens against decoding a valid one.
+    """
+    cipher = IDCipher()
+    rejecting_cipher = IDCipher(rejected_cache_size=1000)
+    cases = (
+        ('valid', cipher, cipher.encode(1)),
+        ('wrong length', cipher, 'a' * 27),
+        ('wrong characters', cipher, '!' * 26),
+        ('wrong key', cipher, IDCipher(secret="other").encode(1)),
+        ('wrong key, cached', rejecting_cipher, IDCipher(secret="other").encode(1)),
+    )
+
+    def decode(this_cipher, token):
+        try:
+            this_cipher.decode(token)
+        except ValueError:
+            pass
+
+    print('%-20s %12s' % ('token', 'decode (s)'))
+    for name, this_cipher, token in cases:
+        print('%-20s %12.9f' % (name, best_of(lambda: decode(this_cipher, token), number)))
+
+
+def bench_cipher_threads(size=100000, thread_counts=(1, 2, 4, 8)):
+    """
+    Compare encode/decode throughput of one cipher shared by 1 to 8 threads.
+
+    Each thread uses its own cipher objects, so no lock is taken; throughput
+    scales with threads only as far as the backend releases the GIL.
+    """
+    backends = [('aes', IDCipher), ('feistel', FeistelIDCipher)]
+    if Cipher is not None:
+        backends.append(('openssl', CryptographyIDCipher))
+
+    def run(cipher, count, batch):
+        ids = list(range(size // count))
+
+        def work():
+            for start in range(0, len(ids), batch):
+                cipher.decode_many(cipher.encode_many(ids[start:start + batch]))
+
+        threads = [threading.Thread(target=work) for _ in range(count)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return 2 * count * len(ids) / (time.time() - started)
+
+    print('%-8s %6s %8s %14s' % ('cipher', 'batch', 'threads', 'ids/s'))
+    for name, cipher_class in backends:
+        cipher = cipher_class()
+        for batch in (1, 1000):
+            for count in thread_counts:
+                print('%-8s %6d %8d %14.0f' % (name, batch, count, run(cipher, count, batch)))
+
+
+class CipherBenchmarkSerializer(serializers.Serializer):  # pylint: disable=abstract-method
+    id = EncryptedLookupField()
+    related_id = EncryptedLookupField()
+
+    cipher = id_cipher
+
+    def get_cipher(self):
+        return self.cipher
+
+
+def bench_cipher_backends(size=10000):
+    """
+    Compare the cipher backends on encode, decode and serializer throughput.
+    """
+    backends = [('aes', IDCipher), ('feistel', FeistelIDCipher)]
+    if Cipher is not None:
+        backends.append(('openssl', CryptographyIDCipher))
+
+    ids = list(range(size))
+    rows = [Namespace(id=i, related_id=i // 10) for i in ids]
+
+    print('%-8s %-8s %6s %12s %12s %14s' % ('cipher', 'alphabet', 'chars', 'encode (s)',
+                                            'decode (s)', 'serialize (s)'))
+    for name, cipher_class in backends:
+        for alphabet in ('base32', 'base64'):
+            cipher = cipher_class(alphabet=alphabet)
+            encoded = cipher.encode_many(ids)
+
+            serializer = CipherBenchmarkSerializer(rows, many=True)
+            serializer.child.cipher = cipher
+
+            encode = best_of(lambda: [cipher.encode(i) for i in ids], 1)
+            decode = best_of(lambda: [cipher.decode(e) for e in encoded], 1)
+            serialize = best_of(lambda: serializer.to_representation(rows), 1)
+
+            print('%-8s %-8s %6d %12.6f %12.6f %14.6f' % (name, alphabet, len(encoded[0]),
+                                                        encode, decode, serialize))
+
+
+def bench_streaming(sizes=(10000, 100000)):
+    """
+    Compare the time and peak memory of rendering a list in full against streaming it.
+    """
+    if tracemalloc is None:
+        print('tracemalloc is not available')
+        return
+
+    def measure(render):
+        tracemalloc.start()
+        started = timeit.default_timer()
+        render()
+        elapsed = timeit.default_timer() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak / 1024.0 / 1024.0
+
+    def rows(size):
+        return (Namespace(id=i, related_id=i // 10) for i in range(size))
+
+    def stream(size):
+        for _ in iter_json(serializer.iter_representation(rows(size), 1000)):
+            pass
+
+    serializer = EncryptedLookupListSerializer(child=CipherBenchmarkSerializer())
+
+    print('%-8s %10s %10s %12s %12s' %
+          ('rows', 'list (s)', 'list (MB)', 'stream (s)', 'stream (MB)'))
+    for size in sizes:
+        full = measure(lambda: encode_json(serializer.to_representation(list(rows(size)))))
+        streamed = measure(lambda: stream(size))
+        print('%-8d %10.3f %10.1f %12.3f %12.1f' % ((size,) + full + streamed))
+
+
+def bench_command(size=1000000):
+    """
+    Compare the encrypted_lookup command's throughput in one process against a pool of one
+    worker per CPU.
+    """
+    directory = tempfile.mkdtemp()
+    input_path = os.path.join(directory, 'ids')
+    output_path = os.path.join(directory, 'tokens')
+
+    with open(input_path, 'w') as input_file:
+        input_file.write(''.join('%d\n' % i for i in range(size)))
+
+    print('%-8s %8s %12s %14s' % ('op', 'workers', 'time (s)', 'ids/minute'))
+    try:
+        for workers in sorted(set((1, multiprocessing.cpu_count()))):
+            for operation, path in (('encode', input_path), ('decode', output_path)):
+                destination = os.path.join(directory, operation)
+                elapsed = best_of(lambda: call_command('encrypted_lookup', operation, path,
+                                                       output=destination, workers=workers,
+                                                       stderr=six.StringIO()), 1, repeat=1)
+                if operation == 'encode':
+                    shutil.move(destination, output_path)
+                print('%-8s %8d %12.3f %14.0f' % (operation, workers, elapsed, 60 * size / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_instrumentation(number=10000):
+    """
+    Compare the per-call cost of encode, decode and get_url without sinks and with a MemorySink.
+    """
+    request = APIRequestFactory().get('/')
+    row = Namespace(pk=1)
+    token = id_cipher.encode(1)
+
+    def measure():
+        field = EncryptedLookupHyperlinkedRelatedField('viewname', read_only=True)
+        field.bind('related', UserBenchmarkSerializer())
+        return (
+            best_of(lambda: id_cipher.encode(1), number),
+            best_of(lambda: id_cipher.decode(token), number),
+            best_of(lambda: field.get_url(row, 'viewname', request, None), number),
+        )
+
+    disabled = measure()
+    instrumented = dict(settings.ENCRYPTED_LOOKUP, instrumentation_sinks=[MemorySink()])
+    with override_settings(ENCRYPTED_LOOKUP=instrumented):
+        enabled = measure()
+
+    print('%-10s %14s %14s %8s' % ('op', 'disabled (s)', 'enabled (s)', 'ratio'))
+    for name, off, on in zip(('encode', 'decode', 'get_url'), disabled, enabled):
+        print('%-10s %14.9f %14.9f %7.2fx' % (name, off, on, on / off))
+
+
+class UserBenchmarkSerializer(EncryptedLookupModelSerializer):
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'email', 'groups')
+
+
+class UserBenchmarkView(EncryptedLookupGenericViewSet):
+    queryset = User.objects.all()
+    serializer_class = UserBenchmarkSerializer
+
+
+def bench_view_cipher(number=10000):
+    """
+    Compare the per-request cost of decoding a view's lookup through a new
+    serializer, as dispatch used to, against the view's cipher resolution.
+    """
+    view = UserBenchmarkView(request=APIRequestFactory().get('/'), format_kwarg=None)
+    token = id_cipher.encode(1)
+
+    serializer = best_of(lambda: view.get_serializer().get_cipher().decode(token), number)
+    resolved = best_of(lambda: view.get_cipher().decode(token), number)
+    decode = best_of(lambda: id_cipher.decode(token), number)
+
+    print('%-24s %12s' % ('lookup decode', 'per call (s)'))
+    print('%-24s %12.9f' % ('through serializer', serializer))
+    print('%-24s %12.9f' % ('view.get_cipher()', resolved))
+    print('%-24s %12.9f' % ('cipher.decode() only', decode))
+
+
+def bench_hyperlinked_urls(size=1000):
+    """
+    Compare reversing every hyperlink against EncryptedLookupHyperlinkedRelatedField.get_url.
+    """
+    request = APIRequestFactory().get('/')
+    rows = [Namespace(pk=i) for i in range(size)]
+
+    field = EncryptedLookupHyperlinkedRelatedField('viewname', read_only=True)
+    field.bind('related', UserBenchmarkSerializer())
+
+    reversed_urls = best_of(lambda: [
+        reverse('viewname', kwargs={'pk': id_cipher.encode(row.pk)}, request=request)
+        for row in rows
+    ], 1)
+    templated_urls = best_of(lambda: [
+        field.get_url(row, 'viewname', request, None) for row in rows
+    ], 1)
+
+    print('%-8s %14s %14s %8s' % ('urls', 'reverse (s)', 'get_url (s)', 'speedup'))
+    print('%-8d %14.6f %14.6f %7.2fx' %
+          (size, reversed_urls, templated_urls, reversed_urls / templated_urls))
+
+
+class MemoryQueryset(object):
+    """
+    Queryset stand-in over a list of rows, which counts its queries.
+    """
+
+    def __init__(self, rows):
+        self.rows = dict((row.pk, row) for row in rows)
+        self.queries = 0
+
+    def get(self, pk):
+        self.queries += 1
+        return self.rows[pk]
+
+    def filter(self, pk__in):
+        self.queries += 1
+        return [self.rows[pk] for pk in pk__in if pk in self.rows]
+
+
+def bench_hyperlinked_writes(size=1000):
+    """
+    Compare resolving hyperlinks one at a time against the many=True batch path.
+    """
+    rows = [Namespace(pk=i) for i in range(size)]
+    queryset = MemoryQueryset(rows)
+    serializer = UserBenchmarkSerializer(context={'request': APIRequestFactory().get('/')})
+
+    field = EncryptedLookupHyperlinkedRelatedField('viewname', queryset=queryset, many=True)
+    field.bind('related', serializer)
+    urls = field.to_representation(rows)
+
+    queryset.queries = 0
+    single = best_of(lambda: [field.child_relation.to_internal_value(url) for url in urls], 1,
+                     repeat=1)
+    single_queries, queryset.queries = queryset.queries, 0
+    batch = best_of(lambda: field.to_internal_value(urls), 1, repeat=1)
+
+    print('%-8s %12s %8s %12s %8s %8s' %
+          ('urls', 'single (s)', 'queries', 'batch (s)', 'queries', 'speedup'))
+    print('%-8d %12.6f %8d %12.6f %8d %7.2fx' %
+          (size, single, single_queries, batch, queryset.queries, single / batch))
+
+
+# Results of the suite benchmarks, for machine-readable output.
+results = []  # pylint: disable=invalid-name
+
+
+def record(benchmark, case, variant, size, seconds):
+    results.append({
+        'benchmark': benchmark, 'case': case, 'variant': variant, 'size': size, 'seconds': seconds,
+    })
+
+
+def print_comparison(benchmark):
+    """
+    Print the suite results of benchmark, with the overhead of the encrypted variant over the
+    drf one.
+    """
+    timings = dict(((result['case'], result['size'], result['variant']), result['seconds'])
+                   for result in results if result['benchmark'] == benchmark)
+    cases = sorted(set((case, size) for case, size, _ in timings))
+
+    print('%-12s %8s %14s %14s %9s' % ('case', 'size', 'drf (s)', 'encrypted (s)', 'overhead'))
+    for case, size in cases:
+        drf = timings.get((case, size, 'drf'))
+        encrypted = timings[(case, size, 'encrypted')]
+        if drf is None:
+            print('%-12s %8d %14s %14.6f %9s' % (case, size, '-', encrypted, '-'))
+        else:
+            print('%-12s %8d %14.6f %14.6f %8.2fx' % (case, size, drf, encrypted, encrypted / drf))
+
+
+SUITE_PERMISSIONS = 1000
+
+
+def setup_database():
+    """
+    Create the benchmark tables, and SUITE_PERMISSIONS permissions over ten content types, once.
+    """
+    call_command('migrate', verbosity=0, interactive=False)
+
+    if Permission.objects.filter(codename__startswith='bench_').exists():
+        return
+
+    content_types = [ContentType.objects.get_or_create(app_label='bench', model='model%d' % i)[0]
+                     for i in range(10)]
+    Permission.objects.bulk_create([
+        Permission(name='Bench %d' % i, codename='bench_%d' % i, content_type=content_types[i % 10])
+        for i in range(SUITE_PERMISSIONS)
+    ])
+
+
+def get_permissions(size):
+    return list(Permission.objects.filter(codename__startswith='bench_')
+                .select_related('content_type').order_by('pk')[:size])
+
+
+PERMISSION_FIELDS = ('id', 'name', 'codename', 'content_type')
+
+
+class PlainPermissionSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Permission
+        fields = PERMISSION_FIELDS
+
+
+class EncryptedPermissionSerializer(EncryptedLookupModelSerializer):
+
+    class Meta:
+        model = Permission
+        fields = PERMISSION_FIELDS
+
+
+class PlainHyperlinkedPermissionSerializer(serializers.HyperlinkedModelSerializer):
+
+    class Meta:
+        model = Permission
+        fields = PERMISSION_FIELDS
+        extra_kwargs = {'content_type': {'view_name': 'viewname'}}
+
+
+class EncryptedHyperlinkedPermissionSerializer(EncryptedLookupHyperlinkedModelSerializer):
+
+    class Meta:
+        model = Permission
+        fields = PERMISSION_FIELDS
+        extra_kwargs = {'content_type': {'view_name': 'viewname'}}
+
+
+class PlainGroupSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Group
+        fields = ('name', 'permissions')
+
+
+class EncryptedGroupSerializer(EncryptedLookupModelSerializer):
+
+    class Meta:
+        model = Group
+        fields = ('name', 'permissions')
+
+
+class PlainPermissionView(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    queryset = Permission.objects.all()
+    serializer_class = PlainPermissionSerializer
+
+
+class EncryptedPermissionView(mixins.RetrieveModelMixin, EncryptedLookupGenericViewSet):
+    queryset = Permission.objects.all()
+    serializer_class = EncryptedPermissionSerializer
+
+
+class CachedPermissionSerializer(EncryptedPermissionSerializer):
+    cache_fields = True
+
+
+def bench_serializer_fields(number=1000):
+    """
+    Compare the per-instance cost of building a serializer's fields with and without the
+    per-class cache.
+    """
+    cases = (
+        ('drf', PlainPermissionSerializer),
+        ('uncached', EncryptedPermissionSerializer),
+        ('cached', CachedPermissionSerializer),
+    )
+
+    print('%-10s %14s' % ('fields', 'per instance (s)'))
+    for name, serializer_class in cases:
+        print('%-10s %14.9f' % (name, best_of(lambda: serializer_class().fields, number)))
+
+
+def bench_suite_cipher(size=10000):
+    """
+    Measure IDCipher encode/decode throughput, singly and in batches, per id.
+    """
+    cipher = IDCipher()
+    ids = list(range(size))
+    encoded = cipher.encode_many(ids)
+
+    for case, function in (('encode', lambda: [cipher.encode(i) for i in ids]),
+                           ('encode_many', lambda: cipher.encode_many(ids)),
+                           ('decode', lambda: [cipher.decode(e) for e in encoded]),
+                           ('decode_many', lambda: cipher.decode_many(encoded))):
+        record('cipher', case, 'encrypted', size, best_of(function, 1) / size)
+
+    print_comparison('cipher')
+
+
+def bench_suite_list(sizes=(10, 100, 1000)):
+    """
+    Compare list rendering by plain and encrypted-lookup model and hyperlinked model serializers.
+    """
+    setup_database()
+    context = {'request': APIRequestFactory().get('/')}
+
+    for size in sizes:
+        permissions = get_permissions(size)
+        number = max(1, 1000 // size)
+
+        for case, plain_class, encrypted_class in (
+                ('model', PlainPermissionSerializer, EncryptedPermissionSerializer),
+                ('hyperlinked', PlainHyperlinkedPermissionSerializer,
+                 EncryptedHyperlinkedPermissionSerializer)):
+            for variant, serializer_class in (('drf', plain_class), ('encrypted', encrypted_class)):
+                record('list', case, variant, size, best_of(
+                    lambda: serializer_class(permissions, many=True, context=context).data, number))
+
+    print_comparison('list')
+
+
+def bench_suite_writes(sizes=(10, 100, 1000)):
+    """
+    Compare validating a many-related write of primary keys against one of encrypted lookups.
+    """
+    setup_database()
+
+    for size in sizes:
+        pks = [permission.pk for permission in get_permissions(size)]
+        lookups = [json.dumps(token) for token in id_cipher.encode_many(pks)]
+        number = max(1, 100 // size)
+
+        for variant, serializer_class, values in (('drf', PlainGroupSerializer, pks),
+                                                  ('encrypted', EncryptedGroupSerializer, lookups)):
+            def validate():
+                serializer = serializer_class(data={'name': 'bench', 'permissions': values})
+                assert serializer.is_valid(), serializer.errors
+            record('writes', 'many_related', variant, size, best_of(validate, number))
+
+    print_comparison('writes')
+
+
+def bench_suite_detail(number=1000):
+    """
+    Compare a plain viewset's detail dispatch against an encrypted-lookup viewset's.
+    """
+    setup_database()
+    pk = get_permissions(1)[0].pk
+    request = APIRequestFactory().get('/')
+
+    variants = (
+        ('drf', PlainPermissionView, pk),
+        ('encrypted', EncryptedPermissionView, id_cipher.encode(pk)),
+    )
+    for variant, view_class, lookup in variants:
+        view = view_class.as_view({'get': 'retrieve'})
+        record('detail', 'retrieve', variant, 1,
+               best_of(lambda: view(request, pk=lookup).render(), number))
+
+    print_comparison('detail')
+
+
+SUITE = (
+    bench_suite_cipher,
+    bench_suite_list,
+    bench_suite_writes,
+    bench_suite_detail,
+)
+
+
+BENCHMARKS = (
+    bench_cipher_batch,
+    bench_cipher_cache,
+    bench_cipher_formats,
+    bench_invalid_tokens,
+    bench_cipher_backends,
+    bench_cipher_threads,
+    bench_streaming,
+    bench_command,
+    bench_view_cipher,
+    bench_hyperlinked_urls,
+    bench_hyperlinked_writes,
+    bench_instrumentation,
+    bench_serializer_fields,
+) + SUITE
+
+
+def save_results(path):
+    with open(path, 'w') as output:
+        json.dump({
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'rest_framework': rest_framework.VERSION,
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+
+
+def compare_results(path):
+    """
+    Print the ratio of each suite result to the same result of an earlier run, saved at path.
+    """
+    with open(path) as baseline_file:
+        baseline = dict(
+            ((result['benchmark'], result['case'], result['variant'], result['size']),
+             result['seconds'])
+            for result in json.load(baseline_file)['results']
+        )
+
+    print('\n%-8s %-12s %-10s %8s %14s %14s %8s' %
+          ('bench', 'case', 'variant', 'size', 'baseline (s)', 'current (s)', 'ratio'))
+    for result in results:
+        key = (result['benchmark'], result['case'], result['variant'], result['size'])
+        if key in baseline:
+            ratio = result['seconds'] / baseline[key]
+            print('%-8s %-12s %-10s %8d %14.6f %14.6f %7.2fx' %
+                  (key + (baseline[key], result['seconds'], ratio)))
+
+
+def main(names=None, json_path=None, compare_path=None):
+    """
+    Run the named benchmarks, or all of them; the name "suite" selects the suite benchmarks.
+    """
+    names = set(names or ())
+    if 'suite' in names:
+        names.update(benchmark.__name__ for benchmark in SUITE)
+
+    for benchmark in BENCHMARKS:
+        if names and benchmark.__name__ not in names:
+            continue
+        print('\n%s' % benchmark.__name__)
+        benchmark()
+
+    if json_path:
+        save_results(json_path)
+    if compare_path:
+        compare_results(compare_path)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+
+import django
+from django.conf import settings
+
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..', '..')))
+
+settings.configure(
+    SECRET_KEY="django_benchmarks_secret_key",
+    DEBUG=False,
+    ROOT_URLCONF='rest_framework_encrypted_lookup.tests.urls',
+    ALLOWED_HOSTS=['testserver'],
+    INSTALLED_APPS=(
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'rest_framework',
+        'rest_framework_encrypted_lookup',
+    ),
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('BENCHMARK_DATABASE', ':memory:'),
+        }
+    },
+
+    ENCRYPTED_LOOKUP={
+        'lookup_field_name': 'id',
+        'secret_key': "blablabla",
+    },
+)
+
+try:
+    django.setup()
+except AttributeError:
+    pass
+
+# pylint: disable=wrong-import-position
+from rest_framework_encrypted_lookup.tests import benchmarks
+
+parser = argparse.ArgumentParser(description="Run the rest_framework_encrypted_lookup benchmarks.")
+parser.add_argument('names', nargs='*',
+                    help="Benchmarks to run, or suite for the suite benchmarks; defaults to all.")
+parser.add_argument('--json', help="Save the suite results as JSON to this path.")
+parser.add_argument('--compare', help="Compare the suite results with those saved by an earlier "
+                                         "run at this path.")
+options = parser.parse_args()
+
+benchmarks.main(options.names, options.json, options.compare)
@@ -10,13 +10,15 @@ from django.core.management import execute_from_command_line
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..')))
+# The package itself is installed as an app, for its management command.
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, '..', '..')))
 
 # Unfortunately, apps can not be installed via ``modify_settings``
 # decorator, because it would miss the database setup.
 CUSTOM_INSTALLED_APPS = (
     'rest_framework',
     # 'tests',
-    # 'rest_framework_encrypted_lookup',
+    'rest_framework_encrypted_lookup',
     # 'django.contrib.admin',
 )
 
@@ -44,6 +46,7 @@ settings.configure(
     ALLOWED_HOSTS=[],
     INSTALLED_APPS=ALWAYS_INSTALLED_APPS + CUSTOM_INSTALLED_APPS,
     MIDDLEWARE_CLASSES=ALWAYS_MIDDLEWARE_CLASSES,
+    MIDDLEWARE=ALWAYS_MIDDLEWARE_CLASSES,
     ROOT_URLCONF='rest_framework_encrypted_lookup.tests.urls',
     DATABASES={
         'default': {
@@ -56,6 +59,7 @@ settings.configure(
     USE_L10N=True,
     USE_TZ=True,
     STATIC_URL='/static/',
+    DEFAULT_AUTO_FIELD='django.db.models.AutoField',
     # Use a fast hasher to speed up tests.
     PASSWORD_HASHERS=(
         'django.contrib.auth.hashers.MD5PasswordHasher',
@@ -1,21 +1,64 @@
 import json
+import os
+import re
+import shutil
 import sys
-
-
-from django.test import TestCase
+import tempfile
+import threading
+import unittest
+import uuid
+
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.db import models
 from django.http import Http404
+import six
 
+from rest_framework.routers import SimpleRouter
 from rest_framework.test import APIRequestFactory
-from rest_framework import status, viewsets
+from rest_framework import serializers, status, viewsets
 from rest_framework.response import Response
-
-from rest_framework_encrypted_lookup.utils import id_cipher, IDCipher
+from rest_framework.reverse import reverse as drf_reverse
+
+from rest_framework_encrypted_lookup.utils import id_cipher, IDCipher, FeistelIDCipher, \
+    CryptographyIDCipher, MultiKeyIDCipher, id_cipher_registry, InvalidTokenError, get_key_type
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+try:
+    import django_filters
+except ImportError:
+    django_filters = None
 from rest_framework_encrypted_lookup.fields import EncryptedLookupRelatedField, EncryptedLookupField, \
-    EncryptedLookupHyperlinkedRelatedField
+    EncryptedLookupHyperlinkedRelatedField, EncryptedLookupManyRelatedField, \
+    EncryptedLookupHyperlinkedManyRelatedField
 from rest_framework_encrypted_lookup.serializers import EncryptedLookupModelSerializer, \
-    EncryptedLookupHyperlinkedModelSerializer
-from rest_framework_encrypted_lookup.views import EncryptedLookupGenericViewSet
+    EncryptedLookupHyperlinkedModelSerializer, EncryptedLookupListSerializer
+from rest_framework_encrypted_lookup.converters import EncryptedLookupConverter
+from rest_framework_encrypted_lookup.instrumentation import InstrumentedIDCipher, MemorySink, \
+    SignalSink, metric_recorded
+from rest_framework_encrypted_lookup.filters import EncryptedLookupFilterBackend
+from rest_framework_encrypted_lookup.models import EncryptedLookupTokenField
+if django_filters is not None:
+    from rest_framework_encrypted_lookup.filters import EncryptedLookupFilter
+from rest_framework_encrypted_lookup.settings import encrypted_lookup_settings
+from rest_framework_encrypted_lookup.views import EncryptedLookupGenericViewSet, \
+    EncryptedLookupStreamingListMixin
+if django.VERSION >= (3, 1):
+    import asyncio
+    from django.test import AsyncClient
+    from rest_framework_encrypted_lookup.asynchronous import AsyncEncryptedLookupGenericViewSet, \
+        AsyncEncryptedLookupModelSerializer, AsyncEncryptedLookupRelatedField, \
+        AsyncEncryptedLookupManyRelatedField, AsyncCreateModelMixin, AsyncListModelMixin, \
+        AsyncRetrieveModelMixin, ais_valid
 
 # In Django, defining a model induces side effects such as database table creation.
 # To avoid these side effects during non-test runs, before we define models we first
@@ -27,7 +70,7 @@ if 'runtests.py' in sys.argv[0] or (len(sys.argv) >= 3 and sys.argv[1:2] == ['te
 
     class DummyModel(models.Model):
 
-        related = models.ForeignKey(DummyModel0)
+        related = models.ForeignKey(DummyModel0, on_delete=models.CASCADE)
 
         def __init__(self, *args, **kwargs):
             super(DummyModel, self).__init__(*args, **kwargs)
@@ -40,14 +83,34 @@ if 'runtests.py' in sys.argv[0] or (len(sys.argv) >= 3 and sys.argv[1:2] == ['te
     # A queryset class to retrieve dummy objects:
     class DummyQueryset(object):
 
+        model = DummyModel
+
         def get(self, pk):
             return dummy_objects[pk]
 
+        def filter(self, pk__in):
+            return [dummy_object for dummy_object in dummy_objects if dummy_object.pk in pk__in]
+
         def __iter__(self, *args, **kwargs):
             return dummy_objects.__iter__(*args, **kwargs)
 
     dummy_queryset = DummyQueryset()
 
+    # A queryset class which records its filters:
+    class RecordingQueryset(object):
+
+        model = DummyModel
+
+        def __init__(self):
+            self.filters = []
+
+        def filter(self, **kwargs):
+            self.filters.append(kwargs)
+            return self
+
+        def distinct(self):
+            return self
+
     class DummySerializer(EncryptedLookupModelSerializer):
 
         class Meta:
@@ -71,6 +134,66 @@ if 'runtests.py' in sys.argv[0] or (len(sys.argv) >= 3 and sys.argv[1:2] == ['te
             serializer = self.get_serializer(instance)
             return Response(serializer.data)
 
+    class DummyManyModel(models.Model):
+        targets = models.ManyToManyField(DummyModel0)
+
+    class DummyManySerializer(EncryptedLookupModelSerializer):
+
+        class Meta:
+            model = DummyManyModel
+            fields = ('id', 'targets')
+
+    class TokenModel(models.Model):
+        name = models.CharField(max_length=20, blank=True)
+        token = EncryptedLookupTokenField()
+
+    class TokenRelatedModel(models.Model):
+        target = models.ForeignKey(TokenModel, on_delete=models.CASCADE)
+        token = EncryptedLookupTokenField()
+
+    class TokenSerializer(EncryptedLookupModelSerializer):
+
+        class Meta:
+            model = TokenModel
+            fields = ('id', 'name')
+
+    class TokenRelatedSerializer(EncryptedLookupModelSerializer):
+
+        class Meta:
+            model = TokenRelatedModel
+            fields = ('id', 'target')
+
+    class TokenView(EncryptedLookupGenericViewSet,
+                    viewsets.mixins.RetrieveModelMixin):
+
+        queryset = TokenModel.objects.all()
+        serializer_class = TokenSerializer
+
+    class UUIDModel(models.Model):
+        id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+        name = models.CharField(max_length=20, blank=True)
+
+    class UUIDRelatedModel(models.Model):
+        target = models.ForeignKey(UUIDModel, on_delete=models.CASCADE)
+
+    class UUIDSerializer(EncryptedLookupModelSerializer):
+
+        class Meta:
+            model = UUIDModel
+            fields = ('id', 'name')
+
+    class UUIDRelatedSerializer(EncryptedLookupModelSerializer):
+
+        class Meta:
+            model = UUIDRelatedModel
+            fields = ('id', 'target')
+
+    class UUIDView(EncryptedLookupGenericViewSet,
+                   viewsets.mixins.RetrieveModelMixin):
+
+        queryset = UUIDModel.objects.all()
+        serializer_class = UUIDSerializer
+
 
 
 class IDCipherTests(TestCase):
@@ -93,6 +216,516 @@ class IDCipherTests(TestCase):
         for i in range(-10, 10):
             self.assertEqual(i, new_id_cipher.decode(new_id_cipher.encode(i)))
 
+    def test_encode_many(self):
+        # Include ids long enough to spill into a second block.
+        ids = list(range(-10, 10)) + [2147483647, 10 ** 15, 10 ** 16, -10 ** 20]
+        encoded = id_cipher.encode_many(ids)
+
+        # Assert that batch encoding gives the same tokens as scalar encoding
+        self.assertEqual([id_cipher.encode(i) for i in ids], encoded)
+
+        # Assert that batch decoding inverts batch encoding
+        self.assertEqual(ids, id_cipher.decode_many(encoded))
+
+        self.assertEqual([], id_cipher.encode_many([]))
+        self.assertEqual([], id_cipher.decode_many([]))
+
+    def test_large_decimal_ids(self):
+        cipher = IDCipher(secret="large")
+        ids = [10 ** 15 - 1, 10 ** 15, 2 ** 63 - 1, -2 ** 63]
+        encoded = cipher.encode_many(ids)
+
+        # Assert that 64-bit ids of 16 or more characters still take a single block
+        self.assertEqual(set([26]), set(len(token) for token in encoded))
+        self.assertEqual(ids, cipher.decode_many(encoded))
+
+        # Assert that their earlier two-block tokens still decode, and that ids beyond 64 bits
+        # still encode
+        # pylint: disable=protected-access
+        padded = cipher._pad(str(2 ** 63 - 1), cipher.PADDING_STRING).encode('utf-8')
+        two_block = cipher.alphabet.encode(cipher._encrypt(padded))
+        self.assertEqual(2 ** 63 - 1, cipher.decode(two_block))
+        self.assertEqual(2 ** 64, cipher.decode(cipher.encode(2 ** 64)))
+
+    def test_decode_many_rejects_misaligned_cipher_text(self):
+        encoded = id_cipher.encode_many([1, 2])
+
+        # Assert that a truncated token is not silently decoded into a neighbour's block
+        with self.assertRaises(ValueError):
+            id_cipher.decode_many([encoded[0][:16], encoded[1]])
+
+    def test_cache(self):
+        uncached_cipher = IDCipher(secret="cached")
+        cipher = IDCipher(secret="cached", cache_size=2)
+
+        # Assert that caching is disabled unless a cache size is given
+        self.assertIsNone(uncached_cipher.get_cache_stats())
+
+        # Assert that cached results equal uncached results, in both directions
+        self.assertEqual(uncached_cipher.encode(1), cipher.encode(1))
+        self.assertEqual(uncached_cipher.encode(1), cipher.encode(1))
+        self.assertEqual(1, cipher.decode(uncached_cipher.encode(1)))
+        self.assertEqual(uncached_cipher.encode_many([1, 2, 3]), cipher.encode_many([1, 2, 3]))
+        self.assertEqual([3, 2, 1], cipher.decode_many(uncached_cipher.encode_many([3, 2, 1])))
+
+        stats = cipher.get_cache_stats()
+
+        # Assert that hits, misses and evictions are counted, within the size bound
+        self.assertEqual({'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2, 'max_size': 2},
+                         stats['encode'])
+        self.assertEqual(2, stats['decode']['size'])
+
+        # Assert that decoding a non-canonical cipher text does not poison the encode cache
+        cipher.decode(uncached_cipher.encode(5).upper())
+        self.assertEqual(uncached_cipher.encode(5), cipher.encode(5))
+
+        # Assert that ids given as text decode as they would uncached, from the cache which encode
+        # filled
+        cipher = IDCipher(secret="cached", cache_size=10)
+        tokens = cipher.encode_many(['5', 6, '6'])
+        self.assertEqual([5, 6, 6], [cipher.decode(token) for token in tokens])
+        self.assertEqual([7, 5], cipher.decode_many([cipher.encode('7'), cipher.encode(5)]))
+        self.assertEqual(5, cipher.get_cache_stats()['decode']['hits'])
+
+        value = uuid.uuid4()
+        cipher = IDCipher(secret="cached", cache_size=10, key_type='uuid')
+        self.assertEqual(value, cipher.decode(cipher.encode(str(value))))
+
+    def test_binary_id_format_and_alphabets(self):
+        legacy_cipher = IDCipher(secret="formats")
+        ids = [0, 1, -1, 2147483647, 10 ** 16, 2 ** 63 - 1, -2 ** 63]
+
+        for alphabet, length in (('base32', 26), ('base64', 22), ('base62', 22)):
+            cipher = IDCipher(secret="formats", id_format='binary', alphabet=alphabet)
+            encoded = cipher.encode_many(ids)
+
+            # Assert that every id, however long, encodes to a single-block token
+            self.assertEqual(set([length]), set(len(token) for token in encoded))
+
+            # Assert that batch and scalar methods agree, and invert each other
+            self.assertEqual([cipher.encode(i) for i in ids], encoded)
+            self.assertEqual(ids, cipher.decode_many(encoded))
+            self.assertEqual(ids, [cipher.decode(token) for token in encoded])
+
+            # Assert that legacy tokens remain decodable, alongside new ones
+            legacy_encoded = legacy_cipher.encode_many(ids)
+            self.assertEqual(ids, [cipher.decode(token) for token in legacy_encoded])
+            self.assertEqual(ids + ids, cipher.decode_many(encoded + legacy_encoded))
+
+        # Assert that ids outside the 64-bit range are refused by the binary format
+        with self.assertRaises(ValueError):
+            IDCipher(id_format='binary').encode(2 ** 63)
+
+        # Assert that tokens with characters outside the alphabet are refused
+        token = IDCipher(alphabet='base64').encode(1)
+        with self.assertRaises(ValueError):
+            IDCipher(alphabet='base64').decode_many([token[:-1] + '+'])
+
+    def test_invalid_tokens(self):
+        """
+        Any invalid text should raise InvalidTokenError, and repeats should be rejected from the
+        cache.
+        """
+        cipher = IDCipher(rejected_cache_size=2)
+        hostile = IDCipher(secret="other").encode(1)
+        invalids = (None, 1, [], b'abcd', "", "a" * 27, "!" * 26, "a" * 8000, hostile)
+
+        for invalid in invalids:
+            with self.assertRaises(InvalidTokenError):
+                cipher.decode(invalid)
+            with self.assertRaises(InvalidTokenError):
+                cipher.decode_many([cipher.encode(1), invalid])
+
+        # Assert that decode_many found each rejected string in the cache, which
+        # holds only the most recent ones, and no valid tokens. Under Python 2,
+        # b'abcd' is a string too.
+        self.assertEqual(cipher.decode(cipher.encode(1)), 1)
+        with self.assertRaises(InvalidTokenError):
+            cipher.decode(hostile)
+        stats = cipher.get_cache_stats()['rejected']
+        strings = len([invalid for invalid in invalids if isinstance(invalid, six.string_types)])
+        self.assertEqual((stats['hits'], stats['size'], stats['max_size']), (strings + 1, 2, 2))
+
+        # Assert that overlong text is rejected by its length alone, in every alphabet
+        for alphabet in ('base32', 'base64', 'base62'):
+            cipher = IDCipher(alphabet=alphabet)
+            with self.assertRaises(InvalidTokenError):
+                cipher.decode("a" * (cipher.max_token_length + 1))
+            self.assertEqual({}, cipher.token_alphabets)
+
+        # Assert that ids too long to decode are not encoded
+        with self.assertRaises(ValueError):
+            IDCipher().encode(10 ** 70)
+
+        # Assert that uniform errors don't depend on the cache
+        with self.assertRaises(InvalidTokenError):
+            IDCipher().decode(hostile)
+        with self.assertRaises(InvalidTokenError):
+            FeistelIDCipher().decode("!" * 13)
+
+    def test_feistel_cipher(self):
+        ids = list(range(-1000, 1000)) + [2 ** 63 - 1, -2 ** 63]
+
+        for alphabet, length in (('base32', 13), ('base64', 11), ('base62', 11)):
+            cipher = FeistelIDCipher(secret="feistel", alphabet=alphabet)
+            encoded = cipher.encode_many(ids)
+
+            # Assert that every id encodes to a single 64-bit block token
+            self.assertEqual(set([length]), set(len(token) for token in encoded))
+
+            # Assert that tokens are distinct, and that batch and scalar methods agree and invert
+            self.assertEqual(len(ids), len(set(encoded)))
+            self.assertEqual([cipher.encode(i) for i in ids], encoded)
+            self.assertEqual(ids, cipher.decode_many(encoded))
+            self.assertEqual(ids, [cipher.decode(token) for token in encoded])
+
+        # Assert that the key is used
+        self.assertNotEqual(FeistelIDCipher(secret="first").encode(1),
+                            FeistelIDCipher(secret="second").encode(1))
+
+
+    def test_thread_local_cipher(self):
+        cipher = IDCipher(secret="threads")
+        ciphers = []
+
+        thread = threading.Thread(target=lambda: ciphers.append((cipher.cipher, cipher.encode(1))))
+        thread.start()
+        thread.join()
+
+        # Assert that each thread uses its own AES object, to the same effect
+        self.assertIsNot(cipher.cipher, ciphers[0][0])
+        self.assertIs(cipher.cipher, cipher.cipher)
+        self.assertEqual(cipher.encode(1), ciphers[0][1])
+
+    def test_lazy_id_cipher_setup_race(self):
+        id_cipher.reset()
+        ciphers = []
+        barrier = threading.Event()
+
+        def first_use():
+            barrier.wait()
+            # pylint: disable=protected-access
+            ciphers.append(id_cipher._wrapped if id_cipher.encode(1) else None)
+
+        threads = [threading.Thread(target=first_use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+
+        # Assert that threads racing to first use all get the same cipher
+        self.assertEqual(8, len(ciphers))
+        self.assertEqual(1, len(set(id(cipher) for cipher in ciphers)))
+
+
+class CipherConformanceMixin(object):
+    """
+    Checks which every cipher backend must pass.
+
+    Subclasses set cipher_class, the constructor keyword arguments to check it
+    with, and, for a backend which must produce the same tokens as another,
+    reference_class.
+    """
+
+    cipher_class = None
+    reference_class = None
+    cipher_kwargs = ({'alphabet': 'base32'}, {'alphabet': 'base64'}, {'alphabet': 'base62'})
+    ids = list(range(-300, 300)) + [2147483647, -2147483648, 2 ** 63 - 1, -2 ** 63]
+
+    def get_ciphers(self, **kwargs):
+        for cipher_kwargs in self.cipher_kwargs:
+            cipher_kwargs = dict(cipher_kwargs, **kwargs)
+            yield cipher_kwargs, self.cipher_class(secret="conformance", **cipher_kwargs)
+
+    def test_round_trip(self):
+        for _, cipher in self.get_ciphers():
+            encoded = [cipher.encode(i) for i in self.ids]
+
+            # Assert that tokens are distinct strings which decode to their ids
+            self.assertEqual(len(self.ids), len(set(encoded)))
+            self.assertEqual(self.ids, [cipher.decode(token) for token in encoded])
+
+    def test_batch_matches_scalar(self):
+        for _, cipher in self.get_ciphers():
+            encoded = cipher.encode_many(self.ids)
+
+            self.assertEqual([cipher.encode(i) for i in self.ids], encoded)
+            self.assertEqual(self.ids, cipher.decode_many(encoded))
+
+            # Assert that the batch methods take any iterable
+            self.assertEqual(encoded, cipher.encode_many(i for i in self.ids))
+            self.assertEqual(self.ids, cipher.decode_many(token for token in encoded))
+
+    def test_cache_matches_uncached(self):
+        for cipher_kwargs, cached_cipher in self.get_ciphers(cache_size=100):
+            cipher = self.cipher_class(secret="conformance", **cipher_kwargs)
+
+            for _ in range(2):
+                self.assertEqual(cipher.encode_many(self.ids), cached_cipher.encode_many(self.ids))
+                self.assertEqual([cipher.encode(i) for i in self.ids],
+                                 [cached_cipher.encode(i) for i in self.ids])
+
+    def test_malformed_tokens_raise_value_error(self):
+        for _, cipher in self.get_ciphers():
+            token = cipher.encode(1)
+
+            for malformed in ("", "1", "!" * len(token), token + "a", token[:-1]):
+                with self.assertRaises(ValueError):
+                    cipher.decode(malformed)
+                with self.assertRaises(ValueError):
+                    cipher.decode_many([token, malformed])
+
+    def test_token_pattern(self):
+        for _, cipher in self.get_ciphers():
+            pattern = re.compile('^(?:%s)$' % cipher.get_token_pattern())
+
+            # Assert that every token matches, and that junk does not
+            for token in cipher.encode_many(self.ids):
+                self.assertTrue(pattern.match(token))
+            for junk in ("", "1", "!" * 30, "a/b" * 10, "a.json" * 5, "a" * 2000):
+                self.assertFalse(pattern.match(junk))
+
+    def test_concurrent_use(self):
+        for _, cipher in self.get_ciphers(cache_size=50):
+            expected = cipher.encode_many(self.ids)
+            failures = []
+
+            def work(offset):
+                try:
+                    for i in range(5):
+                        ids = self.ids[offset + i::17]
+                        encoded = cipher.encode_many(ids)
+                        if [cipher.encode(this_id) for this_id in ids] != encoded or \
+                                cipher.decode_many(encoded) != ids or \
+                                [cipher.decode(token) for token in encoded] != ids:
+                            failures.append(offset)
+                except Exception as error:  # pylint: disable=broad-except
+                    failures.append(error)
+
+            threads = [threading.Thread(target=work, args=(offset,)) for offset in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Assert that a cipher shared by threads gives every thread the single-threaded results
+            self.assertEqual([], failures)
+            self.assertEqual(expected, cipher.encode_many(self.ids))
+
+    def test_uuid_keys(self):
+        uuids = [uuid.UUID(int=0), uuid.UUID(int=2 ** 128 - 1)] + [uuid.uuid4() for _ in range(50)]
+
+        for _, cipher in self.get_ciphers(key_type='uuid'):
+            encoded = cipher.encode_many(uuids)
+
+            # Assert that every UUID encodes to a token of one length, given as a UUID or as text
+            self.assertEqual(1, len(set(len(token) for token in encoded)))
+            self.assertEqual(len(uuids), len(set(encoded)))
+            self.assertEqual([cipher.encode(str(this_uuid)) for this_uuid in uuids], encoded)
+
+            # Assert that tokens decode to UUIDs, in batches and singly
+            self.assertEqual(uuids, cipher.decode_many(encoded))
+            self.assertEqual(uuids, [cipher.decode(token) for token in encoded])
+
+            with self.assertRaises(ValueError):
+                cipher.encode('not-a-uuid')
+
+    def test_matches_reference(self):
+        if self.reference_class is None:
+            return
+
+        for cipher_kwargs, cipher in self.get_ciphers():
+            reference = self.reference_class(secret="conformance", **cipher_kwargs)
+
+            # Assert that tokens are interchangeable with the reference backend's
+            self.assertEqual(reference.encode_many(self.ids), cipher.encode_many(self.ids))
+            self.assertEqual(self.ids, cipher.decode_many(reference.encode_many(self.ids)))
+
+
+AES_CIPHER_KWARGS = tuple(
+    {'id_format': id_format, 'alphabet': alphabet}
+    for id_format in IDCipher.ID_FORMATS for alphabet in ('base32', 'base64', 'base62')
+)
+
+
+class IDCipherConformanceTests(CipherConformanceMixin, TestCase):
+
+    cipher_class = IDCipher
+    cipher_kwargs = AES_CIPHER_KWARGS
+
+
+@unittest.skipIf(cryptography is None, "cryptography is not installed")
+class CryptographyIDCipherConformanceTests(CipherConformanceMixin, TestCase):
+
+    cipher_class = CryptographyIDCipher
+    reference_class = IDCipher
+    cipher_kwargs = AES_CIPHER_KWARGS
+
+
+class FeistelIDCipherConformanceTests(CipherConformanceMixin, TestCase):
+
+    cipher_class = FeistelIDCipher
+
+
+def multi_key_id_cipher(secret, **kwargs):
+    return MultiKeyIDCipher({
+        '': IDCipher(secret="legacy " + secret, **kwargs),
+        'k1': IDCipher(secret="old " + secret, **kwargs),
+        'k2': IDCipher(secret=secret, **kwargs),
+    }, 'k2')
+
+
+class MultiKeyIDCipherConformanceTests(CipherConformanceMixin, TestCase):
+
+    cipher_class = staticmethod(multi_key_id_cipher)
+    cipher_kwargs = AES_CIPHER_KWARGS
+
+
+class MultiKeyIDCipherTests(TestCase):
+
+    def test_rotation(self):
+        """
+        Tokens of every configured key should decode, and new tokens should use the current key.
+        """
+        legacy_cipher = IDCipher(secret="first")
+        old_cipher = IDCipher(secret="second")
+        ciphers = {'': legacy_cipher, 'k1': old_cipher, 'k2': IDCipher(secret="third")}
+        cipher = MultiKeyIDCipher(ciphers, 'k2')
+
+        legacy_token = legacy_cipher.encode(1)
+        old_token = 'k1~' + old_cipher.encode(2)
+
+        self.assertEqual(cipher.encode(3), 'k2~' + IDCipher(secret="third").encode(3))
+        self.assertEqual(cipher.encode_many([3]), [cipher.encode(3)])
+        self.assertEqual(cipher.decode(legacy_token), 1)
+        self.assertEqual(cipher.decode(old_token), 2)
+        tokens = [old_token, cipher.encode(3), legacy_token, old_token]
+        self.assertEqual(cipher.decode_many(tokens), [2, 3, 1, 2])
+
+        # Assert that unknown key ids are rejected without trial decryption
+        with self.assertRaises(ValueError):
+            cipher.decode('k0~' + old_cipher.encode(2))
+        with self.assertRaises(ValueError):
+            MultiKeyIDCipher({'k~1': legacy_cipher}, 'k~1')
+        with self.assertRaises(ValueError):
+            MultiKeyIDCipher({'k1': legacy_cipher}, 'k2')
+
+        # Assert that decodes with old keys are counted
+        usage = cipher.get_key_usage()
+        self.assertEqual(sorted(usage), ['', 'k1'])
+        self.assertEqual(usage['']['decodes'], 2)
+        self.assertEqual(usage['k1']['decodes'], 3)
+        self.assertIsNotNone(usage['k1']['last_used'])
+
+    def test_rotation_settings(self):
+        """
+        Rotating the secret key through settings should keep earlier tokens valid.
+        """
+        legacy_token = id_cipher.encode(1)
+        rotated = dict(settings.ENCRYPTED_LOOKUP, secret_key="rotated", key_id='k1',
+                       legacy_secret_keys={'': settings.ENCRYPTED_LOOKUP['secret_key']})
+
+        with override_settings(ENCRYPTED_LOOKUP=rotated):
+            self.assertTrue(id_cipher.encode(1).startswith('k1~'))
+            self.assertEqual(id_cipher.decode(id_cipher.encode(1)), 1)
+            self.assertEqual(id_cipher.decode(legacy_token), 1)
+            self.assertEqual(id_cipher.get_key_usage()['']['decodes'], 1)
+
+
+class SettingsTests(TestCase):
+
+    def test_settings_reload_on_change(self):
+        """
+        Settings, the default cipher and the serializer lookup field should follow
+        changes to ENCRYPTED_LOOKUP.
+        """
+        encoded = id_cipher.encode(1)
+        changed = dict(settings.ENCRYPTED_LOOKUP, secret_key="other secret", lookup_field_name='pk')
+
+        with override_settings(ENCRYPTED_LOOKUP=changed):
+            self.assertEqual(encrypted_lookup_settings['secret_key'], "other secret")
+            self.assertEqual(EncryptedLookupModelSerializer.lookup_field, 'pk')
+            self.assertNotEqual(id_cipher.encode(1), encoded)
+            self.assertEqual(id_cipher.encode(1), IDCipher(secret="other secret").encode(1))
+
+        self.assertEqual(EncryptedLookupModelSerializer.lookup_field,
+                         settings.ENCRYPTED_LOOKUP['lookup_field_name'])
+        self.assertEqual(id_cipher.encode(1), encoded)
+
+    def test_settings_validated_on_access(self):
+        """
+        Invalid settings should raise AttributeError when first read.
+        """
+        with override_settings(ENCRYPTED_LOOKUP={'secret_key': "secret", 'unknown': True}):
+            with self.assertRaises(AttributeError):
+                encrypted_lookup_settings['secret_key']
+
+        with override_settings(ENCRYPTED_LOOKUP={'lookup_field_name': 'id'}):
+            with self.assertRaises(AttributeError):
+                IDCipher()
+
+
+class NamespaceTests(TestCase):
+
+    def setUp(self):
+        namespaced = dict(settings.ENCRYPTED_LOOKUP, model_namespaces=True)
+        self.settings_override = override_settings(ENCRYPTED_LOOKUP=namespaced)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_model_ciphers(self):
+        """
+        Each model should have its own cipher, built once.
+        """
+        cipher = id_cipher_registry.get_for_model(DummyModel)
+        related_cipher = id_cipher_registry.get_for_model(DummyModel0)
+
+        self.assertIs(cipher, id_cipher_registry.get_for_model(DummyModel))
+        self.assertNotEqual(cipher.encode(1), related_cipher.encode(1))
+        self.assertNotEqual(cipher.encode(1), id_cipher.encode(1))
+
+        # Assert that a token for the wrong model is rejected by decoding alone
+        with self.assertRaises(ValueError):
+            cipher.decode(related_cipher.encode(1))
+
+    def test_serializer_namespaces(self):
+        """
+        Serializers should encrypt their own and related lookups with the matching model's cipher.
+        """
+        objects = [DummyModel(pk=i, related_id=i + 100) for i in range(3)]
+        expected = [
+            {
+                'id': id_cipher_registry.get_for_model(DummyModel).encode(obj.pk),
+                'related': id_cipher_registry.get_for_model(DummyModel0).encode(obj.related_id),
+            }
+            for obj in objects
+        ]
+
+        self.assertEqual(expected, [dict(DummySerializer(obj).data) for obj in objects])
+        data = DummySerializer(objects, many=True).data
+        self.assertEqual(expected, [dict(item) for item in data])
+
+    def test_wrong_model_token(self):
+        """
+        Related fields and views should reject another model's token.
+        """
+        field = EncryptedLookupRelatedField(queryset=dummy_queryset)
+        field.bind("field_name", DummySerializer())
+        wrong_token = id_cipher_registry.get_for_model(DummyModel0).encode(1)
+
+        lookup = json.dumps(field.to_representation(dummy_objects[1]))
+        self.assertEqual(dummy_objects[1], field.to_internal_value(lookup))
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value(json.dumps(wrong_token))
+
+        view = DummyView.as_view({'get': 'retrieve', })
+        request = factory.get('/' + wrong_token, format='json')
+        with self.assertRaises(Http404):
+            view(request, pk=wrong_token)
+
 
 class FieldTests(TestCase):
 
@@ -107,6 +740,26 @@ class FieldTests(TestCase):
         # representation of an integer value.
         self.assertEqual(id_cipher.encode(1), field.to_representation(1))
 
+        class Row(object):
+            field_name = 1
+
+        # Assert that EncryptedLookupField.get_attribute reads instances which are not models
+        self.assertEqual(1, field.get_attribute(Row()))
+
+    def test_queryset_without_model(self):
+        """
+        A related field whose queryset has no model should use its serializer's cipher.
+        """
+        class ListQueryset(object):
+            def get(self, pk):
+                return dummy_objects[pk]
+
+        field = EncryptedLookupRelatedField(queryset=ListQueryset())
+        field.bind("field_name", DummySerializer())
+
+        self.assertEqual(id_cipher.encode(1), field.to_representation(dummy_objects[1]))
+        self.assertEqual(dummy_objects[1], field.to_internal_value(json.dumps(id_cipher.encode(1))))
+
     def test_encrypted_lookup_related_field(self):
 
         dummy_object = dummy_queryset.get(pk=1)
@@ -118,6 +771,48 @@ class FieldTests(TestCase):
         # Assert that to_internal_value and to_representation are inverse functions
         self.assertEqual(dummy_object, field.to_internal_value(json.dumps(field.to_representation(dummy_object))))
 
+        # Assert that a lookup which is not a token is reported as such
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value(5)
+
+        class BrokenQueryset(DummyQueryset):
+            def get(self, pk):
+                raise AttributeError("misconfigured")
+
+        # Assert that the field's own errors are not reported as bad lookups
+        field = EncryptedLookupRelatedField(queryset=BrokenQueryset())
+        field.bind("field_name", serializer)
+        with self.assertRaises(AttributeError):
+            field.to_internal_value(json.dumps(id_cipher.encode(1)))
+
+    def test_encrypted_lookup_many_related_field(self):
+
+        field = EncryptedLookupRelatedField(queryset=dummy_queryset, many=True)
+        serializer = DummySerializer()
+        field.bind("field_name", serializer)
+
+        # Assert that many=True produces our batch-resolving field
+        self.assertIsInstance(field, EncryptedLookupManyRelatedField)
+
+        lookups = [json.dumps(id_cipher.encode(i)) for i in (3, 1, 3)]
+
+        # Assert that lookups resolve to objects in order, with a single query
+        queries = []
+        original_filter = dummy_queryset.filter
+        dummy_queryset.filter = \
+            lambda pk__in: queries.append(pk__in) or original_filter(pk__in=pk__in)
+        try:
+            self.assertEqual([dummy_objects[3], dummy_objects[1], dummy_objects[3]],
+                             field.to_internal_value(lookups))
+        finally:
+            del dummy_queryset.filter
+        self.assertEqual([set([1, 3])], queries)
+
+        # Assert that every malformed or missing lookup is reported together
+        with self.assertRaises(serializers.ValidationError) as context:
+            field.to_internal_value([json.dumps(id_cipher.encode(100)), lookups[0], "1", 5])
+        self.assertEqual(3, len(context.exception.detail))
+
     def test_encrypted_lookup_hyperlinked_related_field(self):
 
         dummy_object = dummy_queryset.get(pk=1)
@@ -144,6 +839,146 @@ class FieldTests(TestCase):
         # Assert that DRF's to_internal_value makes use of our decryption methods
         self.assertEqual(dummy_object, field.to_internal_value("https://test/" + id_cipher.encode(1) + '/'))
 
+    def test_encrypted_lookup_hyperlinked_many_related_field(self):
+
+        queries = []
+
+        class CountingQueryset(DummyQueryset):
+            def filter(self, pk__in):
+                queries.append(sorted(pk__in))
+                return super(CountingQueryset, self).filter(pk__in)
+
+        field = EncryptedLookupHyperlinkedRelatedField("viewname", queryset=CountingQueryset(),
+                                                       many=True)
+        serializer = DummySerializer(context={'request': factory.get('/')})
+        field.bind("field_name", serializer)
+
+        # Assert that many=True produces our batch-resolving field
+        self.assertIsInstance(field, EncryptedLookupHyperlinkedManyRelatedField)
+
+        urls = field.to_representation(dummy_objects[:3])
+        self.assertTrue(urls[0].startswith('http://testserver/'))
+
+        # Assert that absolute and relative hyperlinks resolve in one query
+        lookups = urls[:2] + ['/%s/' % id_cipher.encode(2)]
+        self.assertEqual(dummy_objects[:3], field.to_internal_value(lookups))
+        self.assertEqual([[0, 1, 2]], queries)
+
+        # Assert that every bad hyperlink is reported together
+        with self.assertRaises(serializers.ValidationError) as context:
+            field.to_internal_value(
+                [urls[0], 'http://testserver/', '/%s/' % id_cipher.encode(100), '/abc/', 5])
+        self.assertEqual(4, len(context.exception.detail))
+
+    @override_settings(ALLOWED_HOSTS=['testserver', 'other.test'])
+    def test_encrypted_lookup_hyperlinked_url_template(self):
+        """
+        get_url should reverse each URL pattern once, and give the URLs reverse() gives.
+        """
+        field = EncryptedLookupHyperlinkedRelatedField("viewname", queryset=dummy_queryset)
+        field.bind("field_name", DummySerializer())
+
+        reversed_urls = []
+
+        def counting_reverse(*args, **kwargs):
+            reversed_urls.append(drf_reverse(*args, **kwargs))
+            return reversed_urls[-1]
+
+        for request in (factory.get('/'), factory.get('/', HTTP_HOST='other.test')):
+            expected = [
+                drf_reverse("viewname", kwargs={'pk': id_cipher.encode(obj.pk)}, request=request)
+                for obj in dummy_objects
+            ]
+
+            field.reverse = counting_reverse
+            self.assertEqual(expected, [field.get_url(obj, "viewname", request, None)
+                                        for obj in dummy_objects])
+
+        self.assertEqual(2, len(reversed_urls))
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        self.sink = MemorySink()
+        instrumented = dict(settings.ENCRYPTED_LOOKUP, cache_size=10,
+                            instrumentation_sinks=[self.sink])
+        self.settings_override = override_settings(ENCRYPTED_LOOKUP=instrumented)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_disabled(self):
+        self.settings_override.disable()
+        try:
+            # Assert that without sinks the cipher is not wrapped
+            # pylint: disable=protected-access
+            self.assertNotIsInstance(id_cipher._wrapped if id_cipher.encode(1) else None,
+                                     InstrumentedIDCipher)
+        finally:
+            self.settings_override.enable()
+
+    def test_cipher_metrics(self):
+        token = id_cipher.encode(1)
+        id_cipher.encode(1)
+        # Assert that the batch methods take any iterable
+        tokens = id_cipher.encode_many(this_id for this_id in (2, 3))
+        self.assertEqual([2, 3], id_cipher.decode_many(token for token in tokens))
+        for junk in ('junk', IDCipher(secret="other").encode(1)):
+            with self.assertRaises(ValueError):
+                id_cipher.decode(junk)
+        self.assertEqual(1, id_cipher.decode(token))
+
+        stats = self.sink.get_stats()
+
+        # Assert that ids, failures and cache lookups are counted
+        self.assertEqual(4, stats['counters']['encode'])
+        self.assertEqual(3, stats['counters']['decode'])
+        self.assertEqual(2, stats['counters']['decode_failure'])
+        # Encoding an id primes the decode cache with its token
+        self.assertEqual(4, stats['counters']['cache_hit'])
+
+        # Assert that each call is timed, once, in one bucket
+        counts = (('encode', 2), ('encode_many', 1), ('decode', 3), ('decode_many', 1))
+        for operation, count in counts:
+            self.assertEqual(count, stats['timings'][operation]['count'])
+            buckets = stats['timings'][operation]['buckets']
+            self.assertEqual(count, sum(bucket for _, bucket in buckets))
+
+    def test_field_metrics(self):
+        field = EncryptedLookupRelatedField(queryset=dummy_queryset)
+        field.bind("field_name", DummySerializer())
+        self.assertEqual(dummy_objects[1], field.to_internal_value(json.dumps(id_cipher.encode(1))))
+
+        hyperlinked_field = EncryptedLookupHyperlinkedRelatedField("viewname", read_only=True)
+        hyperlinked_field.bind("field_name", DummySerializer())
+        hyperlinked_field.get_url(dummy_objects[1], "viewname", factory.get('/'), None)
+
+        stats = self.sink.get_stats()
+        self.assertEqual(1, stats['counters']['related_query'])
+        self.assertEqual(1, stats['counters']['hyperlink'])
+        self.assertEqual(1, stats['timings']['hyperlink']['count'])
+
+    def test_signal_sink(self):
+        metrics = []
+
+        def receiver(sender, **kwargs):  # pylint: disable=unused-argument
+            metrics.append((kwargs['kind'], kwargs['name'], kwargs['value']))
+
+        metric_recorded.connect(receiver)
+        try:
+            sinks = ['rest_framework_encrypted_lookup.instrumentation.SignalSink']
+            with override_settings(ENCRYPTED_LOOKUP=dict(settings.ENCRYPTED_LOOKUP, cache_size=0,
+                                                         instrumentation_sinks=sinks)):
+                id_cipher.encode(1)
+        finally:
+            metric_recorded.disconnect(receiver)
+
+        self.assertEqual([('timing', 'encode'), ('increment', 'encode')],
+                         [metric[:2] for metric in metrics])
+        self.assertEqual(1, metrics[1][2])
+
 
 class SerializerTests(TestCase):
 
@@ -167,6 +1002,156 @@ class SerializerTests(TestCase):
         # Assert that our related field is an encrypted lookup related field
         self.assertIsInstance(serializer.get_fields()['related'], EncryptedLookupHyperlinkedRelatedField)
 
+    def test_list_serializer_batch_encryption(self):
+        objects = [DummyModel(pk=i, related_id=i + 100) for i in range(5)]
+
+        serializer = DummySerializer(objects, many=True)
+
+        # Assert that many=True produces our batch-encrypting list serializer
+        self.assertIsInstance(serializer, EncryptedLookupListSerializer)
+
+        calls = []
+
+        class CountingCipher(IDCipher):
+            def encode(self, this_id):
+                calls.append(('encode', this_id))
+                return super(CountingCipher, self).encode(this_id)
+
+            def encode_many(self, ids):
+                calls.append(('encode_many', sorted(ids)))
+                return super(CountingCipher, self).encode_many(ids)
+
+        cipher = CountingCipher()
+        serializer.child.get_cipher = lambda: cipher
+
+        # Assert that the batch representation matches the per-item representation
+        self.assertEqual([DummySerializer(obj).data for obj in objects], serializer.data)
+
+        # Assert that every pk and related pk was encrypted in one batch
+        self.assertEqual([('encode_many', list(range(5)) + list(range(100, 105)))], calls)
+
+    def test_list_serializer_many_related_batch_encryption(self):
+        targets = [DummyModel0.objects.create() for _ in range(3)]
+        for count in range(3):
+            DummyManyModel.objects.create().targets.add(*targets[:count + 1])
+
+        queryset = DummyManyModel.objects.prefetch_related('targets').order_by('pk')
+        serializer = DummyManySerializer(queryset, many=True)
+
+        calls = []
+
+        class CountingCipher(IDCipher):
+            def encode(self, this_id):
+                calls.append(('encode', this_id))
+                return super(CountingCipher, self).encode(this_id)
+
+            def encode_many(self, ids):
+                calls.append(('encode_many', sorted(ids)))
+                return super(CountingCipher, self).encode_many(ids)
+
+        cipher = CountingCipher()
+        serializer.child.get_cipher = lambda: cipher
+
+        # Assert that the batch representation matches the per-item representation
+        data = serializer.data
+        self.assertEqual([DummyManySerializer(obj).data for obj in queryset], data)
+
+        # Assert that prefetched many-related pks were encrypted in the same batch as the pks
+        ids = [obj.pk for obj in queryset] + [target.pk for target in targets]
+        self.assertEqual([('encode_many', sorted(set(ids)))], calls)
+
+    def test_list_serializer_iter_representation(self):
+        objects = [DummyModel(pk=i, related_id=i + 100) for i in range(5)]
+        serializer = DummySerializer(objects, many=True)
+
+        calls = []
+
+        class CountingCipher(IDCipher):
+            def encode_many(self, ids):
+                calls.append(sorted(ids))
+                return super(CountingCipher, self).encode_many(ids)
+
+        cipher = CountingCipher()
+        serializer.child.get_cipher = lambda: cipher
+        representations = serializer.iter_representation(objects, 2)
+
+        # Assert that nothing is represented until the first item is asked for
+        self.assertEqual([], calls)
+
+        # Assert that streamed items match the list representation
+        self.assertEqual([DummySerializer(obj).data for obj in objects], list(representations))
+
+        # Assert that each chunk's pks and related pks were encrypted in one batch
+        self.assertEqual([[0, 1, 100, 101], [2, 3, 102, 103], [4, 104]], calls)
+        self.assertIsNone(serializer.child.batch_ciphers)
+
+    def test_field_layout_cache(self):
+        builds = []
+
+        class CountingSerializer(EncryptedLookupModelSerializer):
+            cache_fields = True
+
+            class Meta:
+                model = User
+                fields = ['id', 'username', 'groups']
+
+            def build_fields(self):
+                builds.append(list(self.Meta.fields))
+                return super(CountingSerializer, self).build_fields()
+
+        first, second = CountingSerializer(), CountingSerializer()
+
+        # Assert that the fields are built once per class, and copied for each instance
+        self.assertEqual(['id', 'username', 'groups'], list(first.fields))
+        self.assertEqual(list(first.fields), list(second.fields))
+        self.assertEqual(1, len(builds))
+        self.assertIsInstance(second.fields['id'], EncryptedLookupField)
+        self.assertIsNot(first.fields['username'], second.fields['username'])
+        self.assertIs(second, second.fields['username'].parent)
+
+        # Assert that stateful validators are not shared between instances
+        validator_ids = set(id(validator) for validator in first.fields['username'].validators)
+        validators = second.fields['username'].validators
+        self.assertFalse(validator_ids & set(id(validator) for validator in validators))
+
+        # Assert that changing Meta rebuilds the fields
+        CountingSerializer.Meta.fields.remove('groups')
+        self.assertEqual(['id', 'username'], list(CountingSerializer().fields))
+        self.assertEqual(2, len(builds))
+
+        # Assert that changing the settings rebuilds the fields
+        options = dict(settings.ENCRYPTED_LOOKUP, lookup_field_name='username')
+        with override_settings(ENCRYPTED_LOOKUP=options):
+            fields = CountingSerializer().fields
+            self.assertIsInstance(fields['username'], EncryptedLookupField)
+            self.assertNotIsInstance(fields['id'], EncryptedLookupField)
+        self.assertEqual(3, len(builds))
+
+        # Assert that the cache can be disabled
+        CountingSerializer.cache_fields = False
+        list(CountingSerializer().fields)
+        list(CountingSerializer().fields)
+        self.assertEqual(5, len(builds))
+
+    def test_field_layout_cache_disabled(self):
+        """
+        Serializers which do not enable cache_fields should build their fields for each instance.
+        """
+        class ContextSerializer(EncryptedLookupModelSerializer):
+            class Meta:
+                model = User
+                fields = ['id', 'username', 'email']
+
+            def get_field_names(self, declared_fields, info):
+                names = super(ContextSerializer, self).get_field_names(declared_fields, info)
+                return [name for name in names if name != 'email' or self.context.get('staff')]
+
+        self.assertFalse(ContextSerializer.cache_fields)
+        self.assertEqual(['id', 'username'], list(ContextSerializer().fields))
+        self.assertEqual(['id', 'username', 'email'],
+                         list(ContextSerializer(context={'staff': True}).fields))
+        self.assertEqual(['id', 'username'], list(ContextSerializer().fields))
+
     def test_independent_by_serializer_ciphers(self):
         """
         Fields should use the cipher provided by their parent serializer.
@@ -193,6 +1178,72 @@ class SerializerTests(TestCase):
 factory = APIRequestFactory()
 
 
+class FilterTests(TestCase):
+
+    def test_filter_backend(self):
+        """
+        Encrypted lookups in query parameters should be decoded and applied as __in filters.
+        """
+        backend = EncryptedLookupFilterBackend()
+        tokens = [id_cipher.encode(i) for i in range(4)]
+
+        params = {'related': '%s,%s' % tuple(tokens[:2]), 'id__in': tokens[2], 'id': tokens[3]}
+        request = factory.get('/', params)
+        queryset = backend.filter_queryset(request, RecordingQueryset(), DummyView(request=request))
+        self.assertEqual(sorted(queryset.filters, key=sorted),
+                         [{'id__in': {2, 3}}, {'related__in': {0, 1}}])
+
+        # Assert that requests without encrypted lookups are not filtered
+        request = factory.get('/', {'other': tokens[0]})
+        queryset = backend.filter_queryset(request, RecordingQueryset(), DummyView(request=request))
+        self.assertEqual([], queryset.filters)
+
+        # Assert that malformed lookups are reported before any query
+        request = factory.get('/', {'related': '%s,abc,' % tokens[0]})
+        queryset = RecordingQueryset()
+        with self.assertRaises(serializers.ValidationError) as context:
+            backend.filter_queryset(request, queryset, DummyView(request=request))
+        self.assertEqual(['related'], list(context.exception.detail))
+        self.assertEqual([], queryset.filters)
+
+    def test_filter_fields_cache(self):
+        """
+        The filterable fields of a serializer class should be found once, across requests.
+        """
+        targets = [TokenModel.objects.create() for _ in range(2)]
+        related = [TokenRelatedModel.objects.create(target=target) for target in targets]
+        field_builds = []
+
+        class CountingSerializer(TokenRelatedSerializer):
+            def __init__(self, *args, **kwargs):
+                # Only the filter backend builds the serializer without arguments.
+                if not args and not kwargs:
+                    field_builds.append(self)
+                super(CountingSerializer, self).__init__(*args, **kwargs)
+
+        class FilteredView(EncryptedLookupGenericViewSet, viewsets.mixins.ListModelMixin):
+            queryset = TokenRelatedModel.objects.order_by('pk')
+            serializer_class = CountingSerializer
+            filter_backends = (EncryptedLookupFilterBackend,)
+
+        view = FilteredView.as_view({'get': 'list'})
+        for target, obj in zip(targets, related):
+            response = view(factory.get('/', {'target': target.token}))
+            self.assertEqual([id_cipher.encode(obj.pk)], [item['id'] for item in response.data])
+
+        self.assertEqual(1, len(field_builds))
+
+    @unittest.skipIf(django_filters is None, "django-filter is not installed")
+    def test_django_filter(self):
+        lookup_filter = EncryptedLookupFilter(name='related')
+        value = '%s,%s' % (id_cipher.encode(1), id_cipher.encode(2))
+        queryset = lookup_filter.filter(RecordingQueryset(), value)
+        self.assertEqual([{'related__in': {1, 2}}], queryset.filters)
+
+        with self.assertRaises(serializers.ValidationError):
+            lookup_filter.filter(RecordingQueryset(), 'abc')
+
+
 class ViewTests(TestCase):
 
     def test_view_dispatch_decryption(self):
@@ -206,6 +1257,517 @@ class ViewTests(TestCase):
         response = view(request, pk=IDCipher().encode(1)).render()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_view_cipher_resolution(self):
+        """
+        Views should resolve their cipher without a serializer, unless the serializer provides its
+        own.
+        """
+
+        class NoSerializerView(DummyView):
+            def get_serializer(self, *args, **kwargs):
+                raise AssertionError("The serializer should not be built.")
+
+        self.assertIs(NoSerializerView().get_cipher(), id_cipher)
+
+        class CustomCipherSerializer(DummySerializer):
+            def get_cipher(self):
+                return IDCipher(secret=self.context['secret'])
+
+        class CustomCipherView(DummyView):
+            serializer_class = CustomCipherSerializer
+
+            def get_serializer_context(self):
+                return {'secret': "custom"}
+
+        self.assertEqual(CustomCipherView().get_cipher().encode(1),
+                         IDCipher(secret="custom").encode(1))
+
+    def test_view_decoded_lookup(self):
+        """
+        Lookups which were already decoded should be passed through dispatch.
+        """
+        view = DummyView.as_view({'get': 'retrieve', })
+        request = factory.get('/1', format='json')
+
+        response = view(request, pk=1).render()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['id'], id_cipher.encode(1))
+
+    def test_router_lookup_regex(self):
+        """
+        Routed detail URLs should match only well-formed tokens.
+        """
+        router = SimpleRouter()
+        router.register(r'dummies', DummyView, 'dummy')
+        detail = [pattern for pattern in router.urls if pattern.name == 'dummy-detail'][0]
+        regex = getattr(detail, 'pattern', detail).regex
+
+        match = regex.match('dummies/%s/' % id_cipher.encode(1))
+        self.assertEqual(match.group('pk'), id_cipher.encode(1))
+        for junk in ('1', 'not-a-token', '%s!' % id_cipher.encode(1)):
+            self.assertIsNone(regex.match('dummies/%s/' % junk))
+
+    def test_streaming_list(self):
+
+        class StreamingDummyView(EncryptedLookupStreamingListMixin, DummyView):
+            stream_chunk_size = 3
+
+        expected = [DummySerializer(obj).data for obj in dummy_objects]
+
+        response = StreamingDummyView.as_view({'get': 'list'})(factory.get('/'))
+        self.assertTrue(response.streaming)
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertEqual(expected, json.loads(b''.join(response.streaming_content).decode('utf-8')))
+
+        StreamingDummyView.stream_format = 'jsonl'
+        response = StreamingDummyView.as_view({'get': 'list'})(factory.get('/'))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(expected, [json.loads(line) for line in lines])
+
+    def test_streaming_queryset(self):
+
+        class UserSerializer(EncryptedLookupModelSerializer):
+            class Meta:
+                model = User
+                fields = ('id', 'username')
+
+        class StreamingUserView(EncryptedLookupStreamingListMixin, EncryptedLookupGenericViewSet):
+            queryset = User.objects.order_by('id')
+            serializer_class = UserSerializer
+            stream_chunk_size = 2
+
+        users = [User.objects.create(username='user%d' % i) for i in range(5)]
+        response = StreamingUserView.as_view({'get': 'list'})(factory.get('/'))
+
+        # Assert that the queryset is read in a single query, as the response is consumed
+        with self.assertNumQueries(1):
+            content = b''.join(response.streaming_content).decode('utf-8')
+        expected = [{'id': id_cipher.encode(user.pk), 'username': user.username} for user in users]
+        self.assertEqual(expected, json.loads(content))
+
+    def test_converter(self):
+        converter = EncryptedLookupConverter()
+        token = id_cipher.encode(1)
+
+        self.assertTrue(re.match('^%s$' % converter.regex, token))
+        self.assertEqual(converter.to_python(token), 1)
+        self.assertEqual(converter.to_url(1), token)
+        self.assertEqual(converter.to_url(token), token)
+        with self.assertRaises(ValueError):
+            converter.to_python(IDCipher(secret="other").encode(1))
+
+
+class CommandTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_command(self, operation, text, **options):
+        input_path = os.path.join(self.directory, 'input')
+        output_path = os.path.join(self.directory, 'output')
+        with open(input_path, 'w') as input_file:
+            input_file.write(text)
+
+        stderr = six.StringIO()
+        call_command('encrypted_lookup', operation, input_path, output=output_path, stderr=stderr,
+                     **options)
+
+        with open(output_path) as output_file:
+            return output_file.read(), stderr.getvalue()
+
+    def test_lines(self):
+        ids = list(range(100))
+        text = ''.join('%d\n' % i for i in ids) + '\n'
+
+        for workers in (1, 2):
+            encoded, report = self.run_command('encode', text, workers=workers, chunk_size=7)
+
+            # Assert that every id is encoded in order, and that blank lines are kept
+            self.assertEqual(id_cipher.encode_many(ids) + [''], encoded.splitlines())
+            self.assertIn('Encoded 101 values', report)
+
+            # Assert that decoding restores the input
+            decoded, _ = self.run_command('decode', encoded, workers=workers, chunk_size=7)
+            self.assertEqual(text, decoded)
+
+    def test_csv(self):
+        text = 'name,id\nfirst,1\nsecond,2\n'
+        encoded, _ = self.run_command('encode', text, format='csv', workers=1)
+        expected = 'name,id\nfirst,%s\nsecond,%s\n' % (id_cipher.encode(1), id_cipher.encode(2))
+        self.assertEqual(expected, encoded)
+
+        # Assert that a header without rows is kept, and that a missing column is an error
+        encoded, _ = self.run_command('encode', 'name,id\n', format='csv', workers=1)
+        self.assertEqual('name,id\n', encoded)
+        with self.assertRaises(CommandError):
+            self.run_command('encode', text, format='csv', field='pk', workers=1)
+
+    def test_jsonl_invalid_values(self):
+        text = '\n'.join(json.dumps({'id': token, 'name': 'row'}) for token in
+                         (id_cipher.encode(1), 'junk', IDCipher(secret="other").encode(2)))
+
+        decoded, report = self.run_command('decode', text, format='jsonl', workers=2, chunk_size=2)
+
+        # Assert that ids are decoded as integers, and that values which cannot be decoded are
+        # emptied and reported
+        expected = [{'id': 1, 'name': 'row'}, {'id': '', 'name': 'row'}, {'id': '', 'name': 'row'}]
+        self.assertEqual(expected, [json.loads(line) for line in decoded.splitlines()])
+        self.assertIn('2 values could not be decoded', report)
+
+    def test_uuid_model(self):
+        uuids = [str(uuid.uuid4()) for _ in range(5)]
+        label = 'rest_framework_encrypted_lookup.UUIDModel'
+
+        for workers in (1, 2):
+            encoded, _ = self.run_command('encode', '\n'.join(uuids), model=label, workers=workers,
+                                          chunk_size=2)
+
+            # Assert that UUIDs are encoded with the model's cipher, and decoded back to text
+            cipher = id_cipher_registry.get_for_model(UUIDModel)
+            self.assertEqual(cipher.encode_many(uuids), encoded.splitlines())
+            decoded, _ = self.run_command('decode', encoded, model=label, workers=workers)
+            self.assertEqual(uuids, decoded.splitlines())
+
+
+class StoredTokenTests(TestCase):
+
+    def setUp(self):
+        self.targets = [TokenModel.objects.create(name='target%d' % i) for i in range(3)]
+        self.related = [TokenRelatedModel.objects.create(target=target) for target in self.targets]
+
+    def count_cipher_work(self, function):
+        """
+        :return: the result of function, and the number of ids it encoded or decoded
+        """
+        sink = MemorySink()
+        options = dict(settings.ENCRYPTED_LOOKUP, instrumentation_sinks=[sink])
+        with override_settings(ENCRYPTED_LOOKUP=options):
+            result = function()
+
+        counters = sink.get_stats()['counters']
+        return result, counters.get('encode', 0) + counters.get('decode', 0)
+
+    def test_token_stored_on_save(self):
+        for obj in self.targets:
+            self.assertEqual(id_cipher.encode(obj.pk), obj.token)
+            self.assertEqual(obj.token, TokenModel.objects.get(pk=obj.pk).token)
+
+        # Assert that a row with a pk gets its token without another query
+        with self.assertNumQueries(1):
+            TokenModel.objects.create(pk=100)
+        self.assertEqual(id_cipher.encode(100), TokenModel.objects.get(pk=100).token)
+
+    def test_backfill_command(self):
+        label = 'rest_framework_encrypted_lookup.TokenModel'
+        pks = [self.targets[0].pk, self.targets[2].pk]
+        TokenModel.objects.filter(pk__in=pks).update(token=None)
+
+        stdout = six.StringIO()
+        call_command('encrypted_lookup_backfill', label, batch_size=1, stdout=stdout)
+        self.assertIn('Stored 2 tokens', stdout.getvalue())
+        self.assertEqual(dict((obj.pk, id_cipher.encode(obj.pk)) for obj in self.targets),
+                         dict(TokenModel.objects.values_list('pk', 'token')))
+
+        # Assert that every token is recomputed under new settings
+        options = dict(settings.ENCRYPTED_LOOKUP, secret_key="other")
+        with override_settings(ENCRYPTED_LOOKUP=options):
+            call_command('encrypted_lookup_backfill', label, all=True, stdout=stdout)
+            self.assertEqual(dict((obj.pk, id_cipher.encode(obj.pk)) for obj in self.targets),
+                             dict(TokenModel.objects.values_list('pk', 'token')))
+
+        with self.assertRaises(CommandError):
+            call_command('encrypted_lookup_backfill', 'auth.User', stdout=stdout)
+
+    def test_representation(self):
+        expected = [{'id': id_cipher.encode(obj.pk), 'target': id_cipher.encode(obj.target_id)}
+                    for obj in self.related]
+
+        # Assert that stored tokens are presented without cipher work, given the related objects
+        queryset = TokenRelatedModel.objects.select_related('target').order_by('pk')
+        data, work = self.count_cipher_work(
+            lambda: TokenRelatedSerializer(queryset, many=True).data)
+        self.assertEqual(expected, data)
+        self.assertEqual(0, work)
+
+        # Assert that related objects which were not loaded are presented by their encrypted pk
+        queryset = TokenRelatedModel.objects.order_by('pk')
+        data, work = self.count_cipher_work(
+            lambda: TokenRelatedSerializer(queryset, many=True).data)
+        self.assertEqual(expected, data)
+        self.assertEqual(len(self.related), work)
+
+    def test_related_field_lookup(self):
+        field = EncryptedLookupRelatedField(queryset=TokenModel.objects.all())
+        field.bind('target', TokenRelatedSerializer())
+        target = self.targets[1]
+
+        # Assert that a stored token is looked up without decoding it
+        lookup = json.dumps(target.token)
+        obj, work = self.count_cipher_work(lambda: field.to_internal_value(lookup))
+        self.assertEqual(target, obj)
+        self.assertEqual(0, work)
+
+        # Assert that a token which is not stored yet is decoded
+        TokenModel.objects.filter(pk=target.pk).update(token=None)
+        self.assertEqual(target, field.to_internal_value(json.dumps(id_cipher.encode(target.pk))))
+
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value(json.dumps(id_cipher.encode(1000)))
+
+    def test_view_lookup(self):
+        view = TokenView.as_view({'get': 'retrieve'})
+        target = self.targets[1]
+
+        # Assert that the object is found by its stored token, without decoding it
+        response, work = self.count_cipher_work(
+            lambda: view(factory.get('/'), pk=target.token).render())
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'id': target.token, 'name': target.name},
+                         json.loads(response.content.decode('utf-8')))
+        self.assertEqual(0, work)
+
+        # Assert that a token which is not stored yet is decoded
+        TokenModel.objects.filter(pk=target.pk).update(token=None)
+        response = view(factory.get('/'), pk=id_cipher.encode(target.pk)).render()
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        for junk in ('junk', IDCipher(secret="other").encode(target.pk), id_cipher.encode(1000)):
+            self.assertEqual(status.HTTP_404_NOT_FOUND, view(factory.get('/'), pk=junk).status_code)
+
+    def test_view_kwargs_before_get_object(self):
+        seen = []
+
+        class RecordingPermission(object):
+            def has_permission(self, request, view):
+                seen.append(view.kwargs['pk'])
+                return True
+
+            def has_object_permission(self, request, view, obj):
+                return True
+
+        class RecordingView(TokenView):
+            permission_classes = (RecordingPermission,)
+
+        class DecodingView(RecordingView):
+            def get_token_field(self):
+                return None
+
+        target = self.targets[1]
+        for view_class in (RecordingView, DecodingView):
+            response = view_class.as_view({'get': 'retrieve'})(factory.get('/'), pk=target.token)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        # Assert that permission checks see the token, unless the view opts out of token lookups
+        self.assertEqual([target.token, target.pk], seen)
+
+
+class KeyTypeTests(TestCase):
+
+    def setUp(self):
+        self.targets = [UUIDModel.objects.create(name='target%d' % i) for i in range(3)]
+
+    def test_key_type_detection(self):
+        cipher = id_cipher_registry.get_for_model(UUIDModel)
+
+        # Assert that UUID pks get a cipher of their own key type, built once, and integer pks
+        # id_cipher
+        self.assertEqual('uuid', get_key_type(UUIDModel))
+        self.assertEqual('uuid', cipher.key_type)
+        self.assertIs(cipher, id_cipher_registry.get_for_model(UUIDModel))
+        self.assertIs(id_cipher, id_cipher_registry.get_for_model(DummyModel))
+
+        # Assert that a UUID token has the length of a single-block integer token
+        self.assertEqual(len(id_cipher.encode(1)), len(cipher.encode(self.targets[0].pk)))
+
+        options = dict(settings.ENCRYPTED_LOOKUP, model_namespaces=True)
+        with override_settings(ENCRYPTED_LOOKUP=options):
+            self.assertEqual('uuid', id_cipher_registry.get_for_model(UUIDModel).key_type)
+
+    def test_related_field(self):
+        cipher = id_cipher_registry.get_for_model(UUIDModel)
+        related = [UUIDRelatedModel.objects.create(target=target) for target in self.targets]
+
+        # Assert that related UUIDs are encrypted with the UUID cipher, singly and in batches
+        expected = [{'id': id_cipher.encode(obj.pk), 'target': cipher.encode(obj.target_id)}
+                    for obj in related]
+        self.assertEqual(expected, [dict(UUIDRelatedSerializer(obj).data) for obj in related])
+        data = UUIDRelatedSerializer(related, many=True).data
+        self.assertEqual(expected, [dict(item) for item in data])
+
+        field = EncryptedLookupRelatedField(queryset=UUIDModel.objects.all())
+        field.bind('target', UUIDRelatedSerializer())
+        lookup = json.dumps(cipher.encode(self.targets[1].pk))
+        self.assertEqual(self.targets[1], field.to_internal_value(lookup))
+
+        lookup = json.dumps(cipher.encode(self.targets[2].pk))
+        serializer = UUIDRelatedSerializer(data={'target': lookup})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(self.targets[2], serializer.validated_data['target'])
+
+    def test_hyperlinked_many_related_field(self):
+        field = EncryptedLookupHyperlinkedRelatedField("viewname", queryset=UUIDModel.objects.all(),
+                                                       many=True)
+        field.bind('targets', UUIDRelatedSerializer(context={'request': factory.get('/')}))
+
+        # Assert that hyperlinks to UUID pks resolve through the route template
+        urls = field.to_representation(self.targets)
+        self.assertEqual(self.targets, field.to_internal_value(urls))
+        self.assertIsNotNone(field.child_relation.get_route_template("viewname"))
+
+        # Assert that a hyperlink with an integer token is a validation error
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value(['/%s/' % id_cipher.encode(1)])
+
+    def test_view_lookup(self):
+        view = UUIDView.as_view({'get': 'retrieve'})
+        target = self.targets[1]
+        token = id_cipher_registry.get_for_model(UUIDModel).encode(target.pk)
+
+        response = view(factory.get('/'), pk=token).render()
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'id': token, 'name': target.name},
+                         json.loads(response.content.decode('utf-8')))
+
+        # Assert that an integer token matches no UUID
+        response = view(factory.get('/'), pk=id_cipher.encode(1))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+@unittest.skipIf(django.VERSION < (3, 1), "asynchronous views require Django 3.1")
+class AsyncTests(TransactionTestCase):
+    """
+    Blocking work runs in executor threads, so these tests commit their data.
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.cipher = id_cipher_registry.get_for_model(UUIDModel)
+        self.targets = [UUIDModel.objects.create(name='target%d' % i) for i in range(3)]
+
+        class AsyncUUIDRelatedSerializer(AsyncEncryptedLookupModelSerializer):
+            class Meta:
+                model = UUIDRelatedModel
+                fields = ('id', 'target')
+
+        class AsyncUUIDView(AsyncRetrieveModelMixin, AsyncListModelMixin,
+                            AsyncEncryptedLookupGenericViewSet):
+            queryset = UUIDModel.objects.order_by('name')
+            serializer_class = UUIDSerializer
+
+        class AsyncUUIDRelatedView(AsyncCreateModelMixin, AsyncEncryptedLookupGenericViewSet):
+            queryset = UUIDRelatedModel.objects.all()
+            serializer_class = AsyncUUIDRelatedSerializer
+
+        self.serializer_class = AsyncUUIDRelatedSerializer
+        self.view_class = AsyncUUIDView
+        self.related_view_class = AsyncUUIDRelatedView
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_retrieve(self):
+        view = self.view_class.as_view({'get': 'retrieve'})
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        self.assertTrue(view.csrf_exempt)
+
+        # Assert that concurrent requests each find their object
+        responses = self.run_async(asyncio.gather(*[
+            view(factory.get('/'), pk=self.cipher.encode(target.pk)) for target in self.targets
+        ]))
+        expected = [{'id': self.cipher.encode(target.pk), 'name': target.name}
+                    for target in self.targets]
+        self.assertEqual(expected, [json.loads(response.render().content.decode('utf-8'))
+                                    for response in responses])
+
+        # Assert that a missing object is a 404 response, and a malformed lookup a 404 error
+        response = self.run_async(view(factory.get('/'), pk=self.cipher.encode(uuid.uuid4())))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        with self.assertRaises(Http404):
+            self.run_async(view(factory.get('/'), pk='junk'))
+
+    def test_asgi_request(self):
+        """
+        Requests through Django's ASGI handler should be served by the coroutine views.
+        """
+        router = SimpleRouter()
+        router.register(r'uuids', self.view_class)
+
+        class URLConf(object):
+            urlpatterns = router.urls
+
+        client = AsyncClient()
+        target = self.targets[0]
+        with self.settings(ROOT_URLCONF=URLConf):
+            response = self.run_async(client.get('/uuids/%s/' % self.cipher.encode(target.pk)))
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual({'id': self.cipher.encode(target.pk), 'name': target.name},
+                             json.loads(response.content.decode('utf-8')))
+
+            response = self.run_async(client.get('/uuids/'))
+            self.assertEqual(len(self.targets), len(json.loads(response.content.decode('utf-8'))))
+
+            response = self.run_async(client.get('/uuids/junk/'))
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_list(self):
+        view = self.view_class.as_view({'get': 'list'})
+        response = self.run_async(view(factory.get('/'))).render()
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        expected = [{'id': self.cipher.encode(target.pk), 'name': target.name}
+                    for target in self.targets]
+        self.assertEqual(expected, json.loads(response.content.decode('utf-8')))
+
+    def test_create(self):
+        view = self.related_view_class.as_view({'post': 'create'})
+        target = self.targets[1]
+
+        data = {'target': json.dumps(self.cipher.encode(target.pk))}
+        response = self.run_async(view(factory.post('/', data, format='json')))
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(target, UUIDRelatedModel.objects.get().target)
+
+        response = self.run_async(view(factory.post('/', {'target': 'junk'}, format='json')))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_related_resolution(self):
+        target = self.targets[2]
+        lookup = json.dumps(self.cipher.encode(target.pk))
+        serializer = self.serializer_class(data={'target': lookup})
+
+        # Assert that the related object is resolved ahead of validation, which then uses it
+        self.assertTrue(self.run_async(ais_valid(serializer)))
+        self.assertEqual(target, serializer.fields['target'].resolved[1])
+        self.assertEqual(target, serializer.validated_data['target'])
+
+        lookup = json.dumps(self.cipher.encode(uuid.uuid4()))
+        serializer = self.serializer_class(data={'target': lookup})
+        self.assertFalse(self.run_async(ais_valid(serializer)))
+        self.assertIn('target', serializer.errors)
+
+    def test_many_related_field(self):
+        field = AsyncEncryptedLookupRelatedField(queryset=UUIDModel.objects.all(), many=True)
+        field.bind('targets', self.serializer_class())
+        self.assertIsInstance(field, AsyncEncryptedLookupManyRelatedField)
+
+        tokens = [json.dumps(self.cipher.encode(target.pk)) for target in reversed(self.targets)]
+        self.assertEqual(list(reversed(self.targets)),
+                         self.run_async(field.ato_internal_value(tokens)))
+
+        # Assert that every bad lookup is reported at once
+        with self.assertRaises(serializers.ValidationError) as context:
+            missing = json.dumps(self.cipher.encode(uuid.uuid4()))
+            self.run_async(field.ato_internal_value(tokens + ['junk', missing]))
+        self.assertEqual(2, len(context.exception.detail))
+
 
 class ErrorTests(TestCase):
 
@@ -1,7 +1,10 @@
-from django.conf.urls import patterns, url
+try:
+    from django.urls import re_path as url
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url
 
 dummy_view = lambda: True
 
-urlpatterns = patterns('',
+urlpatterns = [
     url(r'^(?P<pk>\w+)/', dummy_view, name="viewname"),
-)
\ No newline at end of file
+]
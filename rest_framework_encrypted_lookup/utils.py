@@ -1,30 +1,573 @@
 """
 Encryption utilities for rest_framework_encrypted_lookup
+
+The token alphabets live in .alphabets, and the cipher registry, with the
+multi-key cipher of key rotation, in .registry; their names may still be
+imported from here.
 """
-import base64
+import binascii
 import codecs
 import hashlib
+import struct
+import threading
+import uuid
+from collections import OrderedDict
 
 from Crypto.Cipher import AES
+import six
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # cryptography is only needed by CryptographyIDCipher
+    Cipher = None
 
+# pylint: disable=unused-import
+from .alphabets import (
+    ALPHABETS, LEGACY_ALPHABET, Base32Alphabet, Base62Alphabet, Base64Alphabet, RFC4648Alphabet,
+)
+from .exceptions import InvalidTokenError
+from .registry import (
+    IDCipherRegistry, LazyIDCipher, MultiKeyIDCipher, build_id_cipher, derive_secret,
+    get_key_type, id_cipher, id_cipher_registry, key_types, model_namespace, reset_id_cipher,
+)
+# pylint: enable=unused-import
 from .settings import encrypted_lookup_settings
 
 
-class IDCipher(object):
+# The errors which decoding hostile text may raise along the way. Under Python 2,
+# binascii.Error is not a ValueError, and base64 raises TypeError.
+DECODE_ERRORS = (TypeError, ValueError, binascii.Error)
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded, least-recently-used cache.
+
+    Counts hits, misses and evictions, so that the cache can be sized from
+    real traffic.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for key, marking it as recently used.
+
+        :param key:
+        :param default: the value to return if key is not cached
+        :return: the cached value, or default
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data[key] = value
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        """
+        Cache value for key, evicting the least recently used entry if the
+        cache is full.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_stats(self):
+        """
+        :return: dictionary of the cache's counters, current size and maximum size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'max_size': self.max_size,
+            }
+
+
+class BaseIDCipher(object):
+    """
+    Base class for ciphers between integer ids and string representations.
+
+    This is the interface expected of ENCRYPTED_LOOKUP['cipher_class']. Its
+    public methods are encode, decode, encode_many, decode_many and
+    get_cache_stats. Decoding malformed text raises ValueError, preferably
+    InvalidTokenError, which the shared decode methods raise. The class must
+    be constructible with no arguments, reading its configuration from the
+    ENCRYPTED_LOOKUP settings, and with a key_type argument.
+
+    A subclass supplies a block cipher, through BLOCK_SIZE, _encrypt and
+    _decrypt, and a way of packing ids into whole blocks of plain text,
+    through _pack and _unpack. Token alphabets, caching and the batch methods
+    are shared.
+
+    The key type is 'int' by default. A cipher of key type 'uuid' encodes
+    UUIDs, given as uuid.UUID or as text, and decodes to uuid.UUID. Each UUID
+    is packed as its 16 bytes, so with a 16-byte block cipher it takes exactly
+    one block. Every such block decrypts to some UUID, so malformed tokens are
+    only caught by their length and alphabet.
+    """
+
+    BLOCK_SIZE = None
+
+    # The most blocks an id may take, which bounds the length of valid tokens.
+    MAX_BLOCKS = 4
+
+    KEY_TYPES = ('int', 'uuid')
+    UUID_LENGTH = 16
+
+    def __init__(self, cache_size=None, alphabet=None, rejected_cache_size=None, key_type='int'):
+        cache_size = self._setting(cache_size, 'cache_size')
+        alphabet = self._setting(alphabet, 'alphabet')
+        rejected_cache_size = self._setting(rejected_cache_size, 'rejected_cache_size')
+
+        if alphabet not in ALPHABETS:
+            raise ValueError("Unrecognized alphabet: '%s'" % alphabet)
+
+        if key_type not in self.KEY_TYPES:
+            raise ValueError("Unrecognized key type: '%s'" % key_type)
+
+        if key_type == 'uuid' and self.UUID_LENGTH % self.BLOCK_SIZE:
+            raise ValueError("UUID keys are not a whole number of %d-byte blocks." %
+                             self.BLOCK_SIZE)
+
+        self.key_type = key_type
+
+        self.alphabet = ALPHABETS[alphabet]
+
+        # Alphabets to try, by token length, for lengths found to be valid.
+        self.token_alphabets = {}
+
+        # Longer text is rejected before its length is checked in any alphabet.
+        max_length = self.MAX_BLOCKS * self.BLOCK_SIZE
+        self.max_token_length = max(
+            alphabet.encoded_length(max_length) for alphabet in (self.alphabet, LEGACY_ALPHABET)
+        )
+
+        # Optional memoization of recently encoded ids and decoded cipher texts.
+        self.encode_cache = LRUCache(cache_size) if cache_size else None
+        self.decode_cache = LRUCache(cache_size) if cache_size else None
+
+        # Optional memory of recently rejected texts, to turn away repeats cheaply.
+        self.rejected_cache = LRUCache(rejected_cache_size) if rejected_cache_size else None
+
+    @staticmethod
+    def _setting(value, key):
+        """
+        Return value, or the ENCRYPTED_LOOKUP setting key when value is None.
+        """
+        return encrypted_lookup_settings[key] if value is None else value
+
+    def _encrypt(self, plain_text):
+        """
+        Encrypt plain text of a whole number of blocks, each block independently.
+        """
+        raise NotImplementedError
+
+    def _decrypt(self, cipher_text):
+        """
+        Decrypt cipher text of a whole number of blocks, each block independently.
+        """
+        raise NotImplementedError
+
+    def _pack(self, this_id):
+        """
+        Pack an id into plain text of a whole number of blocks.
+        """
+        raise NotImplementedError
+
+    def _unpack(self, plain_text):
+        """
+        Unpack an id from plain text; the inverse of _pack.
+        """
+        raise NotImplementedError
+
+    def _pack_key(self, this_id):
+        """
+        Pack an id of the cipher's key type into plain text.
+        """
+        if self.key_type != 'uuid':
+            plain_text = self._pack(this_id)
+            if len(plain_text) > self.MAX_BLOCKS * self.BLOCK_SIZE:
+                raise ValueError("Id too long to encode: %r" % this_id)
+            return plain_text
+
+        if not isinstance(this_id, uuid.UUID):
+            try:
+                this_id = uuid.UUID(six.text_type(this_id))
+            except (AttributeError, TypeError, ValueError):
+                raise ValueError("Not a UUID: %r" % this_id)
+
+        return this_id.bytes
+
+    def _unpack_key(self, plain_text):
+        """
+        Unpack an id of the cipher's key type from plain text; the inverse of _pack_key.
+        """
+        if self.key_type != 'uuid':
+            return self._unpack(plain_text)
+
+        if len(plain_text) != self.UUID_LENGTH:
+            raise ValueError("Malformed UUID plain text.")
+
+        return uuid.UUID(bytes=bytes(plain_text))
+
+    def _alphabet_for(self, encoded):
+        """
+        Choose the alphabet to decode a token with, checking the token's length.
+
+        A token whose length cannot be a whole number of blocks in the
+        configured alphabet is taken to be a legacy base32 token. A token
+        whose length fits neither is rejected before any decoding.
+        """
+        try:
+            return self.token_alphabets[len(encoded)]
+        except KeyError:
+            pass
+
+        if not isinstance(encoded, six.string_types):
+            raise InvalidTokenError("Tokens must be strings, not %s." % type(encoded).__name__)
+
+        if len(encoded) > self.max_token_length:
+            raise InvalidTokenError("Tokens are at most %d characters long." %
+                                    self.max_token_length)
+
+        for alphabet in (self.alphabet, LEGACY_ALPHABET):
+            length = alphabet.decoded_length(len(encoded))
+            if length and not length % self.BLOCK_SIZE:
+                # Only valid lengths are remembered, so the dictionary stays small.
+                return self.token_alphabets.setdefault(len(encoded), alphabet)
+
+        raise InvalidTokenError("No token can be %d characters long." % len(encoded))
+
+    def get_token_pattern(self):
+        """
+        A regex, without anchors, which matches every token this cipher can decode.
+
+        It checks only characters and length bounds, as a cheap filter for
+        URL patterns; decoding still validates tokens fully.
+        """
+        alphabets = [self.alphabet]
+        if self.alphabet is not LEGACY_ALPHABET:
+            alphabets.append(LEGACY_ALPHABET)
+
+        return '|'.join(
+            '[%s]{%d,%d}' % (
+                alphabet.character_class,
+                alphabet.encoded_length(self.BLOCK_SIZE),
+                alphabet.encoded_length(self.MAX_BLOCKS * self.BLOCK_SIZE),
+            )
+            for alphabet in alphabets
+        )
+
+    def _check_length(self, cipher_text):
+        if not cipher_text or len(cipher_text) % self.BLOCK_SIZE:
+            raise ValueError(
+                "Cipher text length must be a non-zero multiple of %d." % self.BLOCK_SIZE
+            )
+
+    def get_cache_stats(self):
+        """
+        :return: the counters of the encode, decode and rejected caches which are
+            enabled, or None if caching is disabled
+        """
+        stats = {}
+
+        if self.encode_cache is not None:
+            stats['encode'] = self.encode_cache.get_stats()
+            stats['decode'] = self.decode_cache.get_stats()
+
+        if self.rejected_cache is not None:
+            stats['rejected'] = self.rejected_cache.get_stats()
+
+        return stats or None
+
+    def _remember(self, this_id, encoded):
+        # Only encode produces canonical cipher texts, so only encode may fill
+        # both caches: decode accepts variants, such as upper-cased text.
+        self.encode_cache.set(this_id, encoded)
+
+        # Ids may be given in other types, such as text, than decode returns.
+        self.decode_cache.set(encoded, self._unpack_key(self._pack_key(this_id)))
+
+    def encode(self, this_id):
+        """
+        Encode an integer id into cipher text.
+
+        :param this_id:
+        :return: cipher text
+        """
+        if self.encode_cache is None:
+            return self._encode(this_id)
+
+        result = self.encode_cache.get(this_id)
+        if result is None:
+            result = self._encode(this_id)
+            self._remember(this_id, result)
+
+        return result
+
+    def decode(self, encoded):
+        """
+        Decode an integer id from cipher text.
+
+        :param encoded: cipher text
+        :return: integer id
+        :raise InvalidTokenError: if encoded is not a token of this cipher
+        """
+        try:
+            if self.decode_cache is None and self.rejected_cache is None:
+                return self._decode(encoded)
+
+            result = None if self.decode_cache is None else self.decode_cache.get(encoded)
+            if result is None:
+                if self.rejected_cache is not None and self.rejected_cache.get(encoded):
+                    raise InvalidTokenError("Recently rejected token.")
+
+                result = self._decode(encoded)
+                if self.decode_cache is not None:
+                    self.decode_cache.set(encoded, result)
+
+            return result
+        except DECODE_ERRORS as error:
+            raise self._reject(encoded, error)
+
+    def _reject(self, encoded, error):
+        """
+        Remember a rejected text, if the rejected cache is enabled.
+
+        :return: the InvalidTokenError to raise
+        """
+        if self.rejected_cache is not None and isinstance(encoded, six.string_types):
+            self.rejected_cache.set(encoded, True)
+
+        if isinstance(error, InvalidTokenError):
+            return error
+
+        return InvalidTokenError(str(error))
+
+    def encode_many(self, ids):
+        """
+        Encode a sequence of integer ids into cipher texts.
+
+        Ids which are not already cached are encoded together in one batch.
+
+        :param ids: iterable of integer ids
+        :return: list of cipher texts, in the order of ids
+        """
+        if self.encode_cache is None:
+            return self._encode_many(ids)
+
+        ids = list(ids)
+        results = [self.encode_cache.get(this_id) for this_id in ids]
+
+        missing = [this_id for this_id, result in zip(ids, results) if result is None]
+        encoded = dict(zip(missing, self._encode_many(missing)))
+
+        for this_id in encoded:
+            self._remember(this_id, encoded[this_id])
+
+        return [
+            encoded[this_id] if result is None else result
+            for this_id, result in zip(ids, results)
+        ]
+
+    def decode_many(self, encoded_ids):
+        """
+        Decode a sequence of cipher texts into integer ids.
+
+        Cipher texts which are not already cached are decoded together in one
+        batch.
+
+        :param encoded_ids: iterable of cipher texts
+        :return: list of integer ids, in the order of encoded_ids
+        :raise InvalidTokenError: if any of encoded_ids is not a token of this cipher
+        """
+        try:
+            return self._decode_many_cached(encoded_ids)
+        except DECODE_ERRORS as error:
+            if isinstance(error, InvalidTokenError):
+                raise
+            raise InvalidTokenError(str(error))
+
+    def _decode_many_cached(self, encoded_ids):
+        if self.rejected_cache is not None:
+            encoded_ids = list(encoded_ids)
+            for encoded in encoded_ids:
+                if self.rejected_cache.get(encoded):
+                    raise InvalidTokenError("Recently rejected token.")
+
+        if self.decode_cache is None:
+            return self._decode_many(encoded_ids)
+
+        encoded_ids = list(encoded_ids)
+        results = [self.decode_cache.get(encoded) for encoded in encoded_ids]
+
+        missing = [encoded for encoded, result in zip(encoded_ids, results) if result is None]
+        decoded = dict(zip(missing, self._decode_many(missing)))
+
+        for encoded in decoded:
+            self.decode_cache.set(encoded, decoded[encoded])
+
+        return [
+            decoded[encoded] if result is None else result
+            for encoded, result in zip(encoded_ids, results)
+        ]
+
+    def _encode(self, this_id):
+        return self.alphabet.encode(self._encrypt(self._pack_key(this_id)))
+
+    def _decode(self, encoded):
+        cipher_text = self._alphabet_for(encoded).decode(encoded)
+        self._check_length(cipher_text)
+
+        return self._unpack_key(self._decrypt(cipher_text))
+
+    def _encode_many(self, ids):
+        """
+        Encode a sequence of integer ids into cipher texts, in one batch.
+
+        Every packed id is joined into a single buffer which is encrypted in
+        one call. Because ECB mode encrypts each block independently, the
+        result is identical to calling encode on each id in turn.
+
+        :param ids: iterable of integer ids
+        :return: list of cipher texts, in the order of ids
+        """
+        plain_texts = [self._pack_key(this_id) for this_id in ids]
+
+        if not plain_texts:
+            return []
+
+        result = self._encrypt(b''.join(plain_texts))
+
+        cipher_texts = []
+        offset = 0
+        for plain_text in plain_texts:
+            cipher_texts.append(result[offset:offset + len(plain_text)])
+            offset += len(plain_text)
+
+        return self.alphabet.encode_many(cipher_texts)
+
+    def _decode_many(self, encoded_ids):
+        """
+        Decode a sequence of cipher texts into integer ids, in one batch.
+
+        The inverse of _encode_many: the cipher texts are decoded per
+        alphabet, decrypted in one call, and split back into ids.
+
+        :param encoded_ids: iterable of cipher texts
+        :return: list of integer ids, in the order of encoded_ids
+        """
+        encoded_ids = list(encoded_ids)
+
+        if not encoded_ids:
+            return []
+
+        groups = {}
+        for index, encoded in enumerate(encoded_ids):
+            groups.setdefault(self._alphabet_for(encoded), []).append(index)
+
+        cipher_texts = [None] * len(encoded_ids)
+        for alphabet, indexes in groups.items():
+            decoded = alphabet.decode_many([encoded_ids[index] for index in indexes])
+            for index, cipher_text in zip(indexes, decoded):
+                cipher_texts[index] = cipher_text
+
+        for cipher_text in cipher_texts:
+            # Guard the split below: a short block would otherwise silently
+            # shift every following id.
+            self._check_length(cipher_text)
+
+        result = self._decrypt(b''.join(cipher_texts))
+
+        decoded = []
+        offset = 0
+        for cipher_text in cipher_texts:
+            decoded.append(self._unpack_key(result[offset:offset + len(cipher_text)]))
+            offset += len(cipher_text)
+
+        return decoded
+
+
+class IDCipher(BaseIDCipher):
     """
     Class which encryption/decryption between integer ids and string representations.
+
+    Ids are encrypted with AES-128, and packed into plain text in one of two
+    formats:
+
+    * 'decimal', the original format: the id's decimal string, padded with '{'
+      to a multiple of the block size. Ids of 16 or more characters, which
+      would take two blocks, are packed in the binary format instead, unless
+      they are outside its range.
+    * 'binary': an 8-byte version prefix followed by the id as a signed 64-bit
+      big-endian integer. Every id takes exactly one block.
+
+    Either format is decoded regardless of the configured one, as are base32
+    tokens regardless of the configured alphabet, so that tokens already held
+    by clients keep working through a migration.
     """
 
     BLOCK_SIZE = 16
     PADDING_STRING = '{'
     PADDING_BYTES = bytes(PADDING_STRING.encode('utf-8'))
 
-    def __init__(self, secret=encrypted_lookup_settings['secret_key']):
+    ID_FORMATS = ('decimal', 'binary')
+
+    # A decimal plain text starts with a digit or '-', never with a zero byte.
+    BINARY_PREFIX = b'\x00' * 7 + b'\x01'
+    BINARY_STRUCT = struct.Struct('>q')
+
+    def __init__(self, secret=None, cache_size=None, id_format=None, alphabet=None,
+                 rejected_cache_size=None, key_type='int'):
+        super(IDCipher, self).__init__(cache_size=cache_size, alphabet=alphabet,
+                                       rejected_cache_size=rejected_cache_size, key_type=key_type)
+        secret = self._setting(secret, 'secret_key')
+        id_format = self._setting(id_format, 'id_format')
+
         secret_hash = hashlib.md5(bytearray(secret, 'utf-8')).hexdigest()
         self.secret = codecs.decode(secret_hash, 'hex_codec')
-        self.cipher = AES.new(self.secret)
 
-    def _pad(self, string, padding_char):
+        # Cipher objects are not documented as safe for concurrent use, so each
+        # thread builds its own on first use, rather than taking a shared lock.
+        self.local = threading.local()
+        self.local.cipher = self._new_cipher(self.secret)
+
+        if id_format not in self.ID_FORMATS:
+            raise ValueError("Unrecognized id format: '%s'" % id_format)
+
+        self.id_format = id_format
+
+    def _pad(self, string, padding_char, block_size=None):
         """
         Utility method to pad a string with characters.
 
@@ -34,35 +577,209 @@ class IDCipher(object):
 
         :param string: the string to pad
         :param padding_char:
+        :param block_size: the length to pad to a multiple of, defaults to BLOCK_SIZE
         :return: the padded string
         """
-        return string + (self.BLOCK_SIZE - len(string) % self.BLOCK_SIZE) * padding_char
+        block_size = block_size or self.BLOCK_SIZE
+        return string + (block_size - len(string) % block_size) * padding_char
 
-    def encode(self, this_id):
+    def _new_cipher(self, key):
         """
-        Encode an integer id into cipher text.
+        Build the AES-128 ECB cipher used by _encrypt and _decrypt.
+        """
+        return AES.new(key, AES.MODE_ECB)
 
-        :param this_id:
-        :return: cipher text
+    @property
+    def cipher(self):
+        """
+        The calling thread's cipher.
         """
+        try:
+            return self.local.cipher
+        except AttributeError:
+            self.local.cipher = self._new_cipher(self.secret)
+            return self.local.cipher
 
-        result = self.cipher.encrypt(self._pad(str(this_id), self.PADDING_STRING))
-        result = str(base64.b32encode(result).decode('utf-8')).lower().rstrip('=')
+    def _encrypt(self, plain_text):
+        return self.cipher.encrypt(plain_text)
 
-        return result
+    def _decrypt(self, cipher_text):
+        return self.cipher.decrypt(cipher_text)
 
-    def decode(self, encoded):
+    def _pack(self, this_id):
         """
-        Decode an integer id from cipher text.
+        Pack an id into plain text, in the configured id format.
+        """
+        if self.id_format == 'binary':
+            try:
+                return self.BINARY_PREFIX + self.BINARY_STRUCT.pack(int(this_id))
+            except struct.error:
+                raise ValueError("Id out of the binary id format's 64-bit range: %r" % this_id)
 
-        :param encoded: cipher text
-        :return: integer id
+        text = str(this_id)
+        if len(text) >= self.BLOCK_SIZE:
+            # Keep 64-bit ids, such as those of a BigAutoField, to a single block.
+            try:
+                return self.BINARY_PREFIX + self.BINARY_STRUCT.pack(int(this_id))
+            except (struct.error, ValueError):
+                pass
+
+        return self._pad(text, self.PADDING_STRING).encode('utf-8')
+
+    def _unpack(self, plain_text):
+        """
+        Unpack an id from plain text in either id format.
         """
+        if plain_text.startswith(self.BINARY_PREFIX):
+            if len(plain_text) != self.BLOCK_SIZE:
+                raise ValueError("Malformed binary plain text.")
+            return self.BINARY_STRUCT.unpack(plain_text[len(self.BINARY_PREFIX):])[0]
 
-        result = self.cipher.decrypt(base64.b32decode(self._pad(encoded.upper(), "=")))
-        result = int(result.rstrip(self.PADDING_BYTES))
+        return int(plain_text.rstrip(self.PADDING_BYTES))
 
-        return result
 
-# TODO: Refactor name to ID_CIPHER on next major version upgrade
-id_cipher = IDCipher()  # pylint: disable=invalid-name
+class CryptographyIDCipher(IDCipher):
+    """
+    IDCipher implemented with the cryptography package.
+
+    cryptography's OpenSSL backend uses AES-NI where the CPU has it, which
+    makes large batches much faster; a single-block call costs more than
+    PyCrypto's. Tokens are identical to IDCipher's.
+    """
+
+    def _new_cipher(self, key):
+        if Cipher is None:
+            raise ImportError("CryptographyIDCipher requires the cryptography package.")
+
+        return Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+
+    def _context(self, name):
+        # Building an encryption context is far slower than using one, so each
+        # thread keeps its own pair; contexts must not be shared across threads.
+        context = getattr(self.local, name, None)
+        if context is None:
+            context = getattr(self.cipher, name)()
+            setattr(self.local, name, context)
+
+        return context
+
+    def _encrypt(self, plain_text):
+        # In ECB mode, each update of whole blocks is independent of the last.
+        return self._context('encryptor').update(plain_text)
+
+    def _decrypt(self, cipher_text):
+        return self._context('decryptor').update(cipher_text)
+
+
+class FeistelIDCipher(BaseIDCipher):
+    """
+    Cipher using a keyed Feistel network over 64-bit blocks.
+
+    Every id is packed as a signed 64-bit integer into a single 8-byte block,
+    giving 13-character base32 tokens, or 11 characters in base64 or base62.
+    Tokens are not interchangeable with those of IDCipher. Since every block
+    decrypts to some id, malformed tokens are only caught by their length and
+    alphabet. UUID keys take two blocks.
+    """
+
+    BLOCK_SIZE = 8
+    ROUNDS = 8
+
+    BLOCK_STRUCT = struct.Struct('>q')
+    UNSIGNED_STRUCT = struct.Struct('>Q')
+
+    def __init__(self, secret=None, cache_size=None, alphabet=None, rejected_cache_size=None,
+                 key_type='int'):
+        super(FeistelIDCipher, self).__init__(cache_size=cache_size, alphabet=alphabet,
+                                              rejected_cache_size=rejected_cache_size,
+                                              key_type=key_type)
+        secret = self._setting(secret, 'secret_key')
+
+        # One 32-bit key per round, derived from the secret.
+        secret_hash = hashlib.sha256(bytearray(secret, 'utf-8')).digest()
+        self.round_keys = struct.unpack('>%dI' % self.ROUNDS, secret_hash[:4 * self.ROUNDS])
+        self.reversed_round_keys = tuple(reversed(self.round_keys))
+
+    # The round function is the murmur3 finalizer, keyed by xor: cheap, and
+    # well-mixing. It is inlined below, as calls dominate the cost in Python.
+
+    def _encrypt_block(self, block):
+        left, right = block >> 32, block & 0xffffffff
+        for key in self.round_keys:
+            half = (right ^ key) * 0x85ebca6b & 0xffffffff
+            half ^= half >> 13
+            half = half * 0xc2b2ae35 & 0xffffffff
+            left, right = right, left ^ half ^ (half >> 16)
+        return (left << 32) | right
+
+    def _decrypt_block(self, block):
+        left, right = block >> 32, block & 0xffffffff
+        for key in self.reversed_round_keys:
+            half = (left ^ key) * 0x85ebca6b & 0xffffffff
+            half ^= half >> 13
+            half = half * 0xc2b2ae35 & 0xffffffff
+            left, right = right ^ half ^ (half >> 16), left
+        return (left << 32) | right
+
+    def _encrypt(self, plain_text):
+        count = len(plain_text) // self.BLOCK_SIZE
+        blocks = struct.unpack('>%dQ' % count, plain_text)
+        return struct.pack('>%dQ' % count, *[self._encrypt_block(block) for block in blocks])
+
+    def _decrypt(self, cipher_text):
+        count = len(cipher_text) // self.BLOCK_SIZE
+        blocks = struct.unpack('>%dQ' % count, cipher_text)
+        return struct.pack('>%dQ' % count, *[self._decrypt_block(block) for block in blocks])
+
+    def _pack(self, this_id):
+        try:
+            return self.BLOCK_STRUCT.pack(int(this_id))
+        except struct.error:
+            raise ValueError("Id out of the 64-bit range: %r" % this_id)
+
+    def _unpack(self, plain_text):
+        if len(plain_text) != self.BLOCK_SIZE:
+            raise ValueError("Malformed plain text.")
+        return self.BLOCK_STRUCT.unpack(plain_text)[0]
+
+    def _encode(self, this_id):
+        if self.key_type != 'int':
+            return super(FeistelIDCipher, self)._encode(this_id)
+
+        # Stay in integers between packing and encryption.
+        block = self.UNSIGNED_STRUCT.unpack(self._pack(this_id))[0]
+        return self.alphabet.encode(self.UNSIGNED_STRUCT.pack(self._encrypt_block(block)))
+
+    def _decode(self, encoded):
+        if self.key_type != 'int':
+            return super(FeistelIDCipher, self)._decode(encoded)
+
+        cipher_text = self._alphabet_for(encoded).decode(encoded)
+        if len(cipher_text) != self.BLOCK_SIZE:
+            raise ValueError("Cipher text length must be %d." % self.BLOCK_SIZE)
+
+        block = self._decrypt_block(self.UNSIGNED_STRUCT.unpack(cipher_text)[0])
+        return self.BLOCK_STRUCT.unpack(self.UNSIGNED_STRUCT.pack(block))[0]
+
+
+class PrecomputedIDCipher(object):
+    """
+    Wrapper around a cipher, holding a set of ids which were encoded in one batch.
+
+    Encoding one of those ids is a dictionary lookup; everything else is
+    delegated to the wrapped cipher.
+    """
+
+    def __init__(self, cipher, ids):
+        ids = list(set(ids))
+        self.cipher = cipher
+        self.encoded = dict(zip(ids, cipher.encode_many(ids)))
+
+    def encode(self, this_id):
+        try:
+            return self.encoded[this_id]
+        except KeyError:
+            return self.cipher.encode(this_id)
+
+    def __getattr__(self, name):
+        return getattr(self.cipher, name)
@@ -3,10 +3,52 @@ Django-Rest-Framework replacement Views for rest_framework_encrypted_lookup
 """
 import binascii
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.http import Http404
+import six
 
 from rest_framework import viewsets
 
+from .models import get_token_field
+from .serializers import EncryptedLookupSerializerMixin
+from .streaming import DEFAULT_CHUNK_SIZE, stream_representation
+
+
+# The lookup regex of rest_framework's routers, for lookups of unknown form.
+DEFAULT_LOOKUP_VALUE_REGEX = '[^/.]+'
+
+
+def get_function(method):
+    # Unbound methods wrap their function in Python 2.
+    return getattr(method, '__func__', method)
+
+
+DEFAULT_GET_CIPHER = get_function(EncryptedLookupSerializerMixin.get_cipher)
+
+
+class LookupValueRegexDescriptor(object):
+    """
+    The lookup_value_regex of an encrypted lookup viewset class.
+
+    rest_framework's routers read it to build detail URL patterns, which then
+    match only well-formed tokens of the viewset's cipher, so that junk URLs
+    are rejected by the resolver. A viewset may still set lookup_value_regex
+    itself.
+    """
+
+    def __get__(self, instance, owner):
+        serializer_class = owner.serializer_class
+
+        # A serializer's own get_cipher may depend on its context.
+        if get_function(getattr(serializer_class, 'get_cipher', None)) is not DEFAULT_GET_CIPHER:
+            return DEFAULT_LOOKUP_VALUE_REGEX
+
+        get_token_pattern = getattr(serializer_class.get_model_cipher(), 'get_token_pattern', None)
+        if get_token_pattern is None:
+            return DEFAULT_LOOKUP_VALUE_REGEX
+
+        return get_token_pattern()
+
 
 class EncryptedLookupGenericViewSet(viewsets.GenericViewSet):
     """
@@ -15,13 +57,36 @@ class EncryptedLookupGenericViewSet(viewsets.GenericViewSet):
 
     Dispatch method looks for lookup_field references from the url string
     arguments, replaces them with decrypted values, and calls super's dispatch
-    with the results.
+    with the results. Lookups which were already decoded, such as by
+    EncryptedLookupConverter, are passed through.
+
+    When the serializer's model stores its tokens in an EncryptedLookupTokenField,
+    lookups are not decoded in dispatch. get_object finds the object by its
+    token column instead, decoding only tokens which are not stored, and then
+    sets the lookup URL kwarg to the object's pk.
+
+    Until then, the lookup URL kwarg holds the token, not the pk, so that
+    initial(), permission checks, get_queryset and actions which read
+    self.kwargs before calling get_object see the token. Override
+    get_token_field to return None to decode lookups in dispatch instead.
     """
 
+    lookup_value_regex = LookupValueRegexDescriptor()
+
     def dispatch(self, request, *args, **kwargs):
-        lookup = kwargs.get(self.lookup_field, None)
+        self.decode_lookup_kwargs(request, kwargs)
+
+        return super(EncryptedLookupGenericViewSet, self).dispatch(request, *args, **kwargs)
 
-        if lookup is not None:
+    def decode_lookup_kwargs(self, request, kwargs):
+        """
+        Replace the lookup URL kwarg with its decoded value, in place, unless it
+        was already decoded or is to be found by its stored token.
+        """
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = kwargs.get(lookup_url_kwarg, None)
+
+        if isinstance(lookup, six.string_types):
             # Pre-set some of the variables which may be needed to resolve
             # serializer context:
 
@@ -31,11 +96,96 @@ class EncryptedLookupGenericViewSet(viewsets.GenericViewSet):
             # pylint: disable=attribute-defined-outside-init
             self.format_kwarg = self.get_format_suffix(**kwargs)
 
-            try:
-                kwargs[self.lookup_field] = self.get_serializer().get_cipher().decode(lookup)
-            except binascii.Error:  # Python 3
-                raise Http404
-            except TypeError:       # Python 2
-                raise Http404
+            if self.get_token_field() is None:
+                kwargs[lookup_url_kwarg] = self.decode_lookup(lookup)
 
-        return super(EncryptedLookupGenericViewSet, self).dispatch(request, *args, **kwargs)
+    def decode_lookup(self, lookup):
+        try:
+            return self.get_cipher().decode(lookup)
+        except binascii.Error:  # Python 3
+            raise Http404
+        except TypeError:       # Python 2
+            raise Http404
+        except ValueError:      # Well-formed, but not a token of this cipher
+            raise Http404
+
+    def get_object(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        lookup = self.kwargs.get(lookup_url_kwarg, None)
+        token_field = self.get_token_field()
+
+        if token_field is None or not isinstance(lookup, six.string_types):
+            return super(EncryptedLookupGenericViewSet, self).get_object()
+
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            obj = queryset.get(**{token_field.attname: lookup})
+        except ObjectDoesNotExist:
+            # The token may not have been stored yet; decode it instead.
+            self.kwargs[lookup_url_kwarg] = self.decode_lookup(lookup)
+            return super(EncryptedLookupGenericViewSet, self).get_object()
+
+        self.kwargs[lookup_url_kwarg] = obj.pk
+        self.check_object_permissions(self.request, obj)
+
+        return obj
+
+    def get_token_field(self):
+        """
+        :return: the EncryptedLookupTokenField holding this view's lookups, or None if they
+            must be decoded
+
+        While this returns a field, dispatch leaves the lookup URL kwarg as a token for
+        get_object to resolve.
+        """
+        serializer_class = self.get_serializer_class()
+
+        # A serializer's own cipher may not be the one the tokens were stored with.
+        if get_function(getattr(serializer_class, 'get_cipher', None)) is not DEFAULT_GET_CIPHER:
+            return None
+
+        model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+        token_field = get_token_field(model)
+        if token_field is None:
+            return None
+
+        if self.lookup_field not in ('pk', model._meta.pk.name):  # pylint: disable=protected-access
+            return None
+
+        return token_field
+
+    def get_cipher(self):
+        """
+        Return the cipher with which to decode this view's lookups.
+
+        The cipher of the serializer class's model is taken from the cipher
+        registry, without building a serializer. Only a serializer class which
+        overrides get_cipher, and so may depend on its context, is instantiated.
+        """
+        serializer_class = self.get_serializer_class()
+
+        if get_function(getattr(serializer_class, 'get_cipher', None)) is DEFAULT_GET_CIPHER:
+            return serializer_class.get_model_cipher()
+
+        return self.get_serializer().get_cipher()
+
+
+class EncryptedLookupStreamingListMixin(object):
+    """
+    List action which streams its response, for exports too large to build in memory.
+
+    The queryset is filtered as usual, but not paginated. Items are represented
+    stream_chunk_size at a time, with each chunk's lookups encrypted in one
+    batch, and rendered as a JSON array, or as JSON Lines when stream_format
+    is 'jsonl'. The serializer must be an encrypted-lookup serializer.
+    """
+
+    stream_format = 'json'
+    stream_chunk_size = DEFAULT_CHUNK_SIZE
+
+    def list(self, request, *args, **kwargs):  # pylint: disable=unused-argument
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer(queryset, many=True)
+
+        return stream_representation(serializer, queryset, self.stream_format,
+                                     self.stream_chunk_size)
@@ -10,7 +10,11 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django-rest-encrypted-lookup',
     version='0.10.1',
-    packages=['rest_framework_encrypted_lookup'],
+    packages=[
+        'rest_framework_encrypted_lookup',
+        'rest_framework_encrypted_lookup.management',
+        'rest_framework_encrypted_lookup.management.commands',
+    ],
     include_package_data=True,
     license='GNU General Public License v3 (GPLv3)',
     description='Replace Rest Framework\'s IntegerField pk or id lookups with encrypted strings.',
@@ -19,10 +23,15 @@ setup(
     author='InterSIS Foundation',
     author_email='dev@sigmaeducation.com',
     install_requires=[
-        'django>=1.7',
+        'django>=1.8',
         'djangorestframework>=3.0.0',
         'pycrypto==2.6.1',
+        'six',
     ],
+    extras_require={
+        'cryptography': ['cryptography'],
+        'django-filter': ['django-filter'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',